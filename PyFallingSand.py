@@ -1,25 +1,23 @@
+import argparse                 # command line options for the world size and file
 import tkinter as tk            # Creates tkinter windows
 from tkinter import filedialog  # Save/load tkinter interfaces
-import pickle                   # allows saving and loading of files
 import numpy as np              # easy array interface
-from random import choice       # for particle physics
-import time                     # used for debugging and capping FPS
-
-AIR   = 0   # Empty tile
-STONE = 1   # stationary and indestructible
-SAND  = 2   # falls down and piles up, heavier than water
-WATER = 3   # falls down and spreads out
-WOOD  = 4   # stationary but flammable
-FIRE  = 5   # spreads onto flammable particles
-
-# element colors
-# https://www.plus2net.com/python/tkinter-colors.php
-AIR_COLOR   = "#FAEBD7" # antiquewhite note: we should never actually be drawing AIR rectangles, this is just for the canvas background really
-STONE_COLOR = "#808A87" # coldgrey
-WOOD_COLOR  = "#8B4513" # chocolate
-SAND_COLOR  = "#F4A460" # saddlebrown
-WATER_COLOR = "#7FFFD4" # aquamarine1
-FIRE_COLOR  = "#FF6103" #cadmiumorange
+import time                     # used for measuring FPS and scheduling ticks
+from sand_engine import (AIR, SAND, AIR_COLOR, MATERIALS, PLACEABLE_PARTICLES, PALETTE_HEX, PALETTE_SIZE, SCALAR_STEP, VECTORIZED_STEP,
+                         PARALLEL_STEP, MARGOLUS_STEP, TICK_RATE, EMIT_TICK_TARGET, CIRCLE_BRUSH, SQUARE_BRUSH, SPRAY_BRUSH, BRUSH_RADIUS, MAX_BRUSH_RADIUS,
+                         SPRAY_DENSITY, AUTOSAVE_INTERVAL, BackgroundFiles, FixedTimestep, ReplayReader, SandEngine, render_ppm) # the headless simulation
+
+# renderers
+RECTANGLE_RENDERER = "rectangle" # one canvas rectangle per particle
+IMAGE_RENDERER     = "image"     # one tk.PhotoImage for the whole grid
+
+FRAME_LABEL_INTERVAL = 30 # drawn frames between updates of the FPS/TPS labels and profiler overlay
+SPRAY_DENSITIES = (0.05, 0.1, 0.25, 0.5) # spray densities offered in the Brush menu
+
+# camera settings
+ZOOM_LEVELS  = (1, 2, 4, 6, 10, 16) # cell sizes in pixels the mouse wheel zooms between
+RECTANGLE_MIN_ZOOM = 6              # smallest cell size the rectangle renderer zooms out to, it needs a canvas item for every cell in view
+PAN_FRACTION = 0.25                 # share of the view the arrow keys pan by
 
 # Create the info window with information about the different particles
 class ParticleInfoWindow:
@@ -36,15 +34,9 @@ class ParticleInfoWindow:
         self.populate_info()
     
     def populate_info(self):
-        particle_info = {
-            "Air": "Empty space",
-            "Stone": "Stationary particle",
-            "Sand": "Affected by gravity\nPiles up\nHeavier than water",
-            "Water": "Affected by gravity\nFills available space",
-            "Wood": "Stationary particle\nFlammable",
-            "Fire": "Ignores gravity\nSpreads to flammable particles\nDies if there is no flammable particle\nDoused by water",
-            "" : ""
-        }# Empty entry is because the anchor="nw" isn't being applied to the last created label for some reason
+        # every material in the registry gets a row
+        particle_info = {material.name: material.description for material in MATERIALS}
+        particle_info[""] = "" # Empty entry is because the anchor="nw" isn't being applied to the last created label for some reason
         # parse through particle_info and populate a grid with tk.Label objects
         for index, (particle, description) in enumerate(particle_info.items()):
             particle_name = tk.Label(self.info_frame, text=particle, bd=1, relief=tk.SUNKEN, padx=5, pady=5)
@@ -52,107 +44,492 @@ class ParticleInfoWindow:
             
             particle_description = tk.Label(self.info_frame, text=description, bd=1, relief=tk.SUNKEN, anchor="nw", padx=10, pady=5)
             particle_description.grid(row=index, column=2, sticky="nsew")
+class RectangleRenderer:
+    '''
+    Draws every particle as its own rectangle on the canvas
+    Every cell gets one rectangle up front, kept in a rows x columns table of canvas item ids,
+    so redrawing a cell only changes its fill or hides it and the canvas item count never grows
+    '''
+    def __init__(self, canvas, cell_size):
+        self.canvas    = canvas
+        self.cell_size = cell_size
+        self.items = None # canvas item id of every cell's rectangle, built by draw_all
+        self.shown = None # palette key every rectangle is showing, -1 when it's hidden
+
+    def build_items(self, rows, columns):
+        '''
+        Creates a hidden rectangle for every cell of the grid
+
+        Args:
+            rows (int): The number of rows in the grid
+            columns (int): The number of columns in the grid
+        '''
+        self.canvas.delete("particle")
+        size = self.cell_size
+        create_rectangle = self.canvas.create_rectangle
+        self.items = np.array([[create_rectangle(column*size, row*size, (column+1)*size, (row+1)*size, outline="", state="hidden", tags="particle")
+                                for column in range(columns)] for row in range(rows)], dtype=np.int64).reshape(rows, columns)
+        self.shown = np.full((rows, columns), -1, dtype=np.int32)
+    def draw(self, grid, rectangles):
+        '''
+        Draws the particles in every changed rectangle
+
+        Args:
+            grid (ParticleGrid): The part of the particle grid in view
+            rectangles (list): (row_start, row_end, column_start, column_end) tuples of changed cells in the view
+        '''
+        if self.items is None or self.items.shape != grid.types.shape:
+            self.draw_all(grid)
+            return
+        for row_start, row_end, column_start, column_end in rectangles:
+            rows, columns = np.indices((row_end - row_start, column_end - column_start)).reshape(2, -1)
+            # draw_cells skips the cells in the rectangle that didn't change
+            self.draw_cells(grid, rows + row_start, columns + column_start)
+    def draw_cells(self, grid, rows, columns):
+        '''
+        Points the rectangles of the given cells at their particle's color, or hides them for AIR
+
+        Args:
+            grid (ParticleGrid): The particle grid
+            rows, columns (np.ndarray, np.ndarray): The row and column of every cell to draw
+        '''
+        types = grid.types[rows, columns]
+        # AIR is drawn by hiding the rectangle, every other cell by its palette entry
+        keys = np.where(types == AIR, -1, types.astype(np.int32) * PALETTE_SIZE + grid.colors[rows, columns])
+        # skip the cells whose rectangle already shows the right color
+        changed = keys != self.shown[rows, columns]
+        rows, columns, keys = rows[changed], columns[changed], keys[changed]
+        self.shown[rows, columns] = keys
+        itemconfigure = self.canvas.itemconfigure
+        for item, key in zip(self.items[rows, columns].tolist(), keys.tolist()):
+            if key < 0:
+                itemconfigure(item, state="hidden")
+            else:
+                itemconfigure(item, fill=PALETTE_HEX[key // PALETTE_SIZE][key % PALETTE_SIZE], state="normal")
+    def draw_all(self, grid):
+        '''
+        Redraws the entire grid, hiding every rectangle at once before showing the ones that aren't AIR
+        '''
+        if self.items is None or self.items.shape != grid.types.shape:
+            self.build_items(grid.rows, grid.columns)
+        else:
+            self.canvas.itemconfigure("particle", state="hidden")
+            self.shown.fill(-1)
+        self.draw_cells(grid, *np.nonzero(grid.types != AIR))
+    def clear(self):
+        '''
+        Removes every particle from the canvas
+        '''
+        self.canvas.delete("particle")
+        self.items = self.shown = None
+
+class ImageRenderer:
+    '''
+    Draws the whole grid into a single tk.PhotoImage
+    Changed cells are turned into RGB pixels with NumPy and only the box around them is pushed to the image
+    '''
+    def __init__(self, canvas, cell_size, width, height):
+        self.canvas    = canvas
+        self.cell_size = cell_size
+        self.image = tk.PhotoImage(width=width, height=height)
+        self.image.put(AIR_COLOR, to=(0, 0, width, height))
+        self.canvas.create_image(0, 0, image=self.image, anchor="nw", tags="particle")
+        self.canvas.tag_lower("particle")
+
+    def draw_region(self, grid, row_start, row_end, column_start, column_end):
+        '''
+        Pushes a rectangle of cells to the image
+
+        Args:
+            grid (ParticleGrid): The particle grid
+            row_start, row_end (int, int): The rows of the rectangle, end exclusive
+            column_start, column_end (int, int): The columns of the rectangle, end exclusive
+        '''
+        data = render_ppm(grid[row_start:row_end, column_start:column_end], self.cell_size)
+        self.image.tk.call(self.image.name, "put", data, "-format", "ppm", "-to", column_start*self.cell_size, row_start*self.cell_size)
+    def draw(self, grid, rectangles):
+        '''
+        Redraws every rectangle of changed cells
+
+        Args:
+            grid (ParticleGrid): The part of the particle grid in view
+            rectangles (list): (row_start, row_end, column_start, column_end) tuples of changed cells in the view
+        '''
+        for row_start, row_end, column_start, column_end in rectangles:
+            self.draw_region(grid, row_start, row_end, column_start, column_end)
+    def draw_all(self, grid):
+        '''
+        Redraws the entire grid
+        '''
+        self.draw_region(grid, 0, grid.rows, 0, grid.columns)
+    def clear(self):
+        '''
+        Removes the image from the canvas
+        '''
+        self.canvas.delete("particle")
+
+class Camera:
+    '''
+    The part of the world shown in the window, as its top left cell and how many pixels wide a cell is
+    Worlds bigger than the window are panned and zoomed through, and only the cells in view are ever drawn
+    '''
+    def __init__(self, world_rows, world_columns, width, height, cell_size):
+        self.world_rows    = world_rows
+        self.world_columns = world_columns
+        self.width  = width
+        self.height = height
+        self.cell_size = cell_size
+        self.row    = 0
+        self.column = 0
+
+    def view_size(self):
+        '''
+        Returns:
+            rows, columns (int, int): How many cells fit in the window at the current zoom, never more than the world has
+        '''
+        return min(self.height // self.cell_size, self.world_rows), min(self.width // self.cell_size, self.world_columns)
+    def bounds(self):
+        '''
+        Returns:
+            bounds (int, int, int, int): (row_start, row_end, column_start, column_end) of the cells in view, ends exclusive
+        '''
+        rows, columns = self.view_size()
+        return self.row, self.row + rows, self.column, self.column + columns
+    def clamp(self):
+        '''
+        Keeps the view inside the world
+        '''
+        rows, columns = self.view_size()
+        self.row    = min(max(self.row, 0), self.world_rows - rows)
+        self.column = min(max(self.column, 0), self.world_columns - columns)
+    def pan(self, rows, columns):
+        '''
+        Moves the view by a number of cells
+
+        Args:
+            rows (int): Cells to move down, negative to move up
+            columns (int): Cells to move right, negative to move left
+        '''
+        self.row += rows
+        self.column += columns
+        self.clamp()
+    def zoom(self, cell_size, x, y):
+        '''
+        Changes the cell size, keeping the cell under a pixel of the window in place
+
+        Args:
+            cell_size (int): The new cell size in pixels
+            x, y (int, int): The pixel of the window to zoom around
+        '''
+        row, column = self.to_grid(x, y)
+        self.cell_size = cell_size
+        self.row, self.column = row - y // cell_size, column - x // cell_size
+        self.clamp()
+    def resize(self, world_rows, world_columns):
+        '''
+        Points the camera at a different sized world, like after a scene is loaded
+        '''
+        self.world_rows, self.world_columns = world_rows, world_columns
+        self.clamp()
+    def to_grid(self, x, y):
+        '''
+        Returns the grid location of a pixel of the window
+
+        Returns:
+            location (int, int): (row, column) of the cell under the pixel
+        '''
+        return self.row + y // self.cell_size, self.column + x // self.cell_size
 
 class FallingSand:
-    def __init__(self, root, title, width, height, cell_size):
+    def __init__(self, root, title, width, height, cell_size, tick_rate=TICK_RATE, world_rows=None, world_columns=None, world_path=None):
         # Tk window variables
         self.root = root
         self.root.title(title)
         self.root.geometry(f"{width}x{height}")
         self.root.resizable(False,False)
         
-        # Debug settings
-        self.debug_log = "DEBUG LOG\n\n"
-        self.debug_time = time.time()
-
         # Particle settings
         self.current_particle = SAND
+        self.show_chunks = False
+        self.brush_shape   = CIRCLE_BRUSH
+        self.spray_density = SPRAY_DENSITY
         
         # Simulation Variables
-        self.columns = width // cell_size  # x
-        self.rows    = height // cell_size # y
-        # Creates a grid of size [rows][columns] filled with tuples that contain (int, 7 character string).  The string is 7characters since it should only be a hex value starting with '#'
-        self.particle_grid = np.zeros((self.rows, self.columns), dtype=[('particle_type', int),('particle_color','U7')])
-        # Fill the grid with default value of AIR. AIR_COLOR is probably not needed
-        self.particle_grid.fill((AIR,AIR_COLOR))
-        self.updated_particles = []
+        # the world defaults to the size of the window, a bigger one is scrolled through with the camera
+        self.columns = world_columns or width // cell_size  # x
+        self.rows    = world_rows or height // cell_size    # y
+        self.engine  = SandEngine(self.rows, self.columns)
+        if world_path:
+            # a world file is memory-mapped, so only the parts of it in use need to be in memory
+            self.engine.open_world(world_path, self.rows, self.columns)
+            self.rows, self.columns = self.engine.rows, self.engine.columns
+        self.timestep = FixedTimestep(tick_rate)
+        # the window has a frame rate to keep, so the emitters back off when ticks run long
+        self.engine.emitters.tick_target = EMIT_TICK_TARGET
+        # saves and loads run on a worker thread, a memory-mapped world is already kept on disk so it isn't autosaved
+        self.files = BackgroundFiles()
+        self.autosave = world_path is None
+        self.last_autosave = time.perf_counter()
         
         # Canvas Variables
         self.canvas_width   = width
         self.canvas_height  = height
-        self.cell_size      = cell_size
+        self.camera = Camera(self.rows, self.columns, width, height, cell_size)
+        self.engine.set_focus(self.camera.bounds())
 
         # Mouse Variables
         self.mouse_down     = False
         self.mouse_position = (0,0)
         
-        #self.root.protocol("WM_DELETE_WINDOW", self.debug_on_closing)
-        
         # Create the canvas to display the simulation
         self.canvas = tk.Canvas(root, width=width, height=height, bg=AIR_COLOR)
         self.canvas.pack()
+        self.renderer_type = IMAGE_RENDERER
+        self.renderer = ImageRenderer(self.canvas, cell_size, width, height)
+        self.renderer.draw_all(self.view())
+
+        # Create an FPS counter label and a simulation tick rate label under it, with the profiler overlay next to them
+        self.fps_label = tk.Label(root, text="FPS: 0", font=("Helvetica", 8))
+        self.fps_label.place(x=2, y=2)
+        self.tps_label = tk.Label(root, text="TPS: 0", font=("Helvetica", 8))
+        self.tps_label.place(x=2, y=20)
+        self.profile_label = tk.Label(root, text="", font=("Helvetica", 8), justify="left")
+        # progress of a background save or load, only shown while one is running
+        self.file_label = tk.Label(root, text="", font=("Helvetica", 8))
+        self.frame_count = 0
+        # brush size slider in the top right corner
+        self.brush_radius = tk.IntVar(value=BRUSH_RADIUS)
+        self.brush_slider = tk.Scale(root, variable=self.brush_radius, from_=0, to=MAX_BRUSH_RADIUS, orient="horizontal",
+                                     label="Brush Size", length=120, font=("Helvetica", 8))
+        self.brush_slider.place(relx=1.0, x=-2, y=2, anchor="ne")
+        # replay scrubber along the bottom, only shown while a replay is open
+        self.playback = None
+        self.live_state = None # the emitters, undo history and world file from before the replay was opened, put back when it's closed
+        self.replay_slider = tk.Scale(root, from_=0, to=0, orient="horizontal", label="Replay Tick", length=width // 2,
+                                      font=("Helvetica", 8), command=self.seek_replay)
         
         # Draw and update the sand particles
-        self.canvas.bind("<ButtonPress-1>", self.on_mouse_down) # start drawing sand when mouse is pressed down
+        self.canvas.bind("<ButtonPress-1>", self.on_mouse_down) # start a brush stroke when mouse is pressed down
         self.canvas.bind("<ButtonRelease-1>", self.on_mouse_up) # stop drawing sand when mouse is released
-        self.canvas.bind("<Motion>", self.track_mouse) # update the current mouse position in relation to the canvas
+        self.canvas.bind("<Motion>", self.track_mouse) # update the current mouse position, and paint the stroke since the last one
+        self.canvas.bind("<ButtonPress-3>", self.on_right_click) # place an emitter of the current particle, or remove one when erasing
+        # Move the camera around a world bigger than the window
+        self.canvas.bind("<ButtonPress-2>", self.on_pan_start) # drag with the middle mouse button to pan
+        self.canvas.bind("<B2-Motion>", self.on_pan_drag)
+        self.canvas.bind("<MouseWheel>", self.on_mouse_wheel) # zoom in and out around the cursor
+        self.canvas.bind("<Button-4>", self.on_mouse_wheel)   # the mouse wheel on X11
+        self.canvas.bind("<Button-5>", self.on_mouse_wheel)
+        for key, rows, columns in (("<Up>", -1, 0), ("<Down>", 1, 0), ("<Left>", 0, -1), ("<Right>", 0, 1)):
+            self.root.bind(key, lambda event, rows=rows, columns=columns: self.pan_view(rows, columns))
+        # Undo and redo brush strokes and resets
+        self.root.bind("<Control-z>", lambda event: self.undo())
+        self.root.bind("<Control-y>", lambda event: self.redo())
+        self.pan_anchor = None
 
         # Start the animation loop
         self.root.after_idle(self.update_canvas)
 
-    # Debug methods
-    def debug_on_closing(self):
-        with open("./bin/debug_log.txt", "wb") as file:
-            pickle.dump(self.debug_log, file)
-        self.root.quit()
-    def debug_log_message(self, message):
-        current_time = time.time()
-        self.debug_log += f"{message} took {(current_time-self.debug_time):3f}milliseconds\n"
-        self.debug_time = time.time()
+    # Profiling methods
+    def toggle_profiling(self):
+        '''
+        Turns the profiler and its overlay on or off
+        '''
+        profiler = self.engine.profiler
+        profiler.set_enabled(not profiler.enabled)
+        if profiler.enabled:
+            self.profile_label.place(x=70, y=2)
+        else:
+            self.profile_label.place_forget()
+    def update_frame_labels(self):
+        '''
+        Updates the FPS and TPS labels, and the profiler overlay when profiling, every FRAME_LABEL_INTERVAL drawn frames
+        '''
+        self.frame_count += 1
+        if self.frame_count < FRAME_LABEL_INTERVAL:
+            return
+        tick_rate, frame_rate = self.timestep.rates(time.perf_counter())
+        self.fps_label.config(text=f"FPS: {frame_rate:.0f}")
+        self.tps_label.config(text=f"TPS: {tick_rate:.0f}")
+        self.frame_count = 0
 
+        if not self.engine.profiler.enabled:
+            return
+        averages = self.engine.profiler.averages()
+        self.profile_label.config(text=f"input {averages['input']*1000:.2f}ms  simulate {averages['simulate']*1000:.2f}ms  render {averages['render']*1000:.2f}ms\n"
+                                       f"swaps {averages['swaps']:.0f}  dirty cells {averages['dirty_cells']:.0f}  canvas items {averages['canvas_items']:.0f}")
+    def dump_profile_dialog(self):
+        '''
+        Creates a save dialog window
+        Opens a file dialog to set the path the profiler's frame samples are written to as CSV
+        '''
+        filename = filedialog.asksaveasfilename(defaultextension=".csv", filetypes=[("CSV Files", "*.csv")])
+        if filename:
+            self.engine.profiler.to_csv(filename)
+        self.timestep.reset()
 
     # Mouse control methods
     def on_mouse_down(self, event):
         '''
         Called when the mouse button1 is pressed
-        Sets the mouse_down boolean to true and calls the draw_particle method
+        Sets the mouse_down boolean to true and paints the brush under the cursor, the whole stroke is undone as one edit
         '''
+        # a replay is only watched, not painted on
+        if self.playback:
+            return
         self.mouse_down = True
-        self.place_particle()
+        self.engine.begin_edit()
+        self.mouse_position = self.camera.to_grid(event.x, event.y)
+        self.paint_stroke(self.mouse_position, self.mouse_position)
     def on_mouse_up(self, event):
         '''
         Called when the mouse button1 is released
-        Sets the mouse_down boolean to false
+        Sets the mouse_down boolean to false and ends the stroke's edit
         '''
         self.mouse_down = False
+        self.engine.end_edit()
+    def on_right_click(self, event):
+        '''
+        Called when the mouse button3 is pressed
+        Places an emitter of the current particle under the cursor, or removes the emitter there when erasing
+        '''
+        if self.playback:
+            return
+        location = self.camera.to_grid(event.x, event.y)
+        if self.current_particle == AIR:
+            self.engine.remove_emitter(location)
+        else:
+            self.engine.add_emitter(location, self.current_particle)
+        self.draw_emitters()
     def track_mouse(self, event):
         '''
         Called when the mouse/cursor is moved
-        Updates the cursor position in relation to the grid
+        Updates the cursor position in relation to the grid, and paints the line from the last position while button1 is held
+        '''
+        #(row,column) <=> (y, x)
+        position = self.camera.to_grid(event.x, event.y)
+        if self.mouse_down and position != self.mouse_position:
+            self.paint_stroke(self.mouse_position, position)
+        self.mouse_position = position
+
+    # Camera methods
+    def on_pan_start(self, event):
+        '''
+        Called when the mouse button2 is pressed
+        Remembers the grid location under the cursor so dragging keeps it under the cursor
+        '''
+        self.pan_anchor = self.camera.to_grid(event.x, event.y)
+    def on_pan_drag(self, event):
+        '''
+        Called when the mouse moves while button2 is held
+        Pans the view so the cell grabbed by on_pan_start follows the cursor
+        '''
+        if self.pan_anchor is None:
+            return
+        row, column = self.camera.to_grid(event.x, event.y)
+        if (row, column) != self.pan_anchor:
+            self.camera.pan(self.pan_anchor[0] - row, self.pan_anchor[1] - column)
+            self.redraw_view()
+    def on_mouse_wheel(self, event):
+        '''
+        Called when the mouse wheel turns
+        Zooms the view in or out one of the ZOOM_LEVELS around the cursor, the rectangle renderer stops at RECTANGLE_MIN_ZOOM
+        '''
+        zoom_in = event.num == 4 or event.delta > 0
+        smallest = RECTANGLE_MIN_ZOOM if self.renderer_type == RECTANGLE_RENDERER else 0
+        levels = [size for size in ZOOM_LEVELS if size >= smallest and (size > self.camera.cell_size if zoom_in else size < self.camera.cell_size)]
+        if not levels:
+            return
+        self.camera.zoom(min(levels) if zoom_in else max(levels), event.x, event.y)
+        # the renderers draw at a fixed cell size, so start a new one at the new zoom
+        self.set_renderer(self.renderer_type, force=True)
+    def pan_view(self, rows, columns):
+        '''
+        Pans the view by PAN_FRACTION of its size in the given direction
+
+        Args:
+            rows (int): -1 to pan up, 1 to pan down, 0 to stay
+            columns (int): -1 to pan left, 1 to pan right, 0 to stay
+        '''
+        view_rows, view_columns = self.camera.view_size()
+        self.camera.pan(rows * max(int(view_rows * PAN_FRACTION), 1), columns * max(int(view_columns * PAN_FRACTION), 1))
+        self.redraw_view()
+    def view(self):
+        '''
+        Returns the part of the particle grid that's in view, as a ParticleGrid sharing memory with the engine's
+        '''
+        row_start, row_end, column_start, column_end = self.camera.bounds()
+        return self.engine.particle_grid[row_start:row_end, column_start:column_end]
+    def redraw_view(self):
+        '''
+        Redraws everything in view after the camera moved, and tells the engine which part of the world to simulate every tick
         '''
-        #if self.mouse_down:
-            #(row,column) <=> (y, x)
-        self.mouse_position = (event.y // self.cell_size, event.x // self.cell_size)
+        self.engine.set_focus(self.camera.bounds())
+        self.renderer.draw_all(self.view())
+        self.draw_emitters()
+        self.draw_chunk_overlay()
 
     # Saving/Loading methods
     def save_scene(self, path):
         '''
-        Saves the current particle_grid to the specified path
+        Starts saving a copy of the current particle_grid to the specified path in the background
 
         Args:
             path (str): The [relative/absolute] path where to save the .sand file to
         '''
-        with open(path, 'wb') as file:
-            pickle.dump(self.particle_grid, file)
+        if not self.files.save(self.engine, path):
+            print(f"Can't save {path} while {self.files.path} is still being written or read")
     def load_scene(self, path):
         '''
-        Loads the file at the specified path and dumps it into the particle_grid
-        
+        Starts loading the file at the specified path in the background, it replaces the particle_grid once it's read
+
         Args:
             path (str): The [absolute/relative] path to the .sand file to be loaded
         '''
-        with open(path, 'rb') as file:
-            self.particle_grid = pickle.load(file)
+        if not self.files.load(path):
+            print(f"Can't load {path} while {self.files.path} is still being written or read")
+    def install_scene(self, grid, sections):
+        '''
+        Swaps a scene loaded in the background in for the current one and redraws the view
+
+        Args:
+            grid (ParticleGrid): The loaded grid
+            sections (dict): The scene's extra tagged sections
+        '''
+        self.engine.install_scene(grid, sections)
+        self.rows, self.columns = self.engine.rows, self.engine.columns
+        self.camera.resize(self.rows, self.columns)
+        # redraw the entire canvas
+        self.engine.dirty.clear()
+        self.redraw_view()
+    def update_files(self, now):
+        '''
+        Starts the autosave when it's due, shows the progress of a running save or load and swaps a finished load in
+        Never waits on the worker thread, so the frame loop doesn't stall on the disk
+
+        Args:
+            now (float): The current time in seconds
+        '''
+        if self.autosave and now - self.last_autosave >= AUTOSAVE_INTERVAL and self.files.autosave(self.engine):
+            self.last_autosave = now
+        if self.files.busy():
+            action = "Loading" if self.files.kind == "load" else "Saving"
+            self.file_label.config(text=f"{action} {self.files.path} {self.files.progress:.0%}")
+            self.file_label.place(x=2, y=38)
+            return
+        kind = self.files.kind
+        try:
+            finished = self.files.poll()
+        except Exception as error:
+            # the file couldn't be written or read, the scene carries on as it was
+            print(f"Couldn't {kind} {self.files.path}: {error}")
+            finished = None
+        self.file_label.place_forget()
+        if finished and finished[0] == "load":
+            try:
+                self.install_scene(*finished[1])
+            except ValueError as error:
+                # a scene of another size can't be copied into an open world
+                print(f"Couldn't load {self.files.path}: {error}")
 
     # Save/Load dialog windows
     def save_dialog(self):
@@ -163,6 +540,8 @@ class FallingSand:
         filename = filedialog.asksaveasfilename(defaultextension=".sand")
         if filename:
             self.save_scene(filename)
+        # the dialog blocked the loop, don't catch up on the time it was open
+        self.timestep.reset()
     def load_dialog(self):
         '''
         Creates a load dialog window
@@ -171,244 +550,191 @@ class FallingSand:
         filename = filedialog.askopenfilename(filetypes=[("PyFallingSand Scenes", "*.sand")])
         if filename:
             self.load_scene(filename)
-        
-        # redraw the entire canvas
-        for row in range(self.rows):
-            for column in range(self.columns):
-                self.updated_particles.append((row,column))
+        self.timestep.reset()
 
-    # Helper methods
-    def vary_color(self, color):
+    # Replay methods
+    def record_replay_dialog(self):
         '''
-        Takes a hex color string and returns a slightly varied hex string
-        
-        Args:
-            color (str): A 7 character hex color string "#RRBBGG"
-        
-        Returns:
-            varied_color (str): A 7 character hex color string
+        Creates a save dialog window
+        Opens a file dialog to set the path a replay log of every tick is streamed to
         '''
-        hex_range = ['0', '1', '2', '3', '4', '5', '6', '7', '8', '9', 'A', 'B', 'C', 'D', 'E', 'F']
-        varied_color = f"#{color[1]}{choice(hex_range)}{color[3]}{choice(hex_range)}{color[5]}{choice(hex_range)}"
-        return varied_color
-
-    # Particle methods
-    def swap_particles(self, particle_1, particle_2):
+        filename = filedialog.asksaveasfilename(defaultextension=".slog", filetypes=[("PyFallingSand Replays", "*.slog")])
+        if filename:
+            self.engine.start_replay(filename)
+        self.timestep.reset()
+    def open_replay_dialog(self):
         '''
-        Swap the particles at the input grid location tuples
-
-        Args:
-            particle_1 (int, int): Tuple of integers representing the row and column of a particle to be swapped
-            particle_2 (int, int): Tuple of integers representing the row and column of a particle to be swapped
+        Creates a load dialog window
+        Opens a file dialog to retrieve the path to a replay log to scrub through
         '''
-        p1_row, p1_column = particle_1
-        p2_row, p2_column = particle_2
-
-        # create a copy of particle_1
-        # move particle_2 to particle_1's location
-        # move the copy of particle_1 to particle_2's location
-        temp = tuple(self.particle_grid[p1_row][p1_column])
-        self.particle_grid[p1_row][p1_column] = self.particle_grid[p2_row][p2_column]
-        self.particle_grid[p2_row][p2_column] = temp
-
-        # Add the particles to the updated_particles array if they're not already there
-        if (p1_row, p1_column) not in self.updated_particles:
-            self.updated_particles.append((p1_row, p1_column))
-        if (p2_row, p2_column) not in self.updated_particles:
-            self.updated_particles.append((p2_row, p2_column))
-    def update_sand(self, sand_location):
+        filename = filedialog.askopenfilename(filetypes=[("PyFallingSand Replays", "*.slog")])
+        if filename:
+            self.open_replay(filename)
+        self.timestep.reset()
+    def open_replay(self, path):
         '''
-        The update logic for sand particles
+        Opens a replay log and pauses the simulation, the scrubber at the bottom of the window picks the tick to show
 
         Args:
-            sand_location (int,int): A tuple containing the grid location of the sand particle
+            path (str): The [absolute/relative] path of the replay log
         '''
-        row, column = sand_location
-
-        # if the particle is at the bottom of the grid(or somehow past it)
-        if row >= self.rows-1:
-            # do nothing
-            return
-
-        # Identify the particle below our sand location
-        particle_below = self.particle_grid[row+1][column][0]
-        # Is particle_below AIR or WATER?
-        if particle_below in {AIR, WATER}:
-            # Swap the sand particle to that location
-            # TODO: I want better logic for WATER particles
-            #       Maybe instead of raw swapping, I could have the particle "push" other water particles upward to make room for the sand
-            self.swap_particles(sand_location, (row+1, column))
+        try:
+            reader = ReplayReader(path)
+        except (OSError, ValueError) as error:
+            print(f"Couldn't open {path}: {error}")
             return
-        # If the particle is not AIR or WATER
-
-        # pick a random direction
-        direction = choice([-1,0,1])
-        # if that direction isn't in bounds or if direction is 0
-        if not (0 <= column + direction < self.columns) or direction == 0:
-            # do nothing
-            return
-        # else that direction is in bounds
-        
-        # Is the particle diagonally down in that direction AIR or WATER?
-        particle_diagonal = self.particle_grid[row+1][column+direction][0]
-        particle_adjacent = self.particle_grid[row][column+direction][0] # adding this stops the particle from slipping down diagonal gaps in walls
-        if particle_diagonal in {AIR, WATER} and particle_adjacent in {AIR, WATER}:
-            # Swap the sand particle to that location
-            # TODO: I want better logic for WATER particles
-            self.swap_particles(sand_location, (row+1, column+direction))
-            #return
-        # if you've reached here, then do nothing
-    def update_water(self, water_location):
-        '''
-        The update logic for water particles
+        self.close_replay()
+        self.live_state = (self.engine.emitters.to_bytes(), self.engine.history, self.engine.world_path)
+        # the replay's ticks are shown in memory, they'd overwrite an open world's file otherwise
+        self.engine.close_world()
+        self.playback = reader
+        self.replay_slider.config(from_=reader.first_tick, to=reader.last_tick)
+        self.replay_slider.set(reader.first_tick)
+        self.replay_slider.place(relx=0.5, rely=1.0, y=-2, anchor="s")
+        self.seek_replay(reader.first_tick)
+    def seek_replay(self, tick):
+        '''
+        Shows the grid and emitters of the open replay after the given tick, rebuilt from the log without running the simulation
 
         Args:
-            water_location (int,int): A tuple containing the grid location of the water particle
-        '''
-        row, column = water_location
-
-        # if the particle is at the bottom of the grid(or somehow past it)
-        if row >= self.rows-1:
-            # move in a random direction, if able
-            # pick a random direction
-            direction = choice([-1,0,1])
-            # is that direction out of bounds or 0?
-            if not (0 <= column+direction < self.columns) or direction == 0:
-                # do nothing
-                return
-            # else that direction is in bounds and not 0
-
-            # is the particle in that direction AIR?
-            if self.particle_grid[row][column+direction][0] == AIR:
-                # Swap the water particle in that direction
-                self.swap_particles(water_location, (row, column+direction))
-                #return
-            # if you've reached here, then do nothing
-            return
-
-        # else that particle is not at the bottom of the grid
-
-        # Identify the particle below our location
-        # Is particle_below AIR?
-        if self.particle_grid[row+1][column][0] == AIR:
-            # Swap the water particle to that location
-            self.swap_particles(water_location, (row+1, column))
-            return
-        # else the particle_below is not AIR
-
-        # move in a random direction, if able
-        # pick a random direction
-        direction = choice([-1,1])
-        # is that direction out of bounds or 0?
-        if not (0 <= column+direction < self.columns):
-            # do nothing
+            tick (str): The tick picked on the scrubber
+        '''
+        if self.playback is None:
             return
-        # else that direction is in bounds and not 0
-
-        # Is the particle in the direction AIR?
-        if self.particle_grid[row][column+direction][0] == AIR:
-            # Swap the water particle to that location
-            self.swap_particles(water_location, (row, column+direction))
-            #return
-        # if you've reached here, then do nothing
-    def update_particles(self):
-        '''
-        The update logic for all particle types
-        '''
-        for column in range(self.columns):
-            for row in range(self.rows-1, -1, -1):
-                particle_type = self.particle_grid[row][column][0]
-                if particle_type == SAND:
-                    self.update_sand((row, column))
-                elif particle_type == WATER:
-                    self.update_water((row, column))
-                elif particle_type in {STONE, WOOD, AIR}:
-                    continue
-                else:
-                    print(f"Error: update_particles() - Invalid particle type: {particle_type}")       
-    def place_particle(self):
-        '''
-        References the mouse location to place a particle in the corresponding grid location
-        '''
-        # is button1 on the mouse is not pressed?
-        if not self.mouse_down:
-            # do nothing
+        tick = int(tick)
+        self.install_scene(self.playback.seek(tick), self.playback.sections(tick))
+    def close_replay(self):
+        '''
+        Closes the open replay, the simulation carries on from the tick on screen with the emitters and undo history it had before
+        the replay was opened, or from the world as it's kept in its file when a world was open
+        '''
+        if self.playback is None:
             return
-        # else button1 is pressed down
+        self.playback.close()
+        self.playback = None
+        self.replay_slider.place_forget()
+        emitters, history, world_path = self.live_state
+        self.live_state = None
+        if world_path is not None:
+            self.engine.open_world(world_path)
+            self.rows, self.columns = self.engine.rows, self.engine.columns
+            self.camera.resize(self.rows, self.columns)
+            # the whole view is redrawn below
+            self.engine.dirty.clear()
+        self.engine.emitters.load_bytes(emitters, self.rows, self.columns)
+        # the history's snapshots only fit a grid of the size it was recorded on
+        if (history.rows, history.columns) == (self.rows, self.columns):
+            self.engine.history = history
+        self.redraw_view()
+        self.timestep.reset()
 
-        row, column = self.mouse_position
-        # is the mouse within the bounds of the grid?
-        if 0 <= row < self.rows and 0 <= column < self.columns:
-        
-        # TODO: decide if I want to let particles replace existing particles
-        #    # is there a particle already in that grid location?
-        #    if self.particle_grid[row][column][0] != AIR:
-        #        # do nothing
-        #        return
-        #    # else the particle is not in that grid location
-        #   else:
-            # Define a dictionary mapping particle types to colors
-            particle_colors = {
-                SAND: self.vary_color(SAND_COLOR),
-                WATER: self.vary_color(WATER_COLOR),
-                STONE: STONE_COLOR,
-                WOOD: self.vary_color(WOOD_COLOR),
-                AIR: AIR_COLOR
-            }
-
-            # Get color based on current particle type
-            particle_color = particle_colors.get(self.current_particle)
-
-            # If somehow the self.current_particle does not correspond to an entry in the particle_colors dictionary
-            if particle_color is None:
-                print(f"Error: place_particles() -Invalid particle type: {self.current_particle}")
-                return
-
-            # Update particle grid and draw the new particle
-            self.particle_grid[row][column] = (self.current_particle, particle_color)
-            # mark the particle as updated and draw the initial particle
-            if (row, column) not in self.updated_particles:
-                self.updated_particles.append((row, column))
-            #self.draw_particle((row, column))
-        self.root.after(5, self.place_particle)
-
-    # Canvas Methods
-    def draw_particle(self, location):
+    # Particle methods
+    def paint_stroke(self, start, end):
         '''
-        Draws the particle at the given location
+        Paints the current particle with the brush along the segment of the stroke between two grid locations
+
+        Args:
+            start (int, int): The row and column the segment starts at
+            end (int, int): The row and column the segment ends at
         '''
-        row, column = location
-        particle_type, particle_color = self.particle_grid[row][column]
+        self.engine.profiler.start("input")
+        self.engine.paint(start, end, self.current_particle, self.brush_radius.get(), self.brush_shape, self.spray_density)
+        self.engine.profiler.stop("input")
 
-        canvas_x = column * self.cell_size
-        canvas_y = row * self.cell_size
+    # Canvas Methods
+    def set_renderer(self, renderer_type, force=False):
+        '''
+        Swaps the renderer used to draw the particles and redraws the whole view with it
+        The view zooms in to RECTANGLE_MIN_ZOOM around its center first when the rectangle renderer is picked while zoomed out further
 
-        # delete any rectangles that are at the specified location
-        for rect in self.canvas.find_overlapping(canvas_x+1, canvas_y+1, canvas_x+2, canvas_y+2):
-            self.canvas.delete(rect)
-        
-        # if the grid at that location is air
-        if particle_type == AIR:
-            # do nothing
+        Args:
+            renderer_type (str): RECTANGLE_RENDERER or IMAGE_RENDERER
+            force (bool): Starts a new renderer even if it's the same type, like after the zoom changed
+        '''
+        if renderer_type == self.renderer_type and not force:
             return
-        # else the particle at that location isn't air
-
-        # draw the new rectangle
-        self.canvas.create_rectangle(canvas_x, canvas_y, canvas_x+self.cell_size, canvas_y+self.cell_size, fill=particle_color, outline="")
-        #self.updated_particles.remove(location)
+        self.renderer.clear()
+        if renderer_type == RECTANGLE_RENDERER and self.camera.cell_size < RECTANGLE_MIN_ZOOM:
+            self.camera.zoom(RECTANGLE_MIN_ZOOM, self.canvas_width // 2, self.canvas_height // 2)
+        if renderer_type == IMAGE_RENDERER:
+            self.renderer = ImageRenderer(self.canvas, self.camera.cell_size, self.canvas_width, self.canvas_height)
+        else:
+            self.renderer = RectangleRenderer(self.canvas, self.camera.cell_size)
+        self.renderer_type = renderer_type
+        # the new renderer's items go on top, so the emitter outlines and chunk overlay are drawn again over them
+        self.redraw_view()
+    def draw_chunk_overlay(self):
+        '''
+        Outlines every awake chunk in view when the chunk overlay is turned on
+        '''
+        self.canvas.delete("chunk_overlay")
+        if not self.show_chunks:
+            return
+        chunks = self.engine.chunks
+        size = chunks.chunk_size
+        cell_size = self.camera.cell_size
+        chunk_pixels = size * cell_size
+        row_start, row_end, column_start, column_end = self.camera.bounds()
+        first_row, first_column = row_start // size, column_start // size
+        in_view = chunks.awake[first_row:-(-row_end // size), first_column:-(-column_end // size)]
+        for chunk_row, chunk_column in zip(*np.nonzero(in_view)):
+            canvas_x = (first_column + chunk_column) * chunk_pixels - column_start * cell_size
+            canvas_y = (first_row + chunk_row) * chunk_pixels - row_start * cell_size
+            self.canvas.create_rectangle(canvas_x, canvas_y, canvas_x+chunk_pixels, canvas_y+chunk_pixels, outline="red", tags="chunk_overlay")
+    def draw_emitters(self):
+        '''
+        Outlines every emitter in view in the color of the particle it emits
+        '''
+        self.canvas.delete("emitter")
+        cell_size = self.camera.cell_size
+        row_start, row_end, column_start, column_end = self.camera.bounds()
+        for row, column, material, _ in self.engine.emitters.emitters.tolist():
+            if not (row_start <= row < row_end and column_start <= column < column_end):
+                continue
+            canvas_x = (column - column_start) * cell_size
+            canvas_y = (row - row_start) * cell_size
+            self.canvas.create_rectangle(canvas_x, canvas_y, canvas_x+cell_size-1, canvas_y+cell_size-1,
+                                         outline=MATERIALS[material].color, width=2, tags="emitter")
     def update_canvas(self):
         '''
-        Each step update the particles that have changed between updates
-        '''
-        self.update_particles()
-
-        #self.canvas.delete("all")
-        # only update the particles that have been flagged as changed
-        for row, column in self.updated_particles:
-            self.draw_particle((row, column))
-        self.updated_particles.clear()
-
-        root.after(5, self.update_canvas) # calls itself every X milliseconds(1000ms = 1s)
+        Runs the simulation ticks that are due and draws the particles that have changed since the last drawn frame
+        The simulation runs at the timestep's fixed tick rate, drawing only happens when there's something new to show
+        '''
+        profiler = self.engine.profiler
+        now = time.perf_counter()
+        self.update_files(now)
+        ticks, draw = self.timestep.advance(now)
+        # holding the brush still keeps painting under it, once per tick
+        if ticks and self.mouse_down:
+            self.paint_stroke(self.mouse_position, self.mouse_position)
+        # the simulation is paused while a replay is open
+        if ticks and not self.playback:
+            profiler.start("simulate")
+            self.engine.step(ticks)
+            profiler.stop("simulate")
+        if draw:
+            self.draw_frame()
+        # come back when the next tick is due
+        self.root.after(max(int(self.timestep.delay() * 1000), 1), self.update_canvas)
+    def draw_frame(self):
+        '''
+        Draws the particles that have been flagged as changed, along with the overlays
+        '''
+        profiler = self.engine.profiler
+        # only update the particles in view that have been flagged as changed, the rest are drawn when the camera gets to them
+        profiler.start("render")
+        row_start, row_end, column_start, column_end = self.camera.bounds()
+        rectangles = [(top - row_start, bottom - row_start, left - column_start, right - column_start)
+                      for top, bottom, left, right in self.engine.dirty.rectangles(self.camera.bounds())]
+        self.renderer.draw(self.view(), rectangles)
+        profiler.stop("render")
+        if profiler.enabled:
+            profiler.count("dirty_cells", self.engine.dirty.count())
+            profiler.count("canvas_items", len(self.canvas.find_all()))
+            profiler.end_frame()
+        self.engine.dirty.clear()
+        self.draw_chunk_overlay()
+        self.update_frame_labels()
 
     # Menu methods
     def particle_info_window(self):
@@ -421,8 +747,24 @@ class FallingSand:
         '''
         Resets the particle simulation by erasing the contents of the particle_grid and clearing the canvas
         '''
-        self.particle_grid.fill((AIR,AIR_COLOR))
-        self.canvas.delete("all")
+        # the reset can be undone like any other edit
+        self.engine.begin_edit()
+        self.engine.reset()
+        self.engine.end_edit()
+        self.engine.dirty.clear()
+        self.redraw_view()
+    def undo(self):
+        '''
+        Undoes the last brush stroke or reset, only the chunks it changed are redrawn
+        '''
+        self.mouse_down = False
+        self.engine.undo()
+    def redo(self):
+        '''
+        Redoes the last undone brush stroke or reset
+        '''
+        self.mouse_down = False
+        self.engine.redo()
     def set_particle(self, particle):
         '''
         Sets the current particle for the draw_particle method
@@ -431,6 +773,35 @@ class FallingSand:
             particle (int): A integer value representing a specific type of particle
         '''
         self.current_particle = particle
+    def set_brush_shape(self, shape):
+        '''
+        Sets the shape of the brush
+
+        Args:
+            shape (str): CIRCLE_BRUSH, SQUARE_BRUSH or SPRAY_BRUSH
+        '''
+        self.brush_shape = shape
+    def set_spray_density(self, density):
+        '''
+        Sets the share of the brush's cells the spray brush paints
+
+        Args:
+            density (float): Spray density between 0 and 1
+        '''
+        self.spray_density = density
+    def set_step_mode(self, step_mode):
+        '''
+        Sets the step mode used to update the particles
+
+        Args:
+            step_mode (str): SCALAR_STEP, VECTORIZED_STEP, PARALLEL_STEP or MARGOLUS_STEP
+        '''
+        self.engine.step_mode = step_mode
+    def toggle_chunk_overlay(self):
+        '''
+        Turns the debug overlay of the awake chunks on or off
+        '''
+        self.show_chunks = not self.show_chunks
     def build_menu(self):
         '''
         Builds the tkinter menu bar
@@ -446,16 +817,68 @@ class FallingSand:
         file_menu.add_separator()
         file_menu.add_command(label="Exit", command=self.root.quit)
         menu_bar.add_cascade(label="File", menu=file_menu)
+
+        # Edit menu
+        # Undoes and redoes brush strokes and resets
+        edit_menu = tk.Menu(menu_bar, tearoff=0)
+        edit_menu.add_command(label="Undo (Ctrl + Z)", command=self.undo)
+        edit_menu.add_command(label="Redo (Ctrl + Y)", command=self.redo)
+        menu_bar.add_cascade(label="Edit", menu=edit_menu)
+
+        # Replay menu
+        # Records a replay log of the session, or opens one to scrub through
+        replay_menu = tk.Menu(menu_bar, tearoff=0)
+        replay_menu.add_command(label="Record Replay...", command=self.record_replay_dialog)
+        replay_menu.add_command(label="Stop Recording", command=self.engine.stop_replay)
+        replay_menu.add_separator()
+        replay_menu.add_command(label="Open Replay...", command=self.open_replay_dialog)
+        replay_menu.add_command(label="Close Replay", command=self.close_replay)
+        menu_bar.add_cascade(label="Replay", menu=replay_menu)
         
         # Particle menu
         # Creates a dropdown menu that lets you select which particle you are drawing with
+        # every placeable material in the registry gets an entry, with AIR last as the eraser
         particle_menu = tk.Menu(menu_bar, tearoff=0)
-        particle_menu.add_radiobutton(label="Sand", command=lambda: self.set_particle(SAND))
-        particle_menu.add_radiobutton(label="Water", command=lambda: self.set_particle(WATER))
-        particle_menu.add_radiobutton(label="Stone", command=lambda: self.set_particle(STONE))
-        particle_menu.add_radiobutton(label="Wood", command=lambda: self.set_particle(WOOD))
-        particle_menu.add_radiobutton(label="Erase", command=lambda: self.set_particle(AIR))
+        self.particle_variable = tk.IntVar(value=self.current_particle)
+        for particle_type in PLACEABLE_PARTICLES:
+            if particle_type == AIR:
+                continue
+            particle_menu.add_radiobutton(label=MATERIALS[particle_type].name, variable=self.particle_variable, value=particle_type,
+                                          command=lambda particle_type=particle_type: self.set_particle(particle_type))
+        particle_menu.add_radiobutton(label="Erase", variable=self.particle_variable, value=AIR, command=lambda: self.set_particle(AIR))
         menu_bar.add_cascade(label="Particles", menu=particle_menu)
+
+        # Brush menu
+        # Creates a dropdown menu that lets you pick the brush shape and how dense the spray brush is, the size is on the slider
+        brush_menu = tk.Menu(menu_bar, tearoff=0)
+        self.brush_shape_variable = tk.StringVar(value=self.brush_shape)
+        brush_menu.add_radiobutton(label="Circle", variable=self.brush_shape_variable, value=CIRCLE_BRUSH, command=lambda: self.set_brush_shape(CIRCLE_BRUSH))
+        brush_menu.add_radiobutton(label="Square", variable=self.brush_shape_variable, value=SQUARE_BRUSH, command=lambda: self.set_brush_shape(SQUARE_BRUSH))
+        brush_menu.add_radiobutton(label="Spray", variable=self.brush_shape_variable, value=SPRAY_BRUSH, command=lambda: self.set_brush_shape(SPRAY_BRUSH))
+        brush_menu.add_separator()
+        self.spray_density_variable = tk.DoubleVar(value=self.spray_density)
+        for density in SPRAY_DENSITIES:
+            brush_menu.add_radiobutton(label=f"Spray Density {density:.0%}", variable=self.spray_density_variable, value=density,
+                                       command=lambda density=density: self.set_spray_density(density))
+        menu_bar.add_cascade(label="Brush", menu=brush_menu)
+
+        # Simulation menu
+        # Creates a dropdown menu that lets you compare the step modes and renderers
+        simulation_menu = tk.Menu(menu_bar, tearoff=0)
+        self.step_mode_variable = tk.StringVar(value=self.engine.step_mode)
+        simulation_menu.add_radiobutton(label="Scalar Step", variable=self.step_mode_variable, value=SCALAR_STEP, command=lambda: self.set_step_mode(SCALAR_STEP))
+        simulation_menu.add_radiobutton(label="Vectorized Step", variable=self.step_mode_variable, value=VECTORIZED_STEP, command=lambda: self.set_step_mode(VECTORIZED_STEP))
+        simulation_menu.add_radiobutton(label="Parallel Step", variable=self.step_mode_variable, value=PARALLEL_STEP, command=lambda: self.set_step_mode(PARALLEL_STEP))
+        simulation_menu.add_radiobutton(label="Margolus Step", variable=self.step_mode_variable, value=MARGOLUS_STEP, command=lambda: self.set_step_mode(MARGOLUS_STEP))
+        simulation_menu.add_separator()
+        self.renderer_variable = tk.StringVar(value=self.renderer_type)
+        simulation_menu.add_radiobutton(label="Rectangle Renderer", variable=self.renderer_variable, value=RECTANGLE_RENDERER, command=lambda: self.set_renderer(RECTANGLE_RENDERER))
+        simulation_menu.add_radiobutton(label="Image Renderer", variable=self.renderer_variable, value=IMAGE_RENDERER, command=lambda: self.set_renderer(IMAGE_RENDERER))
+        simulation_menu.add_separator()
+        simulation_menu.add_checkbutton(label="Show Awake Chunks", command=self.toggle_chunk_overlay)
+        simulation_menu.add_checkbutton(label="Profiling", command=self.toggle_profiling)
+        simulation_menu.add_command(label="Dump Profile CSV...", command=self.dump_profile_dialog)
+        menu_bar.add_cascade(label="Simulation", menu=simulation_menu)
         
         info_menu = tk.Menu(menu_bar, tearoff=0)
         info_menu.add_command(label="Particle Info", command=self.particle_info_window)
@@ -468,11 +891,23 @@ class FallingSand:
         # Create the menu bar at the top of the window
         self.build_menu()
         self.root.mainloop()
+        # let a save that's still being written finish, and the replay log write out its last ticks
+        self.files.close()
+        self.engine.stop_replay()
+        # stop the parallel step's worker processes, if it was used
+        self.engine.close()
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="PyFallingSand, a falling sand particle simulation")
+    parser.add_argument("--size", help="world size as COLUMNSxROWS, bigger than the window to scroll around it (default: the window's size)")
+    parser.add_argument("--world", help="path of a memory-mapped world file, created with --size if it doesn't exist yet")
+    arguments = parser.parse_args()
+    world_columns, world_rows = (int(size) for size in arguments.size.lower().split("x")) if arguments.size else (None, None)
+
     window_width, window_height = 800,600
     cell_size = 10
     application_title = "Python Sand Simulator"
     root = tk.Tk()
-    app = FallingSand(root, application_title, window_width, window_height, cell_size)
+    app = FallingSand(root, application_title, window_width, window_height, cell_size, world_rows=world_rows, world_columns=world_columns,
+                      world_path=arguments.world)
     app.run()
\ No newline at end of file
@@ -0,0 +1,284 @@
+import argparse                 # command line interface
+import json                     # results are written as JSON so runs can be compared
+import os                       # the number of CPUs the parallel step can scale to
+import platform                 # records the machine the benchmark ran on
+import time                     # timing the steps and draws
+import tracemalloc              # peak memory of the steps and draws
+import numpy as np              # easy array interface
+from sand_engine import (AIR, STONE, SAND, WATER, WOOD, FIRE, VECTORIZED_STEP, PARALLEL_STEP, STEP_MODES,
+                         SandEngine, render_ppm) # the headless simulation
+
+# grid sizes to benchmark, as (columns, rows) to match the window's width x height
+RESOLUTIONS = [(80, 60), (160, 120), (400, 300), (800, 600), (1600, 1200)]
+CELL_SIZE   = 10    # cell size the draw path is rendered at, the same as the app's default
+SCENE_SEED  = 0     # every scenario is built from the same seed so runs can be compared
+
+# Scenarios
+# Each scenario fills an empty engine's grid with its starting scene, and can return a list of (row, column, material, rate) emitters to add
+def build_empty(types, rng):
+    '''
+    An empty grid, the cost of stepping and drawing nothing
+    '''
+def build_sand_avalanche(types, rng):
+    '''
+    The top half of the grid packed with sand that falls onto a stone ramp
+    '''
+    rows, columns = types.shape
+    types[:rows//2, :] = SAND
+    # a ramp from the bottom left corner up to the middle of the right side
+    ramp_rows = rows - 1 - (np.arange(columns) * (rows//2) // columns)
+    for column, row in enumerate(ramp_rows):
+        types[row:, column] = STONE
+def build_water_dam_break(types, rng):
+    '''
+    A tall block of water on the left side of the grid whose dam has just been removed
+    '''
+    rows, columns = types.shape
+    types[rows//4:, :columns*2//5] = WATER
+def build_stone_wood_maze(types, rng):
+    '''
+    Shelves of stone and wood with gaps in them, with sand and water falling through from the top
+    '''
+    rows, columns = types.shape
+    shelf_spacing = max(rows // 8, 3)
+    for shelf, row in enumerate(range(shelf_spacing, rows, shelf_spacing)):
+        types[row, :] = STONE if shelf % 2 == 0 else WOOD
+        # punch a few gaps into every shelf
+        gap_width = max(columns // 20, 2)
+        for gap in rng.integers(0, columns - gap_width, 3):
+            types[row, gap:gap+gap_width] = AIR
+    types[:shelf_spacing-1, :] = rng.choice([AIR, SAND, WATER], size=(shelf_spacing-1, columns))
+def build_packed(types, rng):
+    '''
+    A grid with no AIR at all, only sand sinking through water can move
+    '''
+    types[...] = rng.choice([STONE, SAND, WATER, WOOD], size=types.shape)
+def build_forest_fire(types, rng):
+    '''
+    The bottom three quarters of the grid filled with wood, set on fire along its bottom edge
+    '''
+    rows, columns = types.shape
+    types[rows//4:, :] = WOOD
+    types[-1, :] = FIRE
+def build_emitter_rain(types, rng):
+    '''
+    Hundreds of sand and water emitters along the top of the grid raining onto a floor of stone
+    '''
+    rows, columns = types.shape
+    types[-1, :] = STONE
+    return [(0, column, rng.choice([SAND, WATER]), rng.uniform(0.1, 1.0)) for column in range(0, columns, 2)]
+
+SCENARIOS = {
+    "empty": build_empty,
+    "sand_avalanche": build_sand_avalanche,
+    "water_dam_break": build_water_dam_break,
+    "stone_wood_maze": build_stone_wood_maze,
+    "packed": build_packed,
+    "forest_fire": build_forest_fire,
+    "emitter_rain": build_emitter_rain,
+}
+
+def build_engine(scenario, columns, rows, step_mode, workers=None):
+    '''
+    Builds an engine with the scenario's starting scene
+
+    Args:
+        scenario (str): A key of SCENARIOS
+        columns (int): The number of columns in the grid
+        rows (int): The number of rows in the grid
+        step_mode (str): One of STEP_MODES
+        workers (int): Worker processes of the parallel step mode
+
+    Returns:
+        engine (SandEngine): The engine, ready to step
+    '''
+    engine = SandEngine(rows, columns, step_mode=step_mode, seed=SCENE_SEED, workers=workers)
+    rng = np.random.default_rng(SCENE_SEED)
+    emitters = SCENARIOS[scenario](engine.particle_grid.types, rng)
+    for row, column, material, rate in emitters or []:
+        engine.add_emitter((row, column), material, rate)
+    grid = engine.particle_grid
+    grid.colors[...] = rng.integers(0, 256, grid.colors.shape, dtype=np.uint8)
+    engine.refresh()
+    # the starting scene isn't part of the per-step draw cost
+    engine.dirty.clear()
+    return engine
+
+def draw_updated(engine):
+    '''
+    Runs the image renderer's draw path for the cells the last step changed, without tkinter
+
+    Returns:
+        drawn (int): The number of cells drawn
+    '''
+    drawn = 0
+    for row_start, row_end, column_start, column_end in engine.dirty.rectangles():
+        render_ppm(engine.particle_grid[row_start:row_end, column_start:column_end], CELL_SIZE)
+        drawn += (row_end - row_start) * (column_end - column_start)
+    engine.dirty.clear()
+    return drawn
+
+def run_case(scenario, columns, rows, step_mode, steps, memory_steps, workers=None):
+    '''
+    Benchmarks the step and the draw path of one scenario at one resolution
+
+    Args:
+        scenario (str): A key of SCENARIOS
+        columns (int): The number of columns in the grid
+        rows (int): The number of rows in the grid
+        step_mode (str): One of STEP_MODES
+        steps (int): Number of timed steps
+        memory_steps (int): Number of steps run again under tracemalloc to measure peak memory
+        workers (int): Worker processes of the parallel step mode
+
+    Returns:
+        result (dict): The measurements of this case
+    '''
+    engine = build_engine(scenario, columns, rows, step_mode, workers)
+    if step_mode == PARALLEL_STEP:
+        # starting the worker processes isn't part of the per-step cost
+        engine.step()
+        engine.dirty.clear()
+    step_time = draw_time = 0.0
+    active_cells = drawn_cells = 0
+    chunk_cells = engine.chunks.chunk_size ** 2
+    for _ in range(steps):
+        start_time = time.perf_counter()
+        engine.step()
+        step_time += time.perf_counter() - start_time
+        # cells inside the awake chunks are the cells the step actually had to look at
+        active_cells += min(int(np.count_nonzero(engine.chunks.awake)) * chunk_cells, rows * columns)
+
+        start_time = time.perf_counter()
+        drawn_cells += draw_updated(engine)
+        draw_time += time.perf_counter() - start_time
+
+    # tracemalloc slows everything down, so memory is measured separately from the timing
+    tracemalloc.start()
+    for _ in range(memory_steps):
+        engine.step()
+    step_memory = tracemalloc.get_traced_memory()[1]
+    tracemalloc.reset_peak()
+    draw_updated(engine)
+    draw_memory = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    engine.close()
+
+    return {
+        "scenario": scenario,
+        "columns": columns,
+        "rows": rows,
+        "step_mode": step_mode,
+        "workers": workers,
+        "steps": steps,
+        "particles": engine.particle_counts(),
+        "step": {
+            "steps_per_second": steps / step_time if step_time > 0 else None,
+            "ns_per_active_cell": step_time * 1e9 / active_cells if active_cells else None,
+            "active_cells_per_step": active_cells / steps,
+            "peak_memory_bytes": step_memory,
+        },
+        "draw": {
+            "frames_per_second": steps / draw_time if draw_time > 0 else None,
+            "ns_per_drawn_cell": draw_time * 1e9 / drawn_cells if drawn_cells else None,
+            "drawn_cells_per_frame": drawn_cells / steps,
+            "peak_memory_bytes": draw_memory,
+        },
+    }
+
+def mode_label(result):
+    '''
+    Returns the step mode of a result, with the worker count for the parallel step mode
+    '''
+    if result.get("workers") is None:
+        return result["step_mode"]
+    return f"{result['step_mode']}x{result['workers']}"
+def print_scaling(results):
+    '''
+    Prints the scaling curve of the parallel step mode, the speedup of every worker count over a single worker
+    '''
+    curves = {}
+    for result in results:
+        if result["step_mode"] == PARALLEL_STEP and result["step"]["steps_per_second"]:
+            curves.setdefault((result["scenario"], result["columns"], result["rows"]), {})[result["workers"]] = result["step"]["steps_per_second"]
+    if not curves:
+        return
+    print("Parallel step scaling (speedup over 1 worker):")
+    for (scenario, columns, rows), curve in curves.items():
+        baseline = curve.get(1) or curve[min(curve)]
+        points = "  ".join(f"{workers}: x{rate / baseline:.2f}" for workers, rate in sorted(curve.items()))
+        print(f"{scenario:>16} {columns}x{rows:<5} {points}")
+def compare(results, baseline_path):
+    '''
+    Prints the speedup of every case against a previous results file
+
+    Args:
+        results (list): The results of this run
+        baseline_path (str): Path to the JSON file of an earlier run
+    '''
+    with open(baseline_path) as file:
+        baseline = json.load(file)
+    key = lambda result: (result["scenario"], result["columns"], result["rows"], result["step_mode"], result.get("workers"))
+    previous = {key(result): result for result in baseline["results"]}
+    for result in results:
+        old = previous.get(key(result))
+        if old is None:
+            continue
+        line = f"{result['scenario']:>16} {result['columns']}x{result['rows']:<5} {mode_label(result):>12}"
+        for path, rate in (("step", "steps_per_second"), ("draw", "frames_per_second")):
+            if result[path][rate] and old[path][rate]:
+                line += f"  {path} x{result[path][rate] / old[path][rate]:.2f}"
+        print(line)
+
+def main(arguments=None):
+    '''
+    Command line entry point for the benchmark
+
+    Args:
+        arguments (list): The command line arguments, defaults to sys.argv
+    '''
+    parser = argparse.ArgumentParser(description="Benchmarks the PyFallingSand step and draw throughput")
+    parser.add_argument("-s", "--scenarios", nargs="+", choices=list(SCENARIOS), default=list(SCENARIOS), help="scenarios to run (default: all)")
+    parser.add_argument("-r", "--resolutions", nargs="+", default=[f"{columns}x{rows}" for columns, rows in RESOLUTIONS],
+                        help="grid sizes as COLUMNSxROWS (default: 80x60 up to 1600x1200)")
+    parser.add_argument("-m", "--modes", nargs="+", choices=STEP_MODES, default=[VECTORIZED_STEP], help="step modes to run (default: vectorized)")
+    parser.add_argument("-w", "--workers", nargs="+", type=int, default=list(range(1, (os.cpu_count() or 1) + 1)),
+                        help="worker counts to run the parallel step mode with (default: 1 up to the number of CPUs)")
+    parser.add_argument("-n", "--steps", type=int, default=100, help="timed steps per case (default: 100)")
+    parser.add_argument("--memory-steps", type=int, default=5, help="steps run under tracemalloc per case (default: 5)")
+    parser.add_argument("-o", "--output", default="benchmark_results.json", help="path of the JSON results file (default: benchmark_results.json)")
+    parser.add_argument("-c", "--compare", help="path of an earlier results file to print the speedup against")
+    arguments = parser.parse_args(arguments)
+
+    results = []
+    for resolution in arguments.resolutions:
+        columns, rows = (int(size) for size in resolution.lower().split("x"))
+        for scenario in arguments.scenarios:
+            for step_mode in arguments.modes:
+                for workers in (arguments.workers if step_mode == PARALLEL_STEP else [None]):
+                    result = run_case(scenario, columns, rows, step_mode, arguments.steps, arguments.memory_steps, workers)
+                    results.append(result)
+                    step, draw = result["step"], result["draw"]
+                    print(f"{scenario:>16} {columns}x{rows:<5} {mode_label(result):>12}: "
+                          f"{step['steps_per_second'] or 0:9.1f} steps/s {step['ns_per_active_cell'] or 0:8.1f} ns/active cell "
+                          f"{step['peak_memory_bytes'] / 2**20:7.2f} MiB | "
+                          f"{draw['frames_per_second'] or 0:9.1f} draws/s {draw['peak_memory_bytes'] / 2**20:7.2f} MiB")
+
+    with open(arguments.output, "w") as file:
+        json.dump({
+            "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "machine": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "cell_size": CELL_SIZE,
+            "results": results,
+        }, file, indent=2)
+    print(f"Saved the results to {arguments.output}")
+    print_scaling(results)
+
+    if arguments.compare:
+        compare(results, arguments.compare)
+
+if __name__ == '__main__':
+    main()
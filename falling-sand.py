@@ -1,9 +1,13 @@
+import os
 import pickle
 import tkinter as tk
 from tkinter import filedialog
 import numpy as np
 from random import choice
 import time
+from collections import deque
+
+DEBUG_LOG_SIZE = 10000 # only the most recent debug log entries are kept
 
 AIR = 0     # Empty tile
 STONE = 1   # stationary and indestructible
@@ -65,7 +69,7 @@ class FallingSand:
         self.debug = debug
         self.debug_index = 0
         self.debug_time = time.time()
-        self.debug_log = []
+        self.debug_log = deque(maxlen=DEBUG_LOG_SIZE)
 
         # Build the options menu
         self.current_particle = SAND
@@ -105,12 +109,17 @@ class FallingSand:
 
     def on_closing(self):
         print("Closing Falling Sand")
-        with open("./bin/debug_log.txt", "wb") as file:
-            pickle.dump(str(self.debug_log), file)
+        if self.debug:
+            os.makedirs("./bin", exist_ok=True)
+            with open("./bin/debug_log.txt", "wb") as file:
+                pickle.dump(str(list(self.debug_log)), file)
         self.root.quit()
 
 
     def debug_logger(self, method_call, method_name):
+        # logging is skipped entirely unless debug is on, it's called twice for almost every method
+        if not self.debug:
+            return
         self.debug_log.append((method_call, method_name,(time.time() - self.debug_time)))
         self.debug_last_time = time.time()
 
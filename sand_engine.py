@@ -0,0 +1,3834 @@
+import argparse                 # command line interface for headless runs
+import json                     # input events in replay logs
+import mmap                     # pages a memory-mapped world's idle rows out
+import os                       # the default number of worker processes
+import pickle                   # allows loading scenes saved before the v2 format
+import struct                   # packs the .sand file header
+import zlib                     # compresses the .sand file planes
+import numpy as np              # easy array interface
+import time                     # used for timing the steps
+from concurrent.futures import ProcessPoolExecutor  # worker processes for the parallel step
+from concurrent.futures import ThreadPoolExecutor   # worker thread for background saves and loads
+from multiprocessing import shared_memory           # the grid shared between the worker processes
+try:
+    from PIL import Image                           # optional, only needed to record animated GIFs
+except ImportError:
+    Image = None
+
+# Particle types
+# Every particle type is a Material in the MATERIALS registry and its index in the list is the type stored in the grid,
+# new materials go on the end of the list so the types in saved scenes keep their meaning
+AIR   = 0   # Empty tile
+STONE = 1   # stationary and indestructible
+SAND  = 2   # falls down and piles up, heavier than water
+WATER = 3   # falls down and spreads out
+WOOD  = 4   # stationary but flammable
+FIRE  = 5   # spreads onto flammable particles
+BURNT_WOOD = 6 # wood that is being consumed by fire
+SMOKE = 7   # rises from burning wood and fades away
+
+# mobility classes, how a material moves
+EMPTY  = 0  # nothing there, other particles move into it freely
+STATIC = 1  # never moves, and nothing can move into it
+POWDER = 2  # falls, and slides diagonally down to pile up in slopes
+LIQUID = 3  # falls, and spreads out sideways to fill the available space
+GAS    = 4  # rises, and spreads out sideways under whatever stops it
+
+class Material:
+    '''
+    Everything the engine needs to know about one particle type
+    The registry of materials is compiled into NumPy lookup tables indexed by particle type, so the step never branches on a type
+    '''
+    def __init__(self, name, color, density, mobility, flammability=0.0, burns_into=None, lifetime=None, doused_into=None,
+                 flame_chance=0.0, smoke_chance=0.0, douses=False, fade=0.0, dispersion=1, jitter=False, placeable=True, description=""):
+        '''
+        Args:
+            name (str): The name shown in the menus and the info window
+            color (str): The base hex color string "#RRGGBB"
+            density (float): A moving particle sinks through the non-static particles that are less dense than it, and a gas rises through the denser ones
+            mobility (int): EMPTY, STATIC, POWDER, LIQUID or GAS
+            flammability (float): Chance per tick of catching fire next to a burning particle, 0 never burns
+            burns_into (int): The particle type it turns into when it catches fire
+            lifetime (int, int): The range of ticks it burns for before burning out into AIR, None if it doesn't burn
+            doused_into (int): The particle type it turns into when water puts it out, None to stay as it is
+            flame_chance (float): Chance per tick, while burning, of lighting FIRE in each neighboring AIR cell
+            smoke_chance (float): Chance per tick, while burning, of giving off SMOKE into each neighboring AIR cell
+            douses (bool): Whether it puts out the burning particles next to it
+            fade (float): Chance per tick of fading away into AIR
+            dispersion (int): How many cells sideways a liquid or gas can flow in a tick towards somewhere lower(higher for a gas),
+                              and how far a liquid is pushed aside by a powder sinking into it
+            jitter (bool): Whether every placed particle gets a slightly different shade of the color
+            placeable (bool): Whether the particle can be drawn with the mouse
+            description (str): The description shown in the info window
+        '''
+        self.name         = name
+        self.color        = color
+        self.density      = density
+        self.mobility     = mobility
+        self.flammability = flammability
+        self.burns_into   = burns_into
+        self.lifetime     = lifetime
+        self.doused_into  = doused_into
+        self.flame_chance = flame_chance
+        self.smoke_chance = smoke_chance
+        self.douses       = douses
+        self.fade         = fade
+        self.dispersion   = dispersion
+        self.jitter       = jitter
+        self.placeable    = placeable
+        self.description  = description
+
+# element colors
+# https://www.plus2net.com/python/tkinter-colors.php
+# densities are roughly in kg/m^3
+MATERIALS = [
+    # antiquewhite note: we should never actually be drawing AIR rectangles, this is just for the canvas background really
+    Material("Air",   "#FAEBD7", density=1,    mobility=EMPTY,  description="Empty space"),
+    Material("Stone", "#808A87", density=2600, mobility=STATIC, description="Stationary particle"),                                    # coldgrey
+    Material("Sand",  "#F4A460", density=1600, mobility=POWDER, jitter=True, description="Affected by gravity\nPiles up\nHeavier than water"), # saddlebrown
+    Material("Water", "#7FFFD4", density=1000, mobility=LIQUID, douses=True, dispersion=8, jitter=True, description="Affected by gravity\nFills available space\nPuts out fires"), # aquamarine1
+    Material("Wood",  "#8B4513", density=700,  mobility=STATIC, flammability=0.05, burns_into=BURNT_WOOD, jitter=True,                       # chocolate
+             description="Stationary particle\nFlammable"),
+    Material("Fire",  "#FF6103", density=0,    mobility=STATIC, lifetime=(10, 40), doused_into=SMOKE, jitter=True,                             # cadmiumorange
+             description="Ignores gravity\nSpreads to flammable particles\nBurns out quickly\nDoused by water"),
+    Material("Burnt Wood", "#4A2511", density=700, mobility=STATIC, lifetime=(150, 400), flame_chance=0.01, smoke_chance=0.02, jitter=True,  # a darker chocolate
+             placeable=False, description="Wood that is on fire\nSpreads fire and gives off smoke\nCrumbles away once it burns out\nDoused by water"),
+    Material("Smoke", "#A9A9A9", density=0.6,  mobility=GAS, fade=0.01, dispersion=4, jitter=True,                                             # darkgray
+             description="Rises and spreads out\nFades away over time"),
+]
+AIR_COLOR = MATERIALS[AIR].color
+PARTICLE_COLORS  = {particle_type: material.color for particle_type, material in enumerate(MATERIALS)}
+PARTICLE_NAMES   = {particle_type: material.name for particle_type, material in enumerate(MATERIALS)}
+VARIED_PARTICLES = {particle_type for particle_type, material in enumerate(MATERIALS) if material.jitter} # particles that get a slightly different shade of their color when placed
+PLACEABLE_PARTICLES = [particle_type for particle_type, material in enumerate(MATERIALS) if material.placeable]
+
+# lookup tables compiled from the registry, indexed by particle type
+DENSITY_TABLE      = np.array([material.density for material in MATERIALS], dtype=np.float32)
+MOBILITY_TABLE     = np.array([material.mobility for material in MATERIALS], dtype=np.uint8)
+FLAMMABILITY_TABLE = np.array([material.flammability for material in MATERIALS], dtype=np.float32)
+VARIED_TABLE       = np.array([material.jitter for material in MATERIALS], dtype=bool)
+MOVABLE_TABLE      = np.isin(MOBILITY_TABLE, (POWDER, LIQUID, GAS))  # the particles the step has to look at
+# PASSABLE_TABLE[mover, target] is whether a falling particle can swap with the target below it, which has to be lighter and not static
+PASSABLE_TABLE     = (MOBILITY_TABLE[None, :] != STATIC) & (DENSITY_TABLE[None, :] < DENSITY_TABLE[:, None]) & np.isin(MOBILITY_TABLE, (POWDER, LIQUID))[:, None]
+# BUOYANT_TABLE[mover, target] is whether a rising gas can swap with the target above it, which has to be denser and not static
+BUOYANT_TABLE      = (MOBILITY_TABLE[None, :] != STATIC) & (DENSITY_TABLE[None, :] > DENSITY_TABLE[:, None]) & (MOBILITY_TABLE == GAS)[:, None]
+# reaction tables, see SandEngine.update_reactions
+BURNS_INTO_TABLE   = np.array([AIR if material.burns_into is None else material.burns_into for material in MATERIALS], dtype=np.uint8)
+BURNING_TABLE      = np.array([material.lifetime is not None for material in MATERIALS], dtype=bool)
+LIFETIME_TABLE     = np.array([material.lifetime or (0, 0) for material in MATERIALS], dtype=np.int32)
+DOUSED_INTO_TABLE  = np.array([particle_type if material.doused_into is None else material.doused_into for particle_type, material in enumerate(MATERIALS)], dtype=np.uint8)
+FLAME_TABLE        = np.array([material.flame_chance for material in MATERIALS], dtype=np.float32)
+SMOKE_TABLE        = np.array([material.smoke_chance for material in MATERIALS], dtype=np.float32)
+DOUSES_TABLE       = np.array([material.douses for material in MATERIALS], dtype=bool)
+FADE_TABLE         = np.array([material.fade for material in MATERIALS], dtype=np.float32)
+DISPERSION_TABLE   = np.array([material.dispersion for material in MATERIALS], dtype=np.int32)
+# the same tables as python lists, indexing a list is much faster than indexing an array one cell at a time in the scalar step
+MOBILITY_LIST = MOBILITY_TABLE.tolist()
+PASSABLE_LIST = PASSABLE_TABLE.tolist()
+BUOYANT_LIST  = BUOYANT_TABLE.tolist()
+DISPERSION_LIST = DISPERSION_TABLE.tolist()
+# the order the step moves the materials in, lighter ones fall first so heavier ones above them can follow them down in the same tick
+FALL_ORDER = sorted(np.flatnonzero(np.isin(MOBILITY_TABLE, (POWDER, LIQUID))).tolist(), key=lambda particle_type: DENSITY_TABLE[particle_type])
+POWDERS    = [particle_type for particle_type in FALL_ORDER if MOBILITY_TABLE[particle_type] == POWDER]
+LIQUIDS    = [particle_type for particle_type in FALL_ORDER if MOBILITY_TABLE[particle_type] == LIQUID]
+# gases rise in the opposite order, the lightest ones first
+GASES      = sorted(np.flatnonzero(MOBILITY_TABLE == GAS).tolist(), key=lambda particle_type: -DENSITY_TABLE[particle_type])
+
+# Color palette
+# Every cell stores a one byte index into its particle type's row of the palette instead of a hex string
+PALETTE_SIZE = 256
+PALETTE_SEED = 0    # the palette must be the same every run so saved scenes keep their colors
+
+def hex_to_rgb(color):
+    '''
+    Converts a hex color string into its red, green and blue values
+
+    Args:
+        color (str): A 7 character hex color string "#RRGGBB"
+
+    Returns:
+        rgb (int, int, int): The red, green and blue values of the color
+    '''
+    return int(color[1:3], 16), int(color[3:5], 16), int(color[5:7], 16)
+def rgb_to_hex(rgb):
+    '''
+    Converts red, green and blue values into a hex color string
+
+    Args:
+        rgb (int, int, int): The red, green and blue values of the color
+
+    Returns:
+        color (str): A 7 character hex color string "#RRGGBB"
+    '''
+    red, green, blue = rgb
+    return f"#{red:02X}{green:02X}{blue:02X}"
+def build_palette():
+    '''
+    Builds the color palette for every particle type
+
+    Returns:
+        palette (np.ndarray): uint8 array of shape (particle types, PALETTE_SIZE, 3) holding the RGB value of every shade
+    '''
+    rng = np.random.default_rng(PALETTE_SEED)
+    palette = np.zeros((len(MATERIALS), PALETTE_SIZE, 3), dtype=np.uint8)
+    for particle_type, material in enumerate(MATERIALS):
+        base = np.array(hex_to_rgb(material.color), dtype=np.uint8)
+        palette[particle_type] = base
+        if material.jitter:
+            # keep the first hex digit of each channel and randomize the second one
+            palette[particle_type] = (base & 0xF0) | rng.integers(0, 16, (PALETTE_SIZE, 3), dtype=np.uint8)
+    return palette
+PALETTE = build_palette()
+PALETTE_HEX = [[rgb_to_hex(rgb) for rgb in shades] for shades in PALETTE] # hex strings for the tkinter canvas
+
+class ParticleGrid:
+    '''
+    The particle grid stored as two uint8 arrays instead of a structured record array
+    types holds the particle type of each cell and colors holds the index of its shade in the PALETTE, so every swap is a plain integer move
+    '''
+    def __init__(self, rows, columns, types=None, colors=None):
+        self.rows    = rows
+        self.columns = columns
+        self.types  = np.zeros((rows, columns), dtype=np.uint8) if types is None else types
+        self.colors = np.zeros((rows, columns), dtype=np.uint8) if colors is None else colors
+
+    @classmethod
+    def from_records(cls, records):
+        '''
+        Builds a grid from the old structured array of ('particle_type', int), ('particle_color', 'U7')
+        Each old hex color is matched with the closest shade in its particle type's palette row
+
+        Args:
+            records (np.ndarray): The structured particle_grid array from an old .sand file
+
+        Returns:
+            grid (ParticleGrid): A new grid with the same particles
+        '''
+        rows, columns = records.shape
+        grid = cls(rows, columns)
+        pairs, inverse = np.unique(records.ravel(), return_inverse=True)
+        shades = np.zeros(len(pairs), dtype=np.uint8)
+        for index, (particle_type, color) in enumerate(pairs.tolist()):
+            if particle_type not in PARTICLE_COLORS:
+                continue
+            distance = np.abs(PALETTE[particle_type].astype(int) - hex_to_rgb(color)).sum(axis=1)
+            shades[index] = np.argmin(distance)
+        grid.types[...] = records['particle_type']
+        grid.colors[...] = shades[inverse].reshape(rows, columns)
+        return grid
+
+    def __getitem__(self, key):
+        '''
+        Slicing a grid returns a grid that shares memory with this one
+
+        Args:
+            key (slice, slice): The row and column slices
+
+        Returns:
+            grid (ParticleGrid): A view of the sliced region
+        '''
+        types, colors = self.types[key], self.colors[key]
+        return ParticleGrid(types.shape[0], types.shape[1], types, colors)
+    def copy(self):
+        '''
+        Returns a copy of the grid that doesn't share memory with this one
+        '''
+        return ParticleGrid(self.rows, self.columns, self.types.copy(), self.colors.copy())
+    def fill(self, particle_type, color=0):
+        '''
+        Fills every cell of the grid with the same particle
+
+        Args:
+            particle_type (int): The particle type to fill the grid with
+            color (int): The palette index of the particle's shade
+        '''
+        self.types.fill(particle_type)
+        self.colors.fill(color)
+    def set(self, location, particle_type, color=0):
+        '''
+        Sets the particle at the given grid location
+
+        Args:
+            location (int, int): Tuple of integers representing the row and column of the particle
+            particle_type (int): The particle type
+            color (int): The palette index of the particle's shade
+        '''
+        self.types[location] = particle_type
+        self.colors[location] = color
+    def swap(self, particle_1, particle_2):
+        '''
+        Swaps the particles at the two grid locations
+
+        Args:
+            particle_1 (int, int): Tuple of integers representing the row and column of a particle to be swapped
+            particle_2 (int, int): Tuple of integers representing the row and column of a particle to be swapped
+        '''
+        types, colors = self.types, self.colors
+        types[particle_1], types[particle_2] = types[particle_2], types[particle_1]
+        colors[particle_1], colors[particle_2] = colors[particle_2], colors[particle_1]
+    def hex_color(self, location):
+        '''
+        Returns the hex color string of the particle at the given grid location
+
+        Args:
+            location (int, int): Tuple of integers representing the row and column of the particle
+        '''
+        return PALETTE_HEX[self.types[location]][self.colors[location]]
+
+# chunk settings
+CHUNK_SIZE = 16 # width and height of the chunks that fall asleep once they've settled
+OFFSCREEN_STEP_INTERVAL = 4 # awake chunks outside the focus(the part of the world on screen) are only updated every this many ticks
+FOCUS_MARGIN = 2            # chunks around the focus that are still updated every tick
+SECTOR_SIZE  = 512          # width and height of the sectors a big awake box is cut into for the vectorized step
+SECTOR_SPLIT_SHARE = 0.5    # the box is only cut into sectors when their boxes cover at most this share of it
+ACTIVE_BAND_ROWS = 64       # rows the ActiveIndex is rebuilt at a time
+PAGE_OUT_INTERVAL = 600     # ticks between writing a memory-mapped world back to its file and dropping its idle rows from memory
+
+# step modes
+SCALAR_STEP     = "scalar"      # walks the grid one cell at a time in python
+VECTORIZED_STEP = "vectorized"  # moves every particle at once with NumPy masks
+PARALLEL_STEP   = "parallel"    # the vectorized step split into bands of columns stepped by a pool of worker processes
+MARGOLUS_STEP   = "margolus"    # 2x2 blocks stepped at once through a lookup table, an alternative set of rules
+STEP_MODES      = (SCALAR_STEP, VECTORIZED_STEP, PARALLEL_STEP, MARGOLUS_STEP)
+
+# random number settings
+RANDOM_BLOCK_SIZE = 4096 # random values drawn at once, the scalar step draws at least one per movable particle every tick
+
+class RandomBlocks:
+    '''
+    The simulation's random numbers, all drawn from one seeded NumPy generator
+    The scalar step takes its directions and shades from blocks drawn ahead of time instead of calling random once per particle,
+    and the vectorized step draws straight from the generator, so the same scene and seed always give the same result
+    '''
+    def __init__(self, seed=None, block_size=RANDOM_BLOCK_SIZE):
+        self.seed       = seed
+        self.block_size = block_size
+        self.generator  = np.random.default_rng(seed)
+        # pre-drawn values as python ints, popped from the end
+        # a roll is in [0, 6) so it maps evenly onto both three and two directions
+        self.rolls  = []
+        self.shades = []
+
+    def reserve(self, count):
+        '''
+        Draws enough rolls ahead of time for the given number of particles
+
+        Args:
+            count (int): How many rolls are about to be used
+        '''
+        if len(self.rolls) < count:
+            self.rolls.extend(self.generator.integers(0, 6, max(count, self.block_size)).tolist())
+    def direction(self):
+        '''
+        Returns:
+            direction (int): -1, 0 or 1 with equal chance
+        '''
+        if not self.rolls:
+            self.reserve(1)
+        return self.rolls.pop() % 3 - 1
+    def side(self):
+        '''
+        Returns:
+            side (int): -1 or 1 with equal chance
+        '''
+        if not self.rolls:
+            self.reserve(1)
+        return self.rolls.pop() % 2 * 2 - 1
+    def shade(self):
+        '''
+        Returns:
+            shade (int): A random palette index
+        '''
+        if not self.shades:
+            self.shades = self.generator.integers(0, PALETTE_SIZE, self.block_size).tolist()
+        return self.shades.pop()
+
+class ChunkScheduler:
+    '''
+    Splits the grid into CHUNK_SIZE x CHUNK_SIZE chunks that each have an awake/asleep flag
+    Only awake chunks are updated, and a chunk falls asleep after a tick where nothing in or next to it changed
+    '''
+    def __init__(self, rows, columns, chunk_size=CHUNK_SIZE):
+        self.rows       = rows
+        self.columns    = columns
+        self.chunk_size = chunk_size
+        self.chunk_rows    = -(-rows // chunk_size)     # rounded up so the last partial chunk is counted
+        self.chunk_columns = -(-columns // chunk_size)
+        # awake holds the chunks being updated this tick, next_awake collects the chunks woken up for the next tick
+        self.awake      = np.zeros((self.chunk_rows, self.chunk_columns), dtype=bool)
+        self.next_awake = np.ones((self.chunk_rows, self.chunk_columns), dtype=bool)
+        # the chunks updated every tick, None for all of them, the rest are only updated every offscreen_interval ticks
+        self.focus = None
+        self.offscreen_interval = OFFSCREEN_STEP_INTERVAL
+
+    def begin_tick(self, tick=0):
+        '''
+        Starts a new tick, every chunk that wasn't woken up since the last tick falls asleep
+        Awake chunks outside the focus sit out every tick but one in offscreen_interval, they stay awake for the tick they're updated on
+
+        Args:
+            tick (int): The number of the tick, picks the ticks the chunks outside the focus are updated on
+
+        Returns:
+            awake (np.ndarray): 2D boolean array of the chunks to update this tick
+        '''
+        self.awake, self.next_awake = self.next_awake, self.awake
+        self.next_awake.fill(False)
+        if self.focus is not None and tick % self.offscreen_interval:
+            self.next_awake |= self.awake & ~self.focus
+            self.awake &= self.focus
+        return self.awake
+    def set_focus(self, bounds):
+        '''
+        Sets the part of the grid that's updated every tick, usually the part that's on screen
+
+        Args:
+            bounds (int, int, int, int): (row_start, row_end, column_start, column_end) in grid cells, ends exclusive, or None to update everything every tick
+        '''
+        if bounds is None:
+            self.focus = None
+            return
+        row_start, row_end, column_start, column_end = bounds
+        size = self.chunk_size
+        self.focus = np.zeros((self.chunk_rows, self.chunk_columns), dtype=bool)
+        self.focus[max(row_start // size - FOCUS_MARGIN, 0):-(-row_end // size) + FOCUS_MARGIN,
+                   max(column_start // size - FOCUS_MARGIN, 0):-(-column_end // size) + FOCUS_MARGIN] = True
+    def wake_all(self):
+        '''
+        Wakes every chunk, used when the whole grid changes at once like on a scene load
+        '''
+        self.next_awake.fill(True)
+    def wake_cell(self, row, column):
+        '''
+        Wakes the chunk holding a changed cell, plus the neighboring chunks if the cell is on the chunk's edge
+
+        Args:
+            row (int): The row of the changed cell
+            column (int): The column of the changed cell
+        '''
+        size = self.chunk_size
+        chunk_row, chunk_column = row // size, column // size
+        row_start    = chunk_row - (row % size == 0)
+        row_end      = chunk_row + (row % size == size-1) + 1
+        column_start = chunk_column - (column % size == 0)
+        column_end   = chunk_column + (column % size == size-1) + 1
+        self.next_awake[max(row_start, 0):row_end, max(column_start, 0):column_end] = True
+    def wake_cells(self, rows, columns):
+        '''
+        Wakes the chunks around many changed cells at once, the same as calling wake_cell on each of them
+
+        Args:
+            rows (np.ndarray): The rows of the changed cells
+            columns (np.ndarray): The columns of the changed cells
+        '''
+        # waking the chunks of the cell and of its 8 neighbors covers the edge cases of wake_cell
+        for row_offset in (-1, 0, 1):
+            chunk_rows = np.clip(rows + row_offset, 0, self.rows-1) // self.chunk_size
+            for column_offset in (-1, 0, 1):
+                self.next_awake[chunk_rows, np.clip(columns + column_offset, 0, self.columns-1) // self.chunk_size] = True
+    def wake_mask(self, changed, row_offset=0, column_offset=0):
+        '''
+        Wakes every chunk that holds or touches a changed cell in the mask
+
+        Args:
+            changed (np.ndarray): 2D boolean array of the changed cells
+            row_offset (int): Grid row of the mask's first row
+            column_offset (int): Grid column of the mask's first column
+        '''
+        # grow the mask by one cell in every direction so changes on a chunk's edge wake its neighbor too,
+        # padded first so the cells just outside the mask are woken as well
+        grown = np.zeros((changed.shape[0]+2, changed.shape[1]+2), dtype=bool)
+        grown[1:-1, 1:-1] = changed
+        grown[1:] |= grown[:-1].copy()
+        grown[:-1] |= grown[1:].copy()
+        grown[:, 1:] |= grown[:, :-1].copy()
+        grown[:, :-1] |= grown[:, 1:].copy()
+        rows, columns = np.nonzero(grown)
+        if rows.size == 0:
+            return
+        rows, columns = rows + row_offset - 1, columns + column_offset - 1
+        inside = (rows >= 0) & (rows < self.rows) & (columns >= 0) & (columns < self.columns)
+        self.next_awake[rows[inside] // self.chunk_size, columns[inside] // self.chunk_size] = True
+    def wake_rectangle(self, row_start, row_end, column_start, column_end):
+        '''
+        Wakes every chunk that holds or touches a cell in a rectangle, used when a whole rectangle of the grid is written at once
+
+        Args:
+            row_start, row_end (int, int): The rows of the rectangle, end exclusive
+            column_start, column_end (int, int): The columns of the rectangle, end exclusive
+        '''
+        # grown by one cell in every direction so a rectangle ending on a chunk's edge wakes its neighbor too
+        size = self.chunk_size
+        self.next_awake[max(row_start-1, 0) // size:min(row_end, self.rows-1) // size + 1,
+                        max(column_start-1, 0) // size:min(column_end, self.columns-1) // size + 1] = True
+    def awake_cells(self, row_start=0, row_end=None, column_start=0, column_end=None, awake=None):
+        '''
+        Returns the awake chunks scaled up to a cell mask, for the whole grid or just a rectangle of it
+
+        Args:
+            row_start, row_end (int, int): The rows of the rectangle, end exclusive
+            column_start, column_end (int, int): The columns of the rectangle, end exclusive
+            awake (np.ndarray): Optional 2D boolean array of chunks to use instead of all the awake ones
+        '''
+        row_end = self.rows if row_end is None else row_end
+        column_end = self.columns if column_end is None else column_end
+        awake = self.awake if awake is None else awake
+        size = self.chunk_size
+        return awake[np.ix_(np.arange(row_start, row_end) // size, np.arange(column_start, column_end) // size)]
+    def awake_bounds(self, awake=None):
+        '''
+        Returns the bounding box of every awake chunk in grid cells
+
+        Args:
+            awake (np.ndarray): Optional 2D boolean array of chunks to use instead of all the awake ones
+
+        Returns:
+            bounds (int, int, int, int): (row_start, row_end, column_start, column_end), or None if every chunk is asleep
+        '''
+        chunk_rows, chunk_columns = np.nonzero(self.awake if awake is None else awake)
+        if chunk_rows.size == 0:
+            return None
+        size = self.chunk_size
+        return (chunk_rows.min() * size, min((chunk_rows.max()+1) * size, self.rows),
+                chunk_columns.min() * size, min((chunk_columns.max()+1) * size, self.columns))
+    def sector_bounds(self, sector_size=SECTOR_SIZE):
+        '''
+        Returns the bounding box of the awake chunks in each sector of the grid, sectors without an awake chunk are left out
+
+        Args:
+            sector_size (int): Width and height of the sectors in cells, a multiple of the chunk size
+
+        Returns:
+            sectors (dict): (sector_row, sector_column) mapped to (row_start, row_end, column_start, column_end) in grid cells
+        '''
+        chunk_rows, chunk_columns = np.nonzero(self.awake)
+        if chunk_rows.size == 0:
+            return {}
+        size = self.chunk_size
+        sector_chunks = sector_size // size
+        sectors = (chunk_rows // sector_chunks) * self.chunk_columns + chunk_columns // sector_chunks
+        order = np.argsort(sectors, kind="stable")
+        sectors, starts = np.unique(sectors[order], return_index=True)
+        chunk_rows, chunk_columns = chunk_rows[order], chunk_columns[order]
+        boxes = zip((sectors // self.chunk_columns).tolist(), (sectors % self.chunk_columns).tolist(),
+                    np.minimum.reduceat(chunk_rows, starts).tolist(), np.maximum.reduceat(chunk_rows, starts).tolist(),
+                    np.minimum.reduceat(chunk_columns, starts).tolist(), np.maximum.reduceat(chunk_columns, starts).tolist())
+        return {(sector_row, sector_column): (first_row * size, min((last_row+1) * size, self.rows),
+                                              first_column * size, min((last_column+1) * size, self.columns))
+                for sector_row, sector_column, first_row, last_row, first_column, last_column in boxes}
+
+class ActiveIndex:
+    '''
+    Index of the cells holding movable particles(MOVABLE_TABLE), so the step never has to scan AIR or static particles
+    Each row of the grid has a mask of its movable cells and a count of them, and rows with a count of 0 are skipped entirely
+    '''
+    def __init__(self, types):
+        self.rebuild(types)
+
+    def rebuild(self, types):
+        '''
+        Rebuilds the whole index from a grid of particle types, used when the whole grid changes at once
+        It's built ACTIVE_BAND_ROWS rows at a time and only bands holding movable particles are written,
+        so the empty parts of a huge world never need memory behind them
+
+        Args:
+            types (np.ndarray): 2D array of particle types
+        '''
+        rows, columns = types.shape
+        self.cells = np.zeros((rows, columns), dtype=bool)
+        self.row_counts = np.zeros(rows, dtype=np.intp)
+        for row_start in range(0, rows, ACTIVE_BAND_ROWS):
+            band = MOVABLE_TABLE[types[row_start:row_start+ACTIVE_BAND_ROWS]]
+            counts = np.count_nonzero(band, axis=1)
+            if counts.any():
+                self.cells[row_start:row_start+len(band)] = band
+                self.row_counts[row_start:row_start+len(band)] = counts
+    def rebuild_region(self, types, row_start, column_start):
+        '''
+        Rebuilds the index for a rectangle of the grid
+
+        Args:
+            types (np.ndarray): 2D array of the particle types inside the rectangle
+            row_start (int): Grid row of the rectangle's first row
+            column_start (int): Grid column of the rectangle's first column
+        '''
+        row_end, column_end = row_start + types.shape[0], column_start + types.shape[1]
+        self.cells[row_start:row_end, column_start:column_end] = MOVABLE_TABLE[types]
+        self.row_counts[row_start:row_end] = np.count_nonzero(self.cells[row_start:row_end], axis=1)
+    def set(self, location, particle_type):
+        '''
+        Updates the index after a particle was placed
+
+        Args:
+            location (int, int): Tuple of integers representing the row and column of the particle
+            particle_type (int): The particle type that was placed
+        '''
+        movable = MOVABLE_TABLE[particle_type]
+        if self.cells[location] != movable:
+            self.cells[location] = movable
+            self.row_counts[location[0]] += 1 if movable else -1
+    def set_cells(self, rows, columns, types):
+        '''
+        Updates the index after many particles were replaced at once
+
+        Args:
+            rows (np.ndarray): The rows of the replaced particles, no cell may be listed twice
+            columns (np.ndarray): The columns of the replaced particles
+            types (np.ndarray): The particle types they were replaced with
+        '''
+        movable = MOVABLE_TABLE[types]
+        change = movable.astype(np.int64) - self.cells[rows, columns]
+        self.cells[rows, columns] = movable
+        np.add.at(self.row_counts, rows, change)
+    def swap(self, particle_1, particle_2):
+        '''
+        Updates the index after two particles were swapped
+
+        Args:
+            particle_1 (int, int): Tuple of integers representing the row and column of a swapped particle
+            particle_2 (int, int): Tuple of integers representing the row and column of a swapped particle
+        '''
+        cells = self.cells
+        movable_1, movable_2 = cells[particle_1], cells[particle_2]
+        if movable_1 == movable_2:
+            return
+        cells[particle_1], cells[particle_2] = movable_2, movable_1
+        # the movable particle moved to particle_2's row if it was at particle_1
+        change = 1 if movable_1 else -1
+        self.row_counts[particle_1[0]] -= change
+        self.row_counts[particle_2[0]] += change
+    def locations(self):
+        '''
+        Returns the rows and columns of every movable particle, only looking at rows that have any
+
+        Returns:
+            rows, columns (np.ndarray, np.ndarray): The locations of the movable particles
+        '''
+        active_rows = np.flatnonzero(self.row_counts)
+        rows, columns = np.nonzero(self.cells[active_rows])
+        return active_rows[rows], columns
+    def row_bounds(self):
+        '''
+        Returns the first and last row holding a movable particle
+
+        Returns:
+            bounds (int, int): (row_start, row_end), or None if there are no movable particles
+        '''
+        active_rows = np.flatnonzero(self.row_counts)
+        if active_rows.size == 0:
+            return None
+        return active_rows[0], active_rows[-1] + 1
+    def count(self):
+        '''
+        Returns the number of movable particles
+        '''
+        return int(self.row_counts.sum())
+
+# Reactions
+# 8 neighbors of a cell as (row, column) offsets, burning particles spread to and are put out by any of them
+NEIGHBOR_OFFSETS = np.array([(-1, -1), (-1, 0), (-1, 1), (0, -1), (0, 1), (1, -1), (1, 0), (1, 1)])
+
+def flat_cells(indexes, columns):
+    '''
+    Turns flat indexes into the grid back into its cells, every cell once
+
+    Args:
+        indexes (np.ndarray): Flat indexes into the grid, may repeat
+        columns (int): The number of columns in the grid
+
+    Returns:
+        rows, columns (np.ndarray, np.ndarray): The cells of the grid, in row major order
+    '''
+    return np.divmod(np.unique(indexes), columns)
+
+class ReactionList:
+    '''
+    The burning particles and the ticks each one has left to burn
+    Burning particles never move, so the reactions only ever look at these cells and their neighbors instead of searching the grid for FIRE
+    '''
+    def __init__(self, rows, columns):
+        self.rows    = rows
+        self.columns = columns
+        self.cell_rows    = np.zeros(0, dtype=np.int64)
+        self.cell_columns = np.zeros(0, dtype=np.int64)
+        self.lifetimes    = np.zeros(0, dtype=np.int32)
+        # which cells are in the list, so a cell is never listed twice
+        self.listed = np.zeros((rows, columns), dtype=bool)
+
+    def __len__(self):
+        return len(self.lifetimes)
+    def add(self, rows, columns, types, rng):
+        '''
+        Adds newly burning particles with a random lifetime from their material's range
+
+        Args:
+            rows (np.ndarray): The rows of the burning particles
+            columns (np.ndarray): The columns of the burning particles
+            types (np.ndarray): Their particle types, every one with a lifetime
+            rng (np.random.Generator): Random generator for the lifetimes
+        '''
+        rows, columns, types = np.atleast_1d(rows), np.atleast_1d(columns), np.atleast_1d(types)
+        new = ~self.listed[rows, columns]
+        rows, columns, types = rows[new], columns[new], types[new]
+        if rows.size == 0:
+            return
+        low, high = LIFETIME_TABLE[types, 0], LIFETIME_TABLE[types, 1]
+        self.listed[rows, columns] = True
+        self.cell_rows    = np.concatenate((self.cell_rows, rows))
+        self.cell_columns = np.concatenate((self.cell_columns, columns))
+        self.lifetimes    = np.concatenate((self.lifetimes, rng.integers(low, high + 1).astype(np.int32)))
+    def keep(self, kept):
+        '''
+        Drops every entry that isn't kept
+
+        Args:
+            kept (np.ndarray): Boolean array with an entry for every listed particle
+        '''
+        self.listed[self.cell_rows[~kept], self.cell_columns[~kept]] = False
+        self.cell_rows, self.cell_columns, self.lifetimes = self.cell_rows[kept], self.cell_columns[kept], self.lifetimes[kept]
+    def rebuild(self, types, rng):
+        '''
+        Lists every burning particle in a grid from scratch, used when the whole grid changes at once
+        The grid doesn't keep the lifetimes, so every particle with a lifetime, like FIRE and burning wood, gets a fresh one.
+        Burning wood that was put out looks the same as burning wood, the water still next to it puts it out again on the next tick
+
+        Args:
+            types (np.ndarray): 2D array of particle types
+            rng (np.random.Generator): Random generator for the lifetimes
+        '''
+        self.__init__(*types.shape)
+        rows, columns = np.nonzero(BURNING_TABLE[types])
+        self.add(rows, columns, types[rows, columns], rng)
+    def rebuild_region(self, types, bounds, rng):
+        '''
+        Lists the burning particles of a rectangle from scratch, used when the rectangle changes at once like on an undo
+        The same as rebuild, every particle with a lifetime in the rectangle gets a fresh one
+
+        Args:
+            types (np.ndarray): 2D array of particle types of the whole grid
+            bounds (int, int, int, int): The rectangle as (row_start, row_end, column_start, column_end), ends exclusive
+            rng (np.random.Generator): Random generator for the lifetimes
+        '''
+        row_start, row_end, column_start, column_end = bounds
+        inside = ((self.cell_rows >= row_start) & (self.cell_rows < row_end) &
+                  (self.cell_columns >= column_start) & (self.cell_columns < column_end))
+        self.keep(~inside)
+        region = types[row_start:row_end, column_start:column_end]
+        rows, columns = np.nonzero(BURNING_TABLE[region])
+        self.add(rows + row_start, columns + column_start, region[rows, columns], rng)
+
+# emitter settings
+EMITTER_DTYPE    = np.dtype([("row", "<u4"), ("column", "<u4"), ("material", "u1"), ("rate", "<f4")]) # one emitter, as stored in scene files
+EMITTER_RATE     = 0.5      # particles per tick a new emitter emits, at most 1
+EMIT_BUDGET      = 4096     # most particles all the emitters together write in one tick
+EMIT_MAX_FILL    = 0.9      # the emitters stop once this fraction of the grid isn't AIR
+EMIT_TICK_TARGET = 0.008    # seconds a tick can take before the emitters are throttled, half of a 60 FPS frame
+EMIT_MIN_THROTTLE = 1 / 64  # the throttle never shuts the emitters off completely
+EMIT_RECOVERY    = 0.05     # share of the budget that comes back after every tick under the target
+EMIT_FILL_INTERVAL = 32     # ticks between counts of the grid's filled cells, in between the emitters add up what they wrote themselves
+
+class EmitterList:
+    '''
+    Particle generators, cells that keep emitting a material into themselves at their own rate while they're empty
+    The emitters are one structured array, so every emitter that's due emits in a single write per tick
+    Emission is held to a particle budget per tick that shrinks while the grid is too full, or while ticks take longer than the tick target
+    '''
+    def __init__(self, budget=EMIT_BUDGET, max_fill=EMIT_MAX_FILL, tick_target=None):
+        '''
+        Args:
+            budget (int): Most particles all the emitters together write in one tick
+            max_fill (float): The emitters stop once this fraction of the grid isn't AIR
+            tick_target (float): Seconds a tick can take before emission is throttled, None to never throttle on time so seeded runs repeat exactly
+        '''
+        self.emitters = np.zeros(0, dtype=EMITTER_DTYPE)
+        self.credits  = np.zeros(0, dtype=np.float64) # particles each emitter has built up, it emits once it has a whole one
+        self.budget      = budget
+        self.max_fill    = max_fill
+        self.tick_target = tick_target
+        self.throttle    = 1.0 # share of the budget that's available this tick
+        # cells of the grid that aren't AIR as of the last count, plus the particles emitted since, None to count again
+        self.filled      = None
+        self.filled_age  = 0   # ticks since the last count
+
+    def __len__(self):
+        return len(self.emitters)
+    def find(self, row, column):
+        '''
+        Returns the index of the emitter at a cell, or None if there isn't one
+        '''
+        found = np.flatnonzero((self.emitters["row"] == row) & (self.emitters["column"] == column))
+        return int(found[0]) if found.size else None
+    def add(self, row, column, material, rate=EMITTER_RATE):
+        '''
+        Adds an emitter, replacing the emitter already at that cell
+
+        Args:
+            row (int): The row of the emitter
+            column (int): The column of the emitter
+            material (int): The particle type it emits
+            rate (float): Particles per tick, at most 1
+        '''
+        emitter = np.array([(row, column, material, min(max(rate, 0.0), 1.0))], dtype=EMITTER_DTYPE)
+        index = self.find(row, column)
+        if index is not None:
+            self.emitters[index] = emitter[0]
+            return
+        self.emitters = np.concatenate((self.emitters, emitter))
+        self.credits  = np.concatenate((self.credits, [0.0]))
+    def remove(self, row, column):
+        '''
+        Removes the emitter at a cell, if there is one
+        '''
+        index = self.find(row, column)
+        if index is not None:
+            self.emitters = np.delete(self.emitters, index)
+            self.credits  = np.delete(self.credits, index)
+    def clear(self):
+        '''
+        Removes every emitter
+        '''
+        self.emitters = np.zeros(0, dtype=EMITTER_DTYPE)
+        self.credits  = np.zeros(0, dtype=np.float64)
+        self.throttle = 1.0
+        self.filled   = None
+    def to_bytes(self):
+        '''
+        Returns the emitters as the bytes of a scene file's emitter section
+        '''
+        return self.emitters.tobytes()
+    def load_bytes(self, data, rows, columns):
+        '''
+        Replaces the emitters with the ones in a scene file's emitter section
+
+        Args:
+            data (bytes): The section's bytes
+            rows (int): The number of rows in the scene, emitters outside of it are dropped
+            columns (int): The number of columns in the scene
+        '''
+        self.clear()
+        emitters = np.frombuffer(data, dtype=EMITTER_DTYPE)
+        inside = (emitters["row"] < rows) & (emitters["column"] < columns) & (emitters["material"] < len(MATERIALS))
+        self.emitters = emitters[inside].copy()
+        self.credits  = np.zeros(len(self.emitters), dtype=np.float64)
+    def throttle_to(self, tick_time):
+        '''
+        Halves the budget after a tick that took longer than the tick target, and slowly gives it back after ticks that didn't
+
+        Args:
+            tick_time (float): Seconds the last tick took
+        '''
+        if self.tick_target is None:
+            return
+        if tick_time > self.tick_target:
+            self.throttle = max(self.throttle / 2, EMIT_MIN_THROTTLE)
+        else:
+            self.throttle = min(self.throttle + EMIT_RECOVERY, 1.0)
+    def ready(self, types, rng):
+        '''
+        Picks the emitters that emit this tick, the ones with a whole particle built up whose cell is empty
+        When more are due than the budget allows a random few of them emit, the rest keep their particle for a later tick
+
+        Args:
+            types (np.ndarray): 2D array of particle types
+            rng (np.random.Generator): Picks the emitters that go when the budget runs out
+
+        Returns:
+            rows, columns, materials (np.ndarray, np.ndarray, np.ndarray): The cells to emit into and what to emit, every cell once
+        '''
+        emitters = self.emitters
+        rows, columns = emitters["row"].astype(np.intp), emitters["column"].astype(np.intp)
+        self.credits += emitters["rate"]
+        # a little slack so rates like 0.1 still add up to a whole particle in 10 ticks
+        ready = np.flatnonzero((self.credits >= 1 - 1e-6) & (types[rows, columns] == AIR))
+        # blocked emitters don't save up a burst for when their cell empties
+        np.minimum(self.credits, 1.0, out=self.credits)
+
+        # counting the whole grid every tick would cost more than the emitting, so it's only counted every EMIT_FILL_INTERVAL ticks
+        if self.filled is None or self.filled_age >= EMIT_FILL_INTERVAL:
+            self.filled, self.filled_age = np.count_nonzero(types), 0
+        self.filled_age += 1
+        room = int(self.max_fill * types.size) - self.filled
+        allowance = max(min(int(self.budget * self.throttle), room), 0)
+        if ready.size > allowance:
+            ready = np.sort(rng.choice(ready, allowance, replace=False))
+        self.credits[ready] -= 1
+        self.filled += ready.size
+        return rows[ready], columns[ready], emitters["material"][ready]
+
+# brush settings
+CIRCLE_BRUSH = "circle"     # every cell within the radius of the cursor
+SQUARE_BRUSH = "square"     # every cell in the square around the cursor
+SPRAY_BRUSH  = "spray"      # a random share of the circle's cells, set by the spray density
+BRUSH_SHAPES = (CIRCLE_BRUSH, SQUARE_BRUSH, SPRAY_BRUSH)
+BRUSH_RADIUS     = 2        # radius in cells of a new brush, 0 paints single cells
+MAX_BRUSH_RADIUS = 20       # largest radius the brush slider goes up to
+SPRAY_DENSITY    = 0.1      # share of the brush's cells the spray brush paints per stroke segment
+
+def brush_mask(start, end, radius, shape, rows, columns):
+    '''
+    Rasterizes one segment of a brush stroke, the brush stamped at every cell along the line from start to end so fast strokes leave no gaps
+
+    Args:
+        start (int, int): The row and column the segment starts at
+        end (int, int): The row and column the segment ends at
+        radius (int): The brush radius in cells
+        shape (str): One of BRUSH_SHAPES, the spray brush is rasterized as a circle
+        rows (int): The number of rows in the grid
+        columns (int): The number of columns in the grid
+
+    Returns:
+        row_start, column_start, mask (int, int, np.ndarray): The segment's bounding rectangle clipped to the grid as its
+            top left cell and a boolean mask of the painted cells in it, or None when the segment misses the grid
+    '''
+    (start_row, start_column), (end_row, end_column) = start, end
+    row_start    = max(min(start_row, end_row) - radius, 0)
+    row_end      = min(max(start_row, end_row) + radius + 1, rows)
+    column_start = max(min(start_column, end_column) - radius, 0)
+    column_end   = min(max(start_column, end_column) + radius + 1, columns)
+    if row_start >= row_end or column_start >= column_end:
+        return None
+
+    # the brush's footprint as offsets from its center, r^2 + r gives small circles a rounder outline than r^2
+    offset_rows, offset_columns = np.mgrid[-radius:radius+1, -radius:radius+1]
+    if shape != SQUARE_BRUSH:
+        inside = offset_rows**2 + offset_columns**2 <= radius * (radius + 1)
+        offset_rows, offset_columns = offset_rows[inside], offset_columns[inside]
+    # one stamp per cell along the longer axis of the segment
+    stamps = max(abs(end_row - start_row), abs(end_column - start_column)) + 1
+    center_rows    = np.rint(np.linspace(start_row, end_row, stamps)).astype(np.intp)
+    center_columns = np.rint(np.linspace(start_column, end_column, stamps)).astype(np.intp)
+    cell_rows    = (center_rows[:, None] + offset_rows.ravel()).ravel() - row_start
+    cell_columns = (center_columns[:, None] + offset_columns.ravel()).ravel() - column_start
+
+    mask = np.zeros((row_end - row_start, column_end - column_start), dtype=bool)
+    inside = (cell_rows >= 0) & (cell_rows < mask.shape[0]) & (cell_columns >= 0) & (cell_columns < mask.shape[1])
+    mask[cell_rows[inside], cell_columns[inside]] = True
+    return row_start, column_start, mask
+
+# dirty region settings
+DIRTY_MERGE_GAP = 8 # dirty spans in neighboring rows merge into one rectangle when they're at most this many columns apart
+
+class DirtyRegions:
+    '''
+    Tracks the cells that changed since the view last drew them
+    Changes are flags in a boolean mask so marking a cell twice costs nothing, and the view gets them back as a few rectangles to repaint
+    '''
+    def __init__(self, rows, columns):
+        self.rows    = rows
+        self.columns = columns
+        self.mask    = np.zeros((rows, columns), dtype=bool)
+        self.marked_rows = np.zeros(rows, dtype=bool) # rows holding a changed cell, so clearing and coalescing skip the rest of a big grid
+        self.all_dirty = False # set by mark_all so the whole grid is repainted without touching the mask
+
+    def mark(self, row, column):
+        '''
+        Marks a single cell as changed
+
+        Args:
+            row (int): The row of the changed cell
+            column (int): The column of the changed cell
+        '''
+        self.mask[row, column] = True
+        self.marked_rows[row] = True
+    def mark_cells(self, rows, columns):
+        '''
+        Marks many cells as changed at once
+
+        Args:
+            rows (np.ndarray): The rows of the changed cells
+            columns (np.ndarray): The columns of the changed cells
+        '''
+        self.mask[rows, columns] = True
+        self.marked_rows[rows] = True
+    def mark_mask(self, changed, row_offset=0, column_offset=0):
+        '''
+        Marks every changed cell in a mask
+
+        Args:
+            changed (np.ndarray): 2D boolean array of changed cells
+            row_offset (int): The grid row of the mask's first row
+            column_offset (int): The grid column of the mask's first column
+        '''
+        rows, columns = changed.shape
+        self.mask[row_offset:row_offset+rows, column_offset:column_offset+columns] |= changed
+        self.marked_rows[row_offset:row_offset+rows] |= changed.any(axis=1)
+    def mark_rectangle(self, row_start, row_end, column_start, column_end):
+        '''
+        Marks a rectangle of cells as changed, ends exclusive
+        '''
+        self.mask[max(row_start, 0):row_end, max(column_start, 0):column_end] = True
+        self.marked_rows[max(row_start, 0):row_end] = True
+    def mark_all(self):
+        '''
+        Marks the whole grid as changed, used when every cell changes at once like on a scene load
+        '''
+        self.all_dirty = True
+    def clear(self):
+        '''
+        Forgets every change, called once the view has drawn them
+        '''
+        marked = np.flatnonzero(self.marked_rows)
+        self.mask[marked] = False
+        self.marked_rows[marked] = False
+        self.all_dirty = False
+    def any(self):
+        '''
+        Returns:
+            dirty (bool): Whether anything changed
+        '''
+        return self.all_dirty or bool(self.marked_rows.any())
+    def count(self):
+        '''
+        Returns:
+            count (int): How many cells changed
+        '''
+        return self.rows * self.columns if self.all_dirty else int(np.count_nonzero(self.mask[self.marked_rows]))
+    def locations(self):
+        '''
+        Returns:
+            rows, columns (np.ndarray, np.ndarray): The row and column of every changed cell
+        '''
+        if self.all_dirty:
+            return np.indices((self.rows, self.columns)).reshape(2, -1)
+        marked = np.flatnonzero(self.marked_rows)
+        rows, columns = np.nonzero(self.mask[marked])
+        return marked[rows], columns
+    def rectangles(self, bounds=None):
+        '''
+        Coalesces the changed cells into rectangles
+        Each dirty row is reduced to the span from its first to last changed cell, then spans in consecutive rows
+        that overlap or sit within DIRTY_MERGE_GAP columns of each other are merged into one rectangle
+
+        Args:
+            bounds (int, int, int, int): Optional (row_start, row_end, column_start, column_end) box, like the part of the grid
+                on screen, the changes outside of it are left out
+
+        Returns:
+            rectangles (list): (row_start, row_end, column_start, column_end) tuples in grid cells, ends exclusive
+        '''
+        row_start, row_end, column_start, column_end = bounds or (0, self.rows, 0, self.columns)
+        if self.all_dirty:
+            return [(row_start, row_end, column_start, column_end)]
+        dirty_rows = np.flatnonzero(self.marked_rows[row_start:row_end]) + row_start
+        masks = self.mask[dirty_rows, column_start:column_end]
+        changed = masks.any(axis=1)
+        dirty_rows, masks = dirty_rows[changed], masks[changed]
+        if len(dirty_rows) == 0:
+            return []
+        firsts = masks.argmax(axis=1) + column_start
+        lasts  = column_end - masks[:, ::-1].argmax(axis=1)
+
+        rectangles = []
+        row_start = row_end = column_start = column_end = None
+        for row, first, last in zip(dirty_rows.tolist(), firsts.tolist(), lasts.tolist()):
+            if row == row_end and first <= column_end + DIRTY_MERGE_GAP and last >= column_start - DIRTY_MERGE_GAP:
+                # grow the current rectangle down over this row
+                row_end = row + 1
+                column_start, column_end = min(column_start, first), max(column_end, last)
+                continue
+            if row_start is not None:
+                rectangles.append((row_start, row_end, column_start, column_end))
+            row_start, row_end, column_start, column_end = row, row + 1, first, last
+        rectangles.append((row_start, row_end, column_start, column_end))
+        return rectangles
+
+# undo/redo settings
+HISTORY_CHUNK_SIZE  = 64        # width and height of the chunks the edit history snapshots, bigger than CHUNK_SIZE so each one compresses well
+HISTORY_MEMORY_CAP  = 64 << 20  # bytes of compressed snapshots the history holds before dropping its oldest edits
+HISTORY_COMPRESSION = 1         # zlib level of the snapshots, edits are mostly runs of the same particle
+
+class EditHistory:
+    '''
+    Undo/redo stacks of the edits made to a grid, like a brush stroke or a reset
+    An edit copies a chunk the first time it's about to be written (copy-on-write), and only keeps the chunks whose particles changed
+    by the end of the edit, as a zlib snapshot of before and after. Identical snapshots (an empty chunk, the after of one edit and
+    the before of the next) are stored once and shared, and the oldest edits are dropped when the snapshots go over the memory cap
+    '''
+    def __init__(self, rows, columns, chunk_size=HISTORY_CHUNK_SIZE, memory_cap=HISTORY_MEMORY_CAP):
+        self.rows       = rows
+        self.columns    = columns
+        self.chunk_size = chunk_size
+        self.memory_cap = memory_cap
+        self.undo_stack = [] # edits, each a list of (chunk row, chunk column, before snapshot, after snapshot)
+        self.redo_stack = [] # edits that were undone, the most recent last
+        self.snapshots  = {} # compressed snapshot -> how many edits use it
+        self.memory     = 0  # bytes of the stored snapshots
+        # the edit being recorded, copies of its chunks from before their first write
+        self.recording = False
+        self.copied    = np.zeros((-(-rows // chunk_size), -(-columns // chunk_size)), dtype=bool)
+        self.originals = {}
+
+    def chunk_bounds(self, chunk_row, chunk_column):
+        '''
+        Returns:
+            bounds (int, int, int, int): The chunk's rows and columns as (row_start, row_end, column_start, column_end), ends exclusive
+        '''
+        size = self.chunk_size
+        return (chunk_row * size, min((chunk_row+1) * size, self.rows), chunk_column * size, min((chunk_column+1) * size, self.columns))
+    def begin(self):
+        '''
+        Starts recording an edit, an edit that was never ended just carries on
+        '''
+        self.recording = True
+    def touch(self, grid, row_start, row_end, column_start, column_end):
+        '''
+        Copies the chunks of a rectangle that's about to be written, unless the edit already copied them
+        Does nothing when no edit is being recorded
+
+        Args:
+            grid (ParticleGrid): The grid about to be written
+            row_start (int): The first row of the rectangle
+            row_end (int): The row after the rectangle
+            column_start (int): The first column of the rectangle
+            column_end (int): The column after the rectangle
+        '''
+        if not self.recording:
+            return
+        size = self.chunk_size
+        chunk_rows    = slice(max(row_start, 0) // size, -(-min(row_end, self.rows) // size))
+        chunk_columns = slice(max(column_start, 0) // size, -(-min(column_end, self.columns) // size))
+        new = ~self.copied[chunk_rows, chunk_columns]
+        if not new.any():
+            return
+        self.copied[chunk_rows, chunk_columns] = True
+        for chunk_row, chunk_column in zip(*np.nonzero(new)):
+            chunk = (int(chunk_row) + chunk_rows.start, int(chunk_column) + chunk_columns.start)
+            top, bottom, left, right = self.chunk_bounds(*chunk)
+            self.originals[chunk] = (grid.types[top:bottom, left:right].copy(), grid.colors[top:bottom, left:right].copy())
+    def store(self, snapshot):
+        '''
+        Adds a use of a compressed snapshot, storing it if it isn't already
+
+        Args:
+            snapshot (bytes): The compressed snapshot
+        '''
+        if snapshot not in self.snapshots:
+            self.snapshots[snapshot] = 0
+            self.memory += len(snapshot)
+        self.snapshots[snapshot] += 1
+    def release(self, edit):
+        '''
+        Drops an edit's uses of its snapshots, freeing the ones no other edit uses
+
+        Args:
+            edit (list): The dropped edit
+        '''
+        for _, _, *snapshots in edit:
+            for snapshot in snapshots:
+                self.snapshots[snapshot] -= 1
+                if self.snapshots[snapshot] == 0:
+                    del self.snapshots[snapshot]
+                    self.memory -= len(snapshot)
+    def end(self, grid):
+        '''
+        Stops recording the edit and pushes the chunks it changed onto the undo stack, which clears the redo stack
+
+        Args:
+            grid (ParticleGrid): The edited grid
+
+        Returns:
+            recorded (bool): If the edit changed any particle
+        '''
+        if not self.recording:
+            return False
+        edit = []
+        for chunk, (types, colors) in self.originals.items():
+            row_start, row_end, column_start, column_end = self.chunk_bounds(*chunk)
+            after_types, after_colors = grid.types[row_start:row_end, column_start:column_end], grid.colors[row_start:row_end, column_start:column_end]
+            if np.array_equal(types, after_types) and np.array_equal(colors, after_colors):
+                continue
+            before = zlib.compress(types.tobytes() + colors.tobytes(), HISTORY_COMPRESSION)
+            after  = zlib.compress(after_types.tobytes() + after_colors.tobytes(), HISTORY_COMPRESSION)
+            self.store(before)
+            self.store(after)
+            edit.append((*chunk, before, after))
+        self.recording = False
+        self.copied.fill(False)
+        self.originals = {}
+        if not edit:
+            return False
+        for undone in self.redo_stack:
+            self.release(undone)
+        self.redo_stack = []
+        self.undo_stack.append(edit)
+        # oldest first, the edit just made is dropped too if it's bigger than the whole cap on its own
+        while self.memory > self.memory_cap and self.undo_stack:
+            self.release(self.undo_stack.pop(0))
+        return True
+    def restore(self, grid, edit, side):
+        '''
+        Writes one side of an edit's snapshots back into the grid
+
+        Args:
+            grid (ParticleGrid): The grid to write to
+            edit (list): The edit
+            side (int): 2 for the snapshots from before the edit, 3 for after
+
+        Returns:
+            bounds (list): The (row_start, row_end, column_start, column_end) of every chunk written
+        '''
+        written = []
+        for entry in edit:
+            row_start, row_end, column_start, column_end = bounds = self.chunk_bounds(entry[0], entry[1])
+            data = np.frombuffer(zlib.decompress(entry[side]), dtype=np.uint8)
+            cells = (row_end - row_start) * (column_end - column_start)
+            grid.types[row_start:row_end, column_start:column_end] = data[:cells].reshape(row_end - row_start, -1)
+            grid.colors[row_start:row_end, column_start:column_end] = data[cells:].reshape(row_end - row_start, -1)
+            written.append(bounds)
+        return written
+    def undo(self, grid):
+        '''
+        Puts the chunks of the last edit back the way they were before it
+
+        Args:
+            grid (ParticleGrid): The grid to write to
+
+        Returns:
+            bounds (list): The (row_start, row_end, column_start, column_end) of every chunk written, empty when there's nothing to undo
+        '''
+        if not self.undo_stack:
+            return []
+        edit = self.undo_stack.pop()
+        self.redo_stack.append(edit)
+        return self.restore(grid, edit, 2)
+    def redo(self, grid):
+        '''
+        Puts the chunks of the last undone edit back the way they were after it
+
+        Args:
+            grid (ParticleGrid): The grid to write to
+
+        Returns:
+            bounds (list): The (row_start, row_end, column_start, column_end) of every chunk written, empty when there's nothing to redo
+        '''
+        if not self.redo_stack:
+            return []
+        edit = self.redo_stack.pop()
+        self.undo_stack.append(edit)
+        return self.restore(grid, edit, 3)
+
+# Vectorized step kernel
+# Every function here works on the type/color arrays(or views of them) in place and records each cell it touched in the moved mask.
+# A particle may only move once per tick, so every pass skips cells that are already marked as moved.
+def fall_runs(types, colors, moved, movers, passable, dispersion=None):
+    '''
+    Moves every vertical run of mover cells that rests on a passable cell down by one row
+    The passable cell below the run ends up at the top of the run, which is the same result as the scalar path swapping its way up a column
+    With a dispersion table a liquid below a run is pushed aside instead, see displace_liquid
+
+    Args:
+        types (np.ndarray): 2D array of particle types
+        colors (np.ndarray): 2D array of particle colors, the same shape as types
+        moved (np.ndarray): 2D boolean array of the cells that already moved this tick
+        movers (np.ndarray): 2D boolean array of the cells that are trying to fall
+        passable (np.ndarray): Boolean lookup table of the particle types the movers can fall into
+        dispersion (np.ndarray): Optional lookup table of how far each liquid can be pushed aside, see DISPERSION_TABLE
+    '''
+    rows = types.shape[0]
+    if rows < 2:
+        return
+
+    # find the row of the nearest non-mover cell below every cell (rows if there isn't one)
+    blockers = np.where(movers, rows, np.arange(rows)[:, None])
+    nearest = np.minimum.accumulate(blockers[::-1], axis=0)[::-1]
+    below = np.full(types.shape, rows)
+    below[:-1] = nearest[1:]
+
+    # a run falls if the cell it rests on is passable and hasn't already moved(AIR can always be moved into)
+    row, column = np.nonzero(movers & (below < rows))
+    target_row = below[row, column]
+    target_type = types[target_row, column]
+    keep = passable[target_type] & (~moved[target_row, column] | (target_type == AIR))
+    row, column = row[keep], column[keep]
+    if row.size == 0:
+        return
+    falling = np.zeros(types.shape, dtype=bool)
+    falling[row, column] = True
+
+    # the top cell of every falling run receives the cell the run falls into
+    top = falling.copy()
+    top[1:] &= ~falling[:-1]
+    top_row, top_column = np.nonzero(top)
+    bottom_row = below[top_row, top_column]
+    if dispersion is not None:
+        displaced = displace_liquid(types, top_row, top_column, bottom_row, dispersion)
+
+    falling_types, falling_colors = types[row, column], colors[row, column]
+    bottom_types, bottom_colors = types[bottom_row, top_column], colors[bottom_row, top_column]
+    types[row+1, column], colors[row+1, column] = falling_types, falling_colors
+    types[top_row, top_column], colors[top_row, top_column] = bottom_types, bottom_colors
+    moved[row+1, column] = True
+    moved[top_row, top_column] = True
+    if dispersion is not None:
+        # the liquid that just reached the top of a run moves on to the open cell found beside the run, which leaves AIR on top of it
+        run, open_row, open_column = displaced
+        swap_cells(types, colors, moved, top_row[run], top_column[run], open_row, open_column)
+def displace_liquid(types, top_row, top_column, bottom_row, dispersion):
+    '''
+    Finds where the liquid under each falling run is pushed aside to, instead of rising up through the run
+    Every cell of the run looks sideways along its row, through the same liquid, for the nearest AIR cell within the liquid's dispersion.
+    The lowest cell of the run that finds one wins, which is the surface of the liquid next to a run that's sinking into it,
+    so a tall tower of sand dropped into water pushes the water out to its sides instead of lifting it up to the top of the tower
+
+    Args:
+        types (np.ndarray): 2D array of particle types, before the runs fall
+        top_row (np.ndarray): The row of the top cell of every falling run
+        top_column (np.ndarray): The column of every falling run
+        bottom_row (np.ndarray): The row of the cell every run falls into
+        dispersion (np.ndarray): Lookup table of how far each liquid can be pushed aside, see DISPERSION_TABLE
+
+    Returns:
+        run, row, column (np.ndarray, np.ndarray, np.ndarray): The index of every run that has somewhere to push its liquid, and the AIR cell it goes to
+    '''
+    columns = types.shape[1]
+    liquid_types = types[bottom_row, top_column]
+    runs = np.flatnonzero(MOBILITY_TABLE[liquid_types] == LIQUID)
+    if runs.size == 0 or columns < 2:
+        return runs[:0], runs[:0], runs[:0]
+
+    # the AIR cells the runs fall into this tick can't take a liquid too
+    taken = np.zeros(types.shape, dtype=bool)
+    taken[bottom_row, top_column] = True
+
+    # every cell of the runs, each run from its lowest cell up
+    lengths = bottom_row[runs] - top_row[runs]
+    starts = np.cumsum(lengths) - lengths
+    run = np.repeat(runs, lengths)
+    cell_row = np.repeat(bottom_row[runs], lengths) - 1 - (np.arange(lengths.sum()) - np.repeat(starts, lengths))
+    cell_column = top_column[run]
+    liquid = liquid_types[run]
+    reach = dispersion[liquid]
+
+    # look both ways, nearest first, the side looked at first alternates from column to column so neither side is favoured
+    distance = np.full(run.size, columns)
+    open_column = np.zeros(run.size, dtype=np.intp)
+    first_side = cell_column % 2 * 2 - 1
+    for side in (first_side, -first_side):
+        looking = np.ones(run.size, dtype=bool)
+        for step in range(1, int(reach.max()) + 1):
+            candidate = cell_column + side * step
+            looking &= (candidate >= 0) & (candidate < columns) & (step <= reach) & (step < distance)
+            if not looking.any():
+                break
+            candidate = np.clip(candidate, 0, columns-1)
+            candidate_types = types[cell_row, candidate]
+            found = looking & (candidate_types == AIR) & ~taken[cell_row, candidate]
+            distance[found], open_column[found] = step, candidate[found]
+            # the search carries on through AIR that's already taken and the liquid itself, anything else is in the way
+            looking &= ~found & ((candidate_types == AIR) | (candidate_types == liquid))
+
+    # the lowest cell of each run that found somewhere, then only one run per AIR cell
+    found = np.flatnonzero(distance < columns)
+    _, first = np.unique(run[found], return_index=True)
+    found = found[first]
+    _, first = np.unique(cell_row[found] * columns + open_column[found], return_index=True)
+    found = found[first]
+    return run[found], cell_row[found], open_column[found]
+def shift_columns(direction, columns):
+    '''
+    Returns the pair of column slices for cells moving one column in the given direction
+
+    Args:
+        direction (int): -1 for left or 1 for right
+        columns (int): The number of columns in the grid
+
+    Returns:
+        source, target (slice, slice): The columns moving particles come from and the columns they move to
+    '''
+    if direction > 0:
+        return slice(0, columns-1), slice(1, columns)
+    return slice(1, columns), slice(0, columns-1)
+def swap_cells(types, colors, moved, row, column, target_row, target_column):
+    '''
+    Swaps every listed cell with its listed target cell
+    The caller is responsible for making sure that no two swaps share a cell
+
+    Args:
+        types (np.ndarray): 2D array of particle types
+        colors (np.ndarray): 2D array of particle colors
+        moved (np.ndarray): 2D boolean array of the cells that already moved this tick
+        row, column (np.ndarray, np.ndarray): The cells to swap
+        target_row, target_column (np.ndarray, np.ndarray): The cells they swap with
+    '''
+    if row.size == 0:
+        return
+    source_types, source_colors = types[row, column], colors[row, column]
+    types[row, column], colors[row, column] = types[target_row, target_column], colors[target_row, target_column]
+    types[target_row, target_column], colors[target_row, target_column] = source_types, source_colors
+    moved[row, column] = True
+    moved[target_row, target_column] = True
+def swap_masked(types, colors, moved, source, row_offset, column_offset):
+    '''
+    Swaps every cell in the source mask with the cell at the given offset from it
+    The caller is responsible for making sure that no two swaps in the mask share a cell
+
+    Args:
+        types (np.ndarray): 2D array of particle types
+        colors (np.ndarray): 2D array of particle colors
+        moved (np.ndarray): 2D boolean array of the cells that already moved this tick
+        source (np.ndarray): 2D boolean array, the same shape as types, of the cells to swap
+        row_offset (int): Row offset from a source cell to the cell it swaps with
+        column_offset (int): Column offset from a source cell to the cell it swaps with
+    '''
+    row, column = np.nonzero(source)
+    swap_cells(types, colors, moved, row, column, row + row_offset, column + column_offset)
+def slide_powder(types, colors, moved, movers, passable, rng, directions_order):
+    '''
+    Slides every resting powder particle diagonally down in a random direction
+    A slide needs both the diagonal cell and the adjacent cell to be passable, just like update_powder
+
+    Args:
+        types (np.ndarray): 2D array of particle types
+        colors (np.ndarray): 2D array of particle colors
+        moved (np.ndarray): 2D boolean array of the cells that already moved this tick
+        movers (np.ndarray): 2D boolean array of the powder cells that are allowed to slide
+        passable (np.ndarray): Boolean lookup table of the particle types the movers can slide into
+        rng (np.random.Generator): Random generator used to pick each particle's direction
+        directions_order (tuple): The order of the left(-1) and right(1) passes
+    '''
+    rows, columns = types.shape
+    if rows < 2 or columns < 2:
+        return
+    resting = np.zeros(types.shape, dtype=bool)
+    resting[:-1] = movers[:-1] & ~passable[types[1:]]
+    directions = np.zeros(types.shape, dtype=np.int8)
+    directions[resting] = rng.integers(-1, 2, np.count_nonzero(resting))
+
+    for direction in directions_order:
+        # each pass only moves one way, so no two slides can land on the same cell
+        source, target = shift_columns(direction, columns)
+        diagonal = types[1:, target]
+        slides = np.zeros(types.shape, dtype=bool)
+        slides[:-1, source] = ((directions[:-1, source] == direction) & ~moved[:-1, source]
+                               & passable[diagonal] & (~moved[1:, target] | (diagonal == AIR))
+                               & passable[types[:-1, target]])
+        swap_masked(types, colors, moved, slides, 1, direction)
+def spread_liquid(types, colors, moved, movers, passable, particle_type, rng, directions_order):
+    '''
+    Flows every resting liquid particle sideways towards somewhere lower
+    Each particle scans its row in one go, through the passable cells and the particles of its own liquid, for the nearest passable cell
+    with a passable cell under it, and moves towards it by up to its dispersion at once, to fall from it once it gets there.
+    The particles of a layer on a pool's surface all head for the same lower cell together instead of one at a time.
+    It looks in a random direction first and the other one after that, a particle with nowhere lower either way stays still,
+    so a level pool stops moving and its chunks fall asleep, just like update_liquid
+
+    Args:
+        types (np.ndarray): 2D array of particle types
+        colors (np.ndarray): 2D array of particle colors
+        moved (np.ndarray): 2D boolean array of the cells that already moved this tick
+        movers (np.ndarray): 2D boolean array of the liquid cells that are allowed to spread
+        passable (np.ndarray): Boolean lookup table of the particle types the movers can spread into
+        particle_type (int): The particle type of the movers
+        rng (np.random.Generator): Random generator used to pick each particle's direction
+        directions_order (tuple): The order of the left(-1) and right(1) passes
+    '''
+    rows, columns = types.shape
+    if rows < 2 or columns < 2:
+        return
+    dispersion = DISPERSION_TABLE[particle_type]
+    # the bottom row never has anywhere lower to go
+    resting = np.zeros(types.shape, dtype=bool)
+    resting[:-1] = movers[:-1] & ~passable[types[1:]]
+    directions = np.zeros(types.shape, dtype=np.int8)
+    directions[resting] = rng.integers(0, 2, np.count_nonzero(resting))*2 - 1
+    column_index = np.arange(columns)
+
+    # the particles that found nowhere lower in their own direction look the other way in the last two passes
+    for attempt, direction in [(attempt, direction) for attempt in (1, -1) for direction in directions_order]:
+        # the left moving pass works on the grid mirrored left to right, so every pass scans to the right
+        mirror = slice(None, None, direction)
+        pass_types, pass_colors, pass_moved = types[:, mirror], colors[:, mirror], moved[:, mirror]
+        sources = (directions[:, mirror] == direction * attempt) & ~pass_moved
+        if not sources[:, :-1].any():
+            continue
+        # cells a particle can flow into, the ones of those with a cell it can fall into under them,
+        # and the cells it can see through, which are those plus its own liquid
+        flowing = passable[pass_types] & (~pass_moved | (pass_types == AIR))
+        lower = np.zeros(types.shape, dtype=bool)
+        lower[:-1] = flowing[:-1] & flowing[1:]
+        clear = flowing | (pass_types == particle_type)
+        # the column of the first cell at or right of every cell that it can't flow into, can't see through, and of the first lower cell
+        blocked = np.minimum.accumulate(np.where(flowing, columns, column_index)[:, ::-1], axis=1)[:, ::-1]
+        walled = np.minimum.accumulate(np.where(clear, columns, column_index)[:, ::-1], axis=1)[:, ::-1]
+        drops = np.minimum.accumulate(np.where(lower, column_index, columns)[:, ::-1], axis=1)[:, ::-1]
+
+        # a particle only moves up to the first cell it can't flow into, which is also where the run of the next particle along the row starts,
+        # so no two particles in a pass can pick the same cell
+        row, column = np.nonzero(sources[:, :-1])
+        target, end = drops[row, column+1], blocked[row, column+1]
+        flows = (target < walled[row, column+1]) & (end > column + 1)
+        row, column = row[flows], column[flows]
+        target = np.minimum(np.minimum(target[flows], end[flows] - 1), column + dispersion)
+        swap_cells(pass_types, pass_colors, pass_moved, row, column, row, target)
+def step_vectorized(types, colors, rng, flip=False, active=None, moved=None):
+    '''
+    Advances every particle in the grid by one tick at once
+
+    Args:
+        types (np.ndarray): 2D array of particle types
+        colors (np.ndarray): 2D array of particle colors
+        rng (np.random.Generator): Random generator for the particle directions
+        flip (bool): Runs the right moving pass before the left moving pass so neither side is favoured over time
+        active (np.ndarray): Optional 2D boolean array of the cells that are allowed to move, every other cell is treated as if it already moved
+        moved (np.ndarray): Optional 2D boolean array of the cells that already moved earlier in this tick, updated in place
+
+    Returns:
+        moved (np.ndarray): 2D boolean array of every cell that changed
+    '''
+    if moved is None:
+        moved = np.zeros(types.shape, dtype=bool)
+    if active is None:
+        active = np.ones(types.shape, dtype=bool)
+    directions_order = (1, -1) if flip else (-1, 1)
+    # lighter materials fall first so heavier ones above them can follow them down in the same tick, like the bottom-up scalar scan
+    for particle_type in FALL_ORDER:
+        # a powder sinking into a liquid pushes it aside
+        dispersion = DISPERSION_TABLE if MOBILITY_TABLE[particle_type] == POWDER else None
+        fall_runs(types, colors, moved, (types == particle_type) & ~moved & active, PASSABLE_TABLE[particle_type], dispersion)
+    for particle_type in POWDERS:
+        slide_powder(types, colors, moved, (types == particle_type) & ~moved & active, PASSABLE_TABLE[particle_type], rng, directions_order)
+    for particle_type in LIQUIDS:
+        spread_liquid(types, colors, moved, (types == particle_type) & ~moved & active, PASSABLE_TABLE[particle_type], particle_type,
+                      rng, directions_order)
+    # a gas is a liquid upside down, so it rises and drifts with the same passes run on the grid flipped over
+    for particle_type in GASES:
+        movers = (types == particle_type) & ~moved & active
+        fall_runs(types[::-1], colors[::-1], moved[::-1], movers[::-1], BUOYANT_TABLE[particle_type])
+    for particle_type in GASES:
+        movers = (types == particle_type) & ~moved & active
+        spread_liquid(types[::-1], colors[::-1], moved[::-1], movers[::-1], BUOYANT_TABLE[particle_type], particle_type,
+                      rng, directions_order)
+    return moved
+
+# Margolus block step
+# The grid is cut into 2x2 blocks, shifted by one cell on every other tick so particles cross the block edges of the tick before.
+# Each block's mobility classes pack into an index into a precomputed table of where each of its four particles goes,
+# so the whole grid is stepped by one table lookup and a gather, with no scan order. Particles are only ever permuted within
+# their block, the colors follow the same permutation, and every particle is kept.
+# Block cells: 0 top left, 1 top right, 2 bottom left, 3 bottom right
+MOBILITY_CLASSES = 5 # EMPTY, STATIC, POWDER, LIQUID and GAS, the block codes
+MARGOLUS_RANK    = {GAS: 0, EMPTY: 1, LIQUID: 2, POWDER: 3} # heavier classes sink below lighter ones, STATIC never moves
+MARGOLUS_MIRROR  = (1, 0, 3, 2) # the block cells flipped left to right
+
+def margolus_rule(codes):
+    '''
+    Works out where the particles of one block go, trying the left side first
+
+    Args:
+        codes (tuple): The mobility class of each of the block's four cells
+
+    Returns:
+        sources (list): For each block cell, the cell its particle comes from
+    '''
+    sources = [0, 1, 2, 3]
+    kinds   = list(codes)
+    moved   = [False] * 4
+    def heavier(cell, other):
+        return kinds[cell] != STATIC and kinds[other] != STATIC and MARGOLUS_RANK[kinds[cell]] > MARGOLUS_RANK[kinds[other]]
+    def swap(cell, other):
+        sources[cell], sources[other] = sources[other], sources[cell]
+        kinds[cell], kinds[other] = kinds[other], kinds[cell]
+        moved[cell] = moved[other] = True
+
+    # straight down, heavier particles sink and gas rises
+    for top, bottom in ((0, 2), (1, 3)):
+        if heavier(top, bottom):
+            swap(top, bottom)
+    # diagonally, powders and liquids topple into the lower cell on the other side, gas into the upper one
+    for top, bottom, other_top, other_bottom in ((0, 2, 1, 3), (1, 3, 0, 2)):
+        if (kinds[top] in (POWDER, LIQUID) and not moved[top] and not moved[other_bottom]
+                and heavier(top, other_bottom) and heavier(top, other_top)):
+            swap(top, other_bottom)
+        elif (kinds[bottom] == GAS and not moved[bottom] and not moved[other_top]
+                and heavier(other_top, bottom) and heavier(other_bottom, bottom)):
+            swap(bottom, other_top)
+    # sideways, liquids and gas spread into the lighter cell next to them
+    for cell, other in ((0, 1), (2, 3), (1, 0), (3, 2)):
+        if moved[cell] or moved[other]:
+            continue
+        if (kinds[cell] == LIQUID and kinds[other] in (EMPTY, GAS)) or (kinds[cell] == GAS and kinds[other] == EMPTY):
+            swap(cell, other)
+    return sources
+def build_margolus_table():
+    '''
+    Builds the block table for every combination of the four cells' mobility classes, once trying the left side first and once the right
+
+    Returns:
+        table (np.ndarray): uint8 array of shape (2, MOBILITY_CLASSES**4, 4), the source cell of each block cell
+    '''
+    table = np.zeros((2, MOBILITY_CLASSES**4, 4), dtype=np.uint8)
+    for index in range(MOBILITY_CLASSES**4):
+        codes = (index // MOBILITY_CLASSES**3, index // MOBILITY_CLASSES**2 % MOBILITY_CLASSES, index // MOBILITY_CLASSES % MOBILITY_CLASSES, index % MOBILITY_CLASSES)
+        table[0, index] = margolus_rule(codes)
+        # the mirrored rule is the rule run on the mirrored block, mirrored back
+        mirrored = margolus_rule(tuple(codes[cell] for cell in MARGOLUS_MIRROR))
+        table[1, index] = [MARGOLUS_MIRROR[mirrored[MARGOLUS_MIRROR[cell]]] for cell in range(4)]
+    return table
+MARGOLUS_TABLE = build_margolus_table()
+
+def step_margolus(types, colors, offset, rng, active=None):
+    '''
+    Steps every 2x2 block of a grid at once through MARGOLUS_TABLE, each block picks the left or right handed rule at random
+
+    Args:
+        types (np.ndarray): 2D array of particle types, changed in place
+        colors (np.ndarray): 2D array of palette indices, changed in place
+        offset (int): 0 or 1, the row and column the first block starts at
+        rng (np.random.Generator): Random generator for the handedness of each block
+        active (np.ndarray): Optional 2D boolean array, only blocks holding an active cell are stepped
+
+    Returns:
+        changed (np.ndarray): 2D boolean array of the cells that changed
+    '''
+    changed = np.zeros(types.shape, dtype=bool)
+    block_rows, block_columns = (types.shape[0] - offset) // 2, (types.shape[1] - offset) // 2
+    if block_rows <= 0 or block_columns <= 0:
+        return changed
+    window = (slice(offset, offset + 2*block_rows), slice(offset, offset + 2*block_columns))
+    # (block row, block column, cell) views of the blocks
+    block_types  = types[window].reshape(block_rows, 2, block_columns, 2).transpose(0, 2, 1, 3).reshape(block_rows, block_columns, 4)
+    block_colors = colors[window].reshape(block_rows, 2, block_columns, 2).transpose(0, 2, 1, 3).reshape(block_rows, block_columns, 4)
+    codes = MOBILITY_TABLE[block_types].astype(np.int16)
+    index = ((codes[..., 0] * MOBILITY_CLASSES + codes[..., 1]) * MOBILITY_CLASSES + codes[..., 2]) * MOBILITY_CLASSES + codes[..., 3]
+    sources = MARGOLUS_TABLE[rng.integers(0, 2, index.shape, dtype=np.uint8), index]
+    if active is not None:
+        block_active = active[window].reshape(block_rows, 2, block_columns, 2).any(axis=(1, 3))
+        sources[~block_active] = np.arange(4, dtype=np.uint8)
+    new_types  = np.take_along_axis(block_types, sources, axis=2)
+    new_colors = np.take_along_axis(block_colors, sources, axis=2)
+    # back from blocks to rows and columns
+    unblock = lambda blocks: blocks.reshape(block_rows, block_columns, 2, 2).transpose(0, 2, 1, 3).reshape(2*block_rows, 2*block_columns)
+    new_types, new_colors = unblock(new_types), unblock(new_colors)
+    changed[window] = (new_types != types[window]) | (new_colors != colors[window])
+    types[window]  = new_types
+    colors[window] = new_colors
+    return changed
+
+# Parallel step
+# The grid lives in shared memory and every worker process steps its own band of columns with the vectorized kernel.
+# Particles fall straight down and only ever move sideways inside the arrays they're stepped in, so the only moves a band can't make on its own
+# are the ones across its edges. A seam pass in the main process gives the unmoved particles on both sides of each edge their move afterwards,
+# one column across the edge, a liquid flows on from there the next tick.
+MIN_BAND_WIDTH = 2 # narrowest band of columns, so the two column seam strips never overlap
+
+band_memory = None # the worker process's handle on the shared grid, kept open for as long as the worker lives
+band_planes = None # the worker process's (types, colors, moved) views of the shared grid
+
+def shared_planes(memory, rows, columns):
+    '''
+    Views the shared memory block as the grid's planes
+
+    Args:
+        memory (SharedMemory): A block of at least 3 * rows * columns bytes
+        rows (int): The number of rows in the grid
+        columns (int): The number of columns in the grid
+
+    Returns:
+        types, colors, moved (np.ndarray, np.ndarray, np.ndarray): The particle types, particle colors and the cells moved this tick
+    '''
+    size = rows * columns
+    types  = np.ndarray((rows, columns), dtype=np.uint8, buffer=memory.buf, offset=0)
+    colors = np.ndarray((rows, columns), dtype=np.uint8, buffer=memory.buf, offset=size)
+    moved  = np.ndarray((rows, columns), dtype=bool, buffer=memory.buf, offset=2*size)
+    return types, colors, moved
+def attach_band_planes(name, rows, columns):
+    '''
+    Initializer of every worker process, maps the shared grid into the worker
+
+    Args:
+        name (str): The name of the shared memory block
+        rows (int): The number of rows in the grid
+        columns (int): The number of columns in the grid
+    '''
+    global band_memory, band_planes
+    band_memory = shared_memory.SharedMemory(name=name)
+    band_planes = shared_planes(band_memory, rows, columns)
+def step_band(bounds, awake, chunk_size, flip, seed):
+    '''
+    Steps one band of the shared grid inside a worker process
+    The band's cells in the shared moved plane are overwritten with the cells that moved
+
+    Args:
+        bounds (int, int, int, int): (row_start, row_end, column_start, column_end) of the band, ends exclusive
+        awake (np.ndarray): 2D boolean array of the awake chunks
+        chunk_size (int): Width and height of the chunks
+        flip (bool): Runs the right moving pass first, see step_vectorized
+        seed (int): Seed of the band's random generator for this tick
+    '''
+    types, colors, moved = band_planes
+    row_start, row_end, column_start, column_end = bounds
+    active = awake[np.ix_(np.arange(row_start, row_end) // chunk_size, np.arange(column_start, column_end) // chunk_size)]
+    band_moved = moved[row_start:row_end, column_start:column_end]
+    band_moved.fill(False)
+    step_vectorized(types[row_start:row_end, column_start:column_end], colors[row_start:row_end, column_start:column_end],
+                    np.random.default_rng(seed), flip=flip, active=active, moved=band_moved)
+
+class StripedStepper:
+    '''
+    Steps a grid in bands of columns at the same time over a pool of worker processes
+    The grid is copied into shared memory once, from then on the workers and the main process all work on the same bytes
+    '''
+    def __init__(self, grid, workers):
+        self.workers = workers
+        rows, columns = grid.rows, grid.columns
+        self.memory = shared_memory.SharedMemory(create=True, size=max(3 * rows * columns, 1))
+        types, colors, self.moved = shared_planes(self.memory, rows, columns)
+        types[...], colors[...] = grid.types, grid.colors
+        self.grid = ParticleGrid(rows, columns, types, colors)
+        self.pool = ProcessPoolExecutor(workers, initializer=attach_band_planes, initargs=(self.memory.name, rows, columns))
+
+    def bands(self, column_start, column_end, shift=False):
+        '''
+        Splits a range of columns into one band per worker, or fewer if the range is too narrow
+
+        Args:
+            column_start, column_end (int, int): The range of columns, end exclusive
+            shift (bool): Moves the edges between the bands over by half a band, so a liquid's run along a row that
+                          crosses an edge on one tick is inside a band on the next, see spread_liquid
+
+        Returns:
+            bands (list): (column_start, column_end) tuples, ends exclusive
+        '''
+        count = max(min(self.workers, (column_end - column_start) // MIN_BAND_WIDTH), 1)
+        edges = np.linspace(column_start, column_end, count + 1).astype(int)
+        width = (column_end - column_start) // count
+        if shift and width >= 2 * MIN_BAND_WIDTH:
+            edges[1:-1] += width // 2
+        edges = edges.tolist()
+        return list(zip(edges[:-1], edges[1:]))
+    def step(self, row_start, row_end, column_start, column_end, awake, chunk_size, flip, rng, shift=False):
+        '''
+        Steps a rectangle of the grid, every band in its own worker followed by the seam pass
+
+        Args:
+            row_start, row_end (int, int): The rows of the rectangle, end exclusive
+            column_start, column_end (int, int): The columns of the rectangle, end exclusive
+            awake (np.ndarray): 2D boolean array of the awake chunks
+            chunk_size (int): Width and height of the chunks
+            flip (bool): Runs the right moving pass first, see step_vectorized
+            rng (np.random.Generator): Seeds every band's generator and drives the seam pass
+            shift (bool): Moves the edges between the bands over by half a band, see bands
+
+        Returns:
+            moved (np.ndarray): 2D boolean array of the cells in the rectangle that changed
+        '''
+        bands = self.bands(column_start, column_end, shift)
+        seeds = rng.integers(0, 2**63, len(bands)).tolist()
+        futures = [self.pool.submit(step_band, (row_start, row_end, band_start, band_end), awake, chunk_size, flip, seed)
+                   for (band_start, band_end), seed in zip(bands, seeds)]
+        for future in futures:
+            future.result()
+
+        # seam pass, the last column of one band and the first column of the next are stepped together
+        # only the particles that haven't moved yet this tick can move, so the result is still one move per particle
+        row_chunks = np.arange(row_start, row_end) // chunk_size
+        for seam, _ in bands[1:]:
+            strip = slice(seam-1, seam+1)
+            active = awake[np.ix_(row_chunks, np.arange(seam-1, seam+1) // chunk_size)]
+            step_vectorized(self.grid.types[row_start:row_end, strip], self.grid.colors[row_start:row_end, strip],
+                            rng, flip=flip, active=active, moved=self.moved[row_start:row_end, strip])
+        return self.moved[row_start:row_end, column_start:column_end]
+    def close(self):
+        '''
+        Stops the worker processes and frees the shared memory
+        The grid's arrays are copied out of the shared memory first, so the grid stays usable afterwards
+        '''
+        self.pool.shutdown()
+        self.grid.types, self.grid.colors = self.grid.types.copy(), self.grid.colors.copy()
+        # drop every view of the block before closing it
+        self.grid = self.moved = None
+        self.memory.close()
+        self.memory.unlink()
+
+def render_rgb(grid, cell_size=1):
+    '''
+    Turns a particle grid into an RGB image buffer with every cell scaled up to cell_size x cell_size pixels
+
+    Args:
+        grid (ParticleGrid): The grid, or a slice of the grid, to render
+        cell_size (int): The width and height of a cell in pixels
+
+    Returns:
+        rgb (np.ndarray): uint8 array of shape (rows*cell_size, columns*cell_size, 3)
+    '''
+    rgb = PALETTE[grid.types, grid.colors]
+    if cell_size > 1:
+        rgb = np.repeat(np.repeat(rgb, cell_size, axis=0), cell_size, axis=1)
+    return rgb
+def render_ppm(grid, cell_size=1):
+    '''
+    Turns a particle grid into binary PPM image data, the cheapest format tk.PhotoImage can read a raw RGB buffer from
+
+    Args:
+        grid (ParticleGrid): The grid, or a slice of the grid, to render
+        cell_size (int): The width and height of a cell in pixels
+
+    Returns:
+        data (bytes): The PPM header followed by the RGB pixels
+    '''
+    rgb = render_rgb(grid, cell_size)
+    height, width = rgb.shape[:2]
+    return f"P6 {width} {height} 255 ".encode() + rgb.tobytes()
+
+
+# Scene files
+# A .sand v2 file is a little endian header followed by the compressed type and color planes:
+#   magic "SAND", version (uint16), compression (uint16), rows (uint32), columns (uint32),
+#   palette types (uint16), palette size (uint16), the palette's RGB bytes,
+#   then for each plane its byte length (uint64) and its bytes,
+#   then any number of tagged sections, a 4 byte tag, byte length (uint64) and bytes, that older readers skip
+SCENE_MAGIC   = b"SAND"
+SCENE_VERSION = 2
+SCENE_HEADER  = struct.Struct("<4sHHIIHH")
+SCENE_LENGTH  = struct.Struct("<Q")
+RAW_PLANES    = 0 # planes are stored as is, which lets load_scene memory-map them
+ZLIB_PLANES   = 1 # planes are compressed with zlib
+EMITTER_TAG   = b"EMIT" # section of the scene's emitters, an array of EMITTER_DTYPE
+SCENE_COMPRESSION_LEVEL = 1 # the planes are mostly long runs of the same byte, so the fastest level already shrinks them well
+SCENE_BLOCK_SIZE = 1 << 20  # planes are written and read this many bytes at a time, which paces the progress callbacks
+
+class LegacySceneUnpickler(pickle.Unpickler):
+    '''
+    Unpickler for .sand files saved before the v2 format
+    Only the NumPy classes needed to rebuild an array are allowed, so an untrusted file can't run arbitrary code
+    '''
+    ALLOWED = {"_reconstruct", "ndarray", "dtype", "scalar", "_frombuffer"}
+    def find_class(self, module, name):
+        if module.split(".")[0] == "numpy" and name in self.ALLOWED:
+            return super().find_class(module, name)
+        raise pickle.UnpicklingError(f"Refusing to load {module}.{name} from a legacy scene file")
+
+def save_scene(path, grid, compression=ZLIB_PLANES, sections=None, progress=None):
+    '''
+    Saves a particle grid as a .sand v2 file
+    The file is written next to the path first and then moved over it, so a save that fails halfway never leaves a broken scene behind
+
+    Args:
+        path (str): The [relative/absolute] path where to save the .sand file to
+        grid (ParticleGrid): The grid to save
+        compression (int): ZLIB_PLANES, or RAW_PLANES for a file that can be memory-mapped
+        sections (dict): Optional 4 byte tags mapped to extra bytes to store after the planes
+        progress (function): Optional callback given the fraction of the planes written so far, after every SCENE_BLOCK_SIZE bytes
+    '''
+    types = np.ascontiguousarray(grid.types)
+    # only the shades of jittered particle types matter, the rest are saved as shade 0 so they compress better
+    colors = np.where(VARIED_TABLE[types], grid.colors, 0).astype(np.uint8)
+    total = max(types.size + colors.size, 1)
+    written = 0
+    temporary = f"{path}.tmp"
+    with open(temporary, 'wb') as file:
+        file.write(SCENE_HEADER.pack(SCENE_MAGIC, SCENE_VERSION, compression, grid.rows, grid.columns, PALETTE.shape[0], PALETTE.shape[1]))
+        file.write(PALETTE.tobytes())
+        for plane in (types, colors):
+            data = memoryview(plane).cast('B')
+            # the length goes before the plane, a compressed plane's length is only known once it's written
+            length_offset = file.tell()
+            file.write(SCENE_LENGTH.pack(len(data)))
+            compressor = zlib.compressobj(SCENE_COMPRESSION_LEVEL) if compression == ZLIB_PLANES else None
+            for start in range(0, len(data), SCENE_BLOCK_SIZE):
+                block = data[start:start + SCENE_BLOCK_SIZE]
+                file.write(compressor.compress(block) if compressor else block)
+                written += len(block)
+                if progress:
+                    progress(written / total)
+            if compressor:
+                file.write(compressor.flush())
+                end = file.tell()
+                file.seek(length_offset)
+                file.write(SCENE_LENGTH.pack(end - length_offset - SCENE_LENGTH.size))
+                file.seek(end)
+        for tag, data in (sections or {}).items():
+            file.write(tag)
+            file.write(SCENE_LENGTH.pack(len(data)))
+            file.write(data)
+    os.replace(temporary, path)
+def remap_palette(types, colors, palette):
+    '''
+    Maps color indices saved with a different palette to the closest shades in the current PALETTE
+
+    Args:
+        types (np.ndarray): 2D array of particle types
+        colors (np.ndarray): 2D array of palette indices into the saved palette, changed in place
+        palette (np.ndarray): The palette the scene was saved with
+    '''
+    mapping = np.zeros(palette.shape[:2], dtype=np.uint8)
+    for particle_type in range(min(len(palette), len(PALETTE))):
+        distance = np.abs(palette[particle_type, :, None].astype(int) - PALETTE[particle_type, None, :]).sum(axis=2)
+        mapping[particle_type] = np.argmin(distance, axis=1)
+    known = types < len(mapping)
+    colors[known] = mapping[types[known], colors[known]]
+def create_world(path, rows, columns):
+    '''
+    Creates an empty uncompressed .sand v2 file of any size without writing its planes
+    The planes are left as a hole in a sparse file that reads back as AIR, so a huge world costs no disk space or time until it's painted on
+
+    Args:
+        path (str): The [relative/absolute] path where to create the .sand file
+        rows (int): The number of rows in the world
+        columns (int): The number of columns in the world
+    '''
+    with open(path, 'wb') as file:
+        file.write(SCENE_HEADER.pack(SCENE_MAGIC, SCENE_VERSION, RAW_PLANES, rows, columns, PALETTE.shape[0], PALETTE.shape[1]))
+        file.write(PALETTE.tobytes())
+        for _ in range(2):
+            file.write(SCENE_LENGTH.pack(rows * columns))
+            file.seek(rows * columns, 1)
+        file.truncate()
+def check_scene_types(types, path):
+    '''
+    Raises a ValueError if a loaded scene holds a particle type that isn't in the registry
+    The step looks every type up in the tables compiled from it, so a corrupt or crafted file would otherwise crash the simulation
+    partway through a step instead of failing to load
+
+    Args:
+        types (np.ndarray): The scene's particle types, before they're cast to uint8
+        path (str): The path of the scene, for the error message
+    '''
+    unknown = (types < 0) | (types >= len(MATERIALS))
+    if unknown.any():
+        raise ValueError(f"{path} holds particle type {types[unknown].flat[0]}, this version of PyFallingSand only knows types 0 to {len(MATERIALS)-1}")
+def load_scene(path, memory_map=False, writable=False, progress=None):
+    '''
+    Loads a .sand file, either the v2 format or an older pickled scene
+    Newer versions and files holding particle types that aren't in the registry raise a ValueError
+
+    Args:
+        path (str): The [absolute/relative] path to the .sand file to be loaded
+        memory_map (bool): Memory-maps the planes of an uncompressed v2 file instead of reading them, changes stay in memory and never reach the file
+        writable (bool): Changes to memory-mapped planes are written back to the file instead
+        progress (function): Optional callback given the fraction of the planes read so far, after every SCENE_BLOCK_SIZE bytes
+
+    Returns:
+        grid (ParticleGrid): The loaded grid
+        sections (dict): The file's extra tagged sections
+    '''
+    with open(path, 'rb') as file:
+        header = file.read(SCENE_HEADER.size)
+        if header[:len(SCENE_MAGIC)] != SCENE_MAGIC:
+            # scenes saved before the v2 format are pickled
+            file.seek(0)
+            return load_legacy_scene(file), {}
+        magic, version, compression, rows, columns, palette_types, palette_size = SCENE_HEADER.unpack(header)
+        if version > SCENE_VERSION:
+            raise ValueError(f"{path} is a version {version} scene, this version of PyFallingSand only reads up to version {SCENE_VERSION}")
+        palette = np.frombuffer(file.read(palette_types * palette_size * 3), dtype=np.uint8).reshape(palette_types, palette_size, 3)
+
+        planes = []
+        for index in range(2):
+            length, = SCENE_LENGTH.unpack(file.read(SCENE_LENGTH.size))
+            if compression == RAW_PLANES and memory_map:
+                planes.append(np.memmap(path, dtype=np.uint8, mode='r+' if writable else 'c', offset=file.tell(), shape=(rows, columns)))
+                file.seek(length, 1)
+                continue
+            # the plane is read a block at a time so a progress callback can follow along
+            decompressor = zlib.decompressobj() if compression == ZLIB_PLANES else None
+            plane = bytearray()
+            for start in range(0, length, SCENE_BLOCK_SIZE):
+                block = file.read(min(SCENE_BLOCK_SIZE, length - start))
+                plane += decompressor.decompress(block) if decompressor else block
+                if progress:
+                    progress((index + (start + len(block)) / length) / 2)
+            if decompressor:
+                plane += decompressor.flush()
+            planes.append(np.frombuffer(plane, dtype=np.uint8).reshape(rows, columns))
+
+        sections = {}
+        while True:
+            tag = file.read(4)
+            if len(tag) < 4:
+                break
+            length, = SCENE_LENGTH.unpack(file.read(SCENE_LENGTH.size))
+            sections[tag] = file.read(length)
+
+    types, colors = planes
+    check_scene_types(types, path)
+    if not np.array_equal(palette, PALETTE):
+        remap_palette(types, colors, palette)
+    return ParticleGrid(rows, columns, types, colors), sections
+def load_legacy_scene(file):
+    '''
+    Loads a pickled scene from before the v2 format
+
+    Args:
+        file (file): The open .sand file
+
+    Returns:
+        grid (ParticleGrid): The loaded grid
+    '''
+    scene = LegacySceneUnpickler(file).load()
+    # the first scenes were a single structured array, later ones a dictionary of the type and color arrays
+    if isinstance(scene, np.ndarray):
+        check_scene_types(scene["particle_type"], file.name)
+        return ParticleGrid.from_records(scene)
+    check_scene_types(scene["types"], file.name)
+    rows, columns = scene["types"].shape
+    return ParticleGrid(rows, columns, scene["types"].astype(np.uint8), scene["colors"].astype(np.uint8))
+
+# Background saves and loads
+AUTOSAVE_INTERVAL  = 300          # seconds between autosaves
+AUTOSAVE_KEEP      = 3            # autosaves kept, the oldest is dropped when a new one is written
+AUTOSAVE_DIRECTORY = "autosaves"  # where autosaves are written, relative to the working directory
+AUTOSAVE_NAME      = "autosave"   # autosaves are named autosave-1.sand (the newest) to autosave-<AUTOSAVE_KEEP>.sand
+
+class BackgroundFiles:
+    '''
+    Saves and loads scenes on a worker thread so the simulation never waits on the disk
+    A save copies the grid up front, so the simulation can keep changing it while the copy is written,
+    a load hands back the finished grid to be swapped in all at once with SandEngine.install_scene
+    One task runs at a time, zlib and file writes release the GIL so the worker barely slows the frame loop down
+    '''
+    def __init__(self):
+        self.pool     = ThreadPoolExecutor(max_workers=1)
+        self.task     = None  # Future of the running save or load
+        self.kind     = None  # "save", "autosave" or "load"
+        self.path     = None  # the file being saved or loaded
+        self.progress = 0.0   # fraction of the running task done, set from the worker thread
+    def busy(self):
+        '''
+        Returns:
+            busy (bool): If a save or load is still running
+        '''
+        return self.task is not None and not self.task.done()
+    def set_progress(self, fraction):
+        '''
+        Progress callback given to save_scene and load_scene on the worker thread
+
+        Args:
+            fraction (float): The fraction of the task done
+        '''
+        self.progress = fraction
+    def start(self, kind, path, function, *arguments):
+        '''
+        Runs a task on the worker thread unless one is already running
+
+        Args:
+            kind (str): "save", "autosave" or "load"
+            path (str): The file the task works on
+            function (function): The task
+            arguments: The task's arguments
+
+        Returns:
+            started (bool): If the task was started
+        '''
+        if self.task is not None:
+            return False
+        self.kind, self.path, self.progress = kind, path, 0.0
+        self.task = self.pool.submit(function, *arguments)
+        return True
+    def save(self, engine, path, compression=ZLIB_PLANES):
+        '''
+        Starts saving a copy of the engine's grid and emitters
+
+        Args:
+            engine (SandEngine): The engine to save
+            path (str): The [relative/absolute] path where to save the .sand file to
+            compression (int): ZLIB_PLANES, or RAW_PLANES for a file that can be memory-mapped
+
+        Returns:
+            started (bool): If the save was started, False while another task is running
+        '''
+        if self.task is not None:
+            return False
+        grid, sections = engine.snapshot()
+        return self.start("save", path, save_scene, path, grid, compression, sections, self.set_progress)
+    def autosave(self, engine, directory=AUTOSAVE_DIRECTORY, keep=AUTOSAVE_KEEP):
+        '''
+        Starts an autosave, the older autosaves move one number up and the one past keep is dropped
+
+        Args:
+            engine (SandEngine): The engine to save
+            directory (str): Where the autosaves are kept
+            keep (int): How many autosaves to keep
+
+        Returns:
+            started (bool): If the autosave was started, False while another task is running
+        '''
+        if self.task is not None:
+            return False
+        grid, sections = engine.snapshot()
+        path = os.path.join(directory, f"{AUTOSAVE_NAME}-1.sand")
+        return self.start("autosave", path, self.write_autosave, directory, keep, grid, sections)
+    def write_autosave(self, directory, keep, grid, sections):
+        '''
+        Writes an autosave on the worker thread, the older ones are only renamed once the new file is complete
+
+        Args:
+            directory (str): Where the autosaves are kept
+            keep (int): How many autosaves to keep
+            grid (ParticleGrid): The copy of the grid to save
+            sections (dict): The copy of the scene's extra sections
+
+        Returns:
+            path (str): The newest autosave
+        '''
+        os.makedirs(directory, exist_ok=True)
+        paths = [os.path.join(directory, f"{AUTOSAVE_NAME}-{number}.sand") for number in range(1, keep + 1)]
+        newest = os.path.join(directory, f"{AUTOSAVE_NAME}-new.sand")
+        save_scene(newest, grid, ZLIB_PLANES, sections, self.set_progress)
+        # oldest first so nothing is overwritten before it's moved
+        for number in range(keep - 1, 0, -1):
+            if os.path.exists(paths[number - 1]):
+                os.replace(paths[number - 1], paths[number])
+        os.replace(newest, paths[0])
+        return paths[0]
+    def load(self, path):
+        '''
+        Starts loading a scene, poll hands it back once it's read
+
+        Args:
+            path (str): The [absolute/relative] path to the .sand file to be loaded
+
+        Returns:
+            started (bool): If the load was started, False while another task is running
+        '''
+        return self.start("load", path, load_scene, path, False, False, self.set_progress)
+    def poll(self):
+        '''
+        Checks on the running task without waiting for it, the task's error is raised here when it failed
+
+        Returns:
+            finished (tuple): (kind, result) of a task that just finished, result is the saved path of a save or the
+            (grid, sections) of a load, None while the task is still running or when there's none
+        '''
+        if self.task is None or not self.task.done():
+            return None
+        task, kind = self.task, self.kind
+        self.task = self.kind = None
+        return kind, task.result()
+    def close(self):
+        '''
+        Waits for the running task to finish, a save in progress is never cut off
+        '''
+        self.pool.shutdown(wait=True)
+
+# Replay logs
+# A replay log is a little endian header followed by records, streamed to disk while the simulation runs:
+#   magic "SLOG", version (uint16), rows (uint32), columns (uint32), keyframe interval (uint32),
+#   then records of a 4 byte tag, the tick (uint64), the byte length of the data (uint64) and the data
+#   KEYF holds the whole grid after its tick, the type plane then the color plane, zlib compressed
+#   DELT holds the cells that changed during its tick, the gaps between their flat indices (uint32) then their new types and colors, zlib compressed
+#   EVNT holds an input event made before its tick, as UTF-8 JSON
+#   EMIT holds the emitters from its tick on, as a scene file's emitter section, zlib compressed, written when the log starts and whenever they change
+# Ticks where nothing changed have no record
+REPLAY_MAGIC   = b"SLOG"
+REPLAY_VERSION = 1
+REPLAY_HEADER  = struct.Struct("<4sHIII")
+REPLAY_RECORD  = struct.Struct("<4sQQ")
+KEYFRAME_TAG   = b"KEYF"
+DELTA_TAG      = b"DELT"
+EVENT_TAG      = b"EVNT"
+REPLAY_KEYFRAME_INTERVAL = 600 # ticks between keyframes, seeking never applies more deltas than this
+REPLAY_COMPRESSION       = 1   # zlib level of the records
+
+class ReplayWriter:
+    '''
+    Streams a replay log of a running simulation to disk, a keyframe of the whole grid every keyframe_interval ticks and
+    only the changed cells of the ticks in between, so memory use stays at one copy of the grid however long the session runs
+    '''
+    def __init__(self, path, grid, tick=0, keyframe_interval=REPLAY_KEYFRAME_INTERVAL):
+        '''
+        Args:
+            path (str): The [relative/absolute] path of the replay log
+            grid (ParticleGrid): The grid as it is when the log starts
+            tick (int): The current tick, the log's first keyframe
+            keyframe_interval (int): Ticks between keyframes
+        '''
+        self.path = path
+        self.keyframe_interval = max(keyframe_interval, 1)
+        self.file = open(path, 'wb')
+        self.file.write(REPLAY_HEADER.pack(REPLAY_MAGIC, REPLAY_VERSION, grid.rows, grid.columns, self.keyframe_interval))
+        # the grid as of the last record, the next delta is taken against it
+        self.previous = grid.copy()
+        self.keyframe(grid, tick)
+
+    def write_record(self, tag, tick, data):
+        '''
+        Appends one record to the log
+
+        Args:
+            tag (bytes): KEYFRAME_TAG, DELTA_TAG or EVENT_TAG
+            tick (int): The tick of the record
+            data (bytes): The record's data
+        '''
+        self.file.write(REPLAY_RECORD.pack(tag, tick, len(data)))
+        self.file.write(data)
+    def keyframe(self, grid, tick):
+        '''
+        Writes the whole grid as a keyframe
+
+        Args:
+            grid (ParticleGrid): The grid
+            tick (int): The tick the grid is at
+        '''
+        self.previous.types[...], self.previous.colors[...] = grid.types, grid.colors
+        self.write_record(KEYFRAME_TAG, tick, zlib.compress(self.previous.types.tobytes() + self.previous.colors.tobytes(), REPLAY_COMPRESSION))
+        self.last_keyframe = tick
+        self.file.flush()
+    def capture(self, grid, tick, busy=None, chunk_size=CHUNK_SIZE):
+        '''
+        Logs the cells that changed since the last tick, or a keyframe when one is due
+        Only the chunks that could have changed are compared, so a tick where the world is asleep costs next to nothing
+
+        Args:
+            grid (ParticleGrid): The grid after the tick
+            tick (int): The tick that just ran
+            busy (np.ndarray): 2D boolean array of the chunks that were awake or woken during the tick, None to compare the whole grid
+            chunk_size (int): Width and height of the chunks in busy
+        '''
+        if tick - self.last_keyframe >= self.keyframe_interval:
+            self.keyframe(grid, tick)
+            return
+        if busy is None:
+            busy = np.ones((-(-grid.rows // chunk_size), -(-grid.columns // chunk_size)), dtype=bool)
+        changed = []
+        # one rectangle per row of chunks, from its first busy chunk to its last, in order so the indices come out sorted
+        for chunk_row in np.flatnonzero(busy.any(axis=1)).tolist():
+            busy_columns = np.flatnonzero(busy[chunk_row])
+            row_start, row_end = chunk_row * chunk_size, min((chunk_row+1) * chunk_size, grid.rows)
+            column_start, column_end = busy_columns[0] * chunk_size, min((busy_columns[-1]+1) * chunk_size, grid.columns)
+            band = (slice(row_start, row_end), slice(column_start, column_end))
+            rows, columns = np.nonzero((grid.types[band] != self.previous.types[band]) | (grid.colors[band] != self.previous.colors[band]))
+            changed.append((rows + row_start) * grid.columns + columns + column_start)
+        changed = np.concatenate(changed) if changed else np.zeros(0, dtype=np.intp)
+        if changed.size == 0:
+            return
+        types, colors = grid.types.ravel(), grid.colors.ravel()
+        previous_types, previous_colors = self.previous.types.ravel(), self.previous.colors.ravel()
+        previous_types[changed], previous_colors[changed] = types[changed], colors[changed]
+        # the gaps between the changed cells are mostly small numbers, which compress much better than the indices themselves
+        data = np.diff(changed, prepend=0).astype("<u4").tobytes() + previous_types[changed].tobytes() + previous_colors[changed].tobytes()
+        self.write_record(DELTA_TAG, tick, zlib.compress(data, REPLAY_COMPRESSION))
+    def record_emitters(self, tick, emitters):
+        '''
+        Logs the emitters, the ones placed before the log started and every change since, so seeking shows the emitters of the tick
+
+        Args:
+            tick (int): The first tick the emitters are in place for
+            emitters (EmitterList): The emitters
+        '''
+        self.write_record(EMITTER_TAG, tick, zlib.compress(emitters.to_bytes(), REPLAY_COMPRESSION))
+    def event(self, tick, kind, **arguments):
+        '''
+        Logs an input event, like a brush stroke or an emitter being placed
+
+        Args:
+            tick (int): The tick the event happened before
+            kind (str): What happened, the name of the engine method
+            arguments: The JSON serializable arguments of the event
+        '''
+        # NumPy scalars, like the rows and columns of a location, are written as plain numbers
+        self.write_record(EVENT_TAG, tick, json.dumps({"kind": kind, **arguments}, default=lambda value: value.item()).encode())
+    def close(self):
+        '''
+        Writes out the rest of the log and closes the file
+        '''
+        self.file.close()
+
+class ReplayReader:
+    '''
+    Plays a replay log back, any tick is rebuilt from the keyframe before it and the deltas after that without running the simulation
+    Only the record headers are read when the log is opened, the records themselves are read as seeking needs them
+    '''
+    def __init__(self, path):
+        '''
+        Args:
+            path (str): The [absolute/relative] path of the replay log
+        '''
+        self.file = open(path, 'rb')
+        magic, version, self.rows, self.columns, self.keyframe_interval = REPLAY_HEADER.unpack(self.file.read(REPLAY_HEADER.size))
+        if magic != REPLAY_MAGIC:
+            raise ValueError(f"{path} isn't a replay log")
+        if version > REPLAY_VERSION:
+            raise ValueError(f"{path} is a version {version} replay log, this version of PyFallingSand only reads up to version {REPLAY_VERSION}")
+        keyframes, deltas, emitters, self.events = [], [], [], []
+        size = os.fstat(self.file.fileno()).st_size
+        while True:
+            header = self.file.read(REPLAY_RECORD.size)
+            if len(header) < REPLAY_RECORD.size:
+                break
+            tag, tick, length = REPLAY_RECORD.unpack(header)
+            offset = self.file.tell()
+            # a log cut off mid record (the session crashed) still plays back up to its last whole record
+            if offset + length > size:
+                break
+            if tag == EVENT_TAG:
+                self.events.append((tick, json.loads(self.file.read(length))))
+            elif tag == KEYFRAME_TAG:
+                keyframes.append((tick, offset, length))
+            elif tag == DELTA_TAG:
+                deltas.append((tick, offset, length))
+            elif tag == EMITTER_TAG:
+                emitters.append((tick, offset, length))
+            self.file.seek(offset + length)
+        self.keyframes = np.array(keyframes, dtype=np.int64).reshape(-1, 3)
+        self.deltas    = np.array(deltas, dtype=np.int64).reshape(-1, 3)
+        self.emitters  = np.array(emitters, dtype=np.int64).reshape(-1, 3)
+        if len(self.keyframes) == 0:
+            raise ValueError(f"{path} has no keyframe")
+        self.first_tick = int(self.keyframes[0, 0])
+        self.last_tick  = int(max(self.keyframes[-1, 0], self.deltas[-1, 0] if len(self.deltas) else 0))
+        # the tick the grid was last rebuilt at, seeking forward from it only applies the deltas in between
+        self.grid = ParticleGrid(self.rows, self.columns)
+        self.tick = None
+
+    def __len__(self):
+        return self.last_tick - self.first_tick + 1
+    def read(self, offset, length):
+        '''
+        Returns:
+            data (bytes): The decompressed data of the record at offset
+        '''
+        self.file.seek(offset)
+        return zlib.decompress(self.file.read(length))
+    def seek(self, tick):
+        '''
+        Rebuilds the grid as it was after a tick
+
+        Args:
+            tick (int): The tick, clamped to the ticks in the log
+
+        Returns:
+            grid (ParticleGrid): A copy of the grid at that tick
+        '''
+        tick = min(max(tick, self.first_tick), self.last_tick)
+        keyframe = np.searchsorted(self.keyframes[:, 0], tick, side='right') - 1
+        keyframe_tick, offset, length = self.keyframes[keyframe].tolist()
+        if self.tick is None or not keyframe_tick <= self.tick <= tick:
+            data = np.frombuffer(self.read(offset, length), dtype=np.uint8)
+            self.grid.types[...]  = data[:self.rows * self.columns].reshape(self.rows, self.columns)
+            self.grid.colors[...] = data[self.rows * self.columns:].reshape(self.rows, self.columns)
+            self.tick = keyframe_tick
+        types, colors = self.grid.types.ravel(), self.grid.colors.ravel()
+        start, end = np.searchsorted(self.deltas[:, 0], [self.tick, tick], side='right')
+        for _, offset, length in self.deltas[start:end].tolist():
+            data = self.read(offset, length)
+            count = len(data) // 6
+            changed = np.cumsum(np.frombuffer(data, dtype="<u4", count=count), dtype=np.int64)
+            types[changed]  = np.frombuffer(data, dtype=np.uint8, count=count, offset=4 * count)
+            colors[changed] = np.frombuffer(data, dtype=np.uint8, offset=5 * count)
+        self.tick = tick
+        return self.grid.copy()
+    def sections(self, tick):
+        '''
+        Returns the scene's extra tagged sections as they were at a tick, like the emitters
+
+        Args:
+            tick (int): The tick
+
+        Returns:
+            sections (dict): The sections, the same as a loaded scene file's
+        '''
+        record = np.searchsorted(self.emitters[:, 0], tick, side='right') - 1
+        if record < 0:
+            return {}
+        _, offset, length = self.emitters[record].tolist()
+        return {EMITTER_TAG: self.read(offset, length)}
+    def events_until(self, tick):
+        '''
+        Returns:
+            events (list): The (tick, event) of every input event made up to the tick
+        '''
+        return [(event_tick, event) for event_tick, event in self.events if event_tick <= tick]
+    def close(self):
+        '''
+        Closes the log file
+        '''
+        self.file.close()
+
+# Instrumentation
+PROFILE_PHASES   = ("input", "simulate", "render")              # timed phases of a frame, in seconds
+PROFILE_COUNTERS = ("swaps", "dirty_cells", "canvas_items")     # counted events of a frame
+PROFILE_SAMPLES  = 600                                          # frames kept in the ring buffer, 10 seconds at 60 FPS
+
+class Profiler:
+    '''
+    Per-phase timers, counters and a fixed-size ring buffer of frame samples
+    It's turned off by default, and every method returns straight away while it's off so the hooks cost next to nothing
+    '''
+    def __init__(self, capacity=PROFILE_SAMPLES, enabled=False):
+        self.enabled  = enabled
+        self.fields   = PROFILE_PHASES + PROFILE_COUNTERS
+        self.index    = {field: index for index, field in enumerate(self.fields)}
+        self.start_time = time.perf_counter()
+        # ring buffer of samples, each row is the frame's time followed by every field
+        self.samples      = np.zeros((capacity, len(self.fields) + 1))
+        self.sample_count = 0
+        # the frame being measured
+        self.current      = np.zeros(len(self.fields))
+        self.phase_starts = {}
+
+    def start(self, phase):
+        '''
+        Starts timing a phase of the current frame
+
+        Args:
+            phase (str): One of PROFILE_PHASES
+        '''
+        if not self.enabled:
+            return
+        self.phase_starts[phase] = time.perf_counter()
+    def stop(self, phase):
+        '''
+        Stops timing a phase and adds the time to the current frame
+
+        Args:
+            phase (str): One of PROFILE_PHASES
+        '''
+        if not self.enabled or phase not in self.phase_starts:
+            return
+        self.current[self.index[phase]] += time.perf_counter() - self.phase_starts.pop(phase)
+    def count(self, counter, amount=1):
+        '''
+        Adds to a counter of the current frame
+
+        Args:
+            counter (str): One of PROFILE_COUNTERS
+            amount (int): How much to add
+        '''
+        if not self.enabled:
+            return
+        self.current[self.index[counter]] += amount
+    def end_frame(self):
+        '''
+        Stores the current frame in the ring buffer and starts a new one
+        '''
+        if not self.enabled:
+            return
+        row = self.samples[self.sample_count % len(self.samples)]
+        row[0] = time.perf_counter() - self.start_time
+        row[1:] = self.current
+        self.sample_count += 1
+        self.current.fill(0)
+    def set_enabled(self, enabled):
+        '''
+        Turns the profiler on or off, turning it on starts a fresh set of samples
+
+        Args:
+            enabled (bool): Whether to record samples
+        '''
+        if enabled and not self.enabled:
+            self.sample_count = 0
+            self.current.fill(0)
+            self.phase_starts.clear()
+            self.start_time = time.perf_counter()
+        self.enabled = enabled
+    def ordered_samples(self):
+        '''
+        Returns the samples in the ring buffer from oldest to newest
+        '''
+        capacity = len(self.samples)
+        if self.sample_count <= capacity:
+            return self.samples[:self.sample_count]
+        return np.roll(self.samples, -(self.sample_count % capacity), axis=0)
+    def averages(self):
+        '''
+        Averages every field over the samples in the ring buffer
+
+        Returns:
+            averages (dict): Field name mapped to its average per frame
+        '''
+        samples = self.ordered_samples()
+        if len(samples) == 0:
+            return dict.fromkeys(self.fields, 0.0)
+        return dict(zip(self.fields, samples[:, 1:].mean(axis=0).tolist()))
+    def to_csv(self, path):
+        '''
+        Writes the samples in the ring buffer to a CSV file
+
+        Args:
+            path (str): The [relative/absolute] path of the CSV file
+        '''
+        header = ",".join(("time",) + self.fields)
+        np.savetxt(path, self.ordered_samples(), delimiter=",", header=header, comments="", fmt="%.9g")
+
+# Scheduling
+TICK_RATE          = 60 # simulation ticks per second, independent of how fast frames are drawn
+MAX_CATCH_UP_TICKS = 5  # most ticks run for one frame, any time past that is dropped so a slow frame can't snowball
+BEHIND_TICKS       = 3  # a frame that needs this many ticks is behind and skips drawing to catch up
+MAX_SKIPPED_FRAMES = 3  # most frames in a row that can skip drawing while the simulation catches up
+
+class FixedTimestep:
+    '''
+    Runs the simulation at a fixed tick rate no matter how long drawing takes
+    Elapsed time goes into an accumulator that's paid out in whole ticks, so a slow frame runs several ticks and a fast frame may run none
+    '''
+    def __init__(self, tick_rate=TICK_RATE, max_catch_up_ticks=MAX_CATCH_UP_TICKS, behind_ticks=BEHIND_TICKS, max_skipped_frames=MAX_SKIPPED_FRAMES):
+        self.tick_rate          = tick_rate
+        self.tick_interval      = 1 / tick_rate
+        self.max_catch_up_ticks = max_catch_up_ticks
+        self.behind_ticks       = behind_ticks
+        self.max_skipped_frames = max_skipped_frames
+        self.accumulator    = 0.0
+        self.last_time      = None
+        self.pending_draw   = False # ticks have run since the last drawn frame
+        self.skipped_frames = 0
+        self.dropped_ticks  = 0     # ticks thrown away by the catch-up cap
+        # counts since the rates were last measured
+        self.tick_count  = 0
+        self.frame_count = 0
+        self.rate_time   = None
+
+    def advance(self, now):
+        '''
+        Adds the time since the last call to the accumulator and works out what this frame has to do
+
+        Args:
+            now (float): The current time in seconds, from time.perf_counter()
+
+        Returns:
+            ticks (int): How many simulation ticks to run this frame
+            draw (bool): Whether to draw this frame
+        '''
+        if self.last_time is None:
+            self.last_time = now
+        if self.rate_time is None:
+            self.rate_time = now
+        self.accumulator += now - self.last_time
+        self.last_time = now
+
+        ticks = int(self.accumulator // self.tick_interval)
+        if ticks > self.max_catch_up_ticks:
+            # too far behind to ever catch up, drop the rest instead of spiraling
+            self.dropped_ticks += ticks - self.max_catch_up_ticks
+            ticks = self.max_catch_up_ticks
+            self.accumulator = self.tick_interval * ticks
+        self.accumulator -= ticks * self.tick_interval
+        self.tick_count += ticks
+        if ticks:
+            self.pending_draw = True
+
+        # needing several ticks means drawing is holding the simulation back, so skip a few frames to let it catch up
+        draw = self.pending_draw and (ticks < self.behind_ticks or self.skipped_frames >= self.max_skipped_frames)
+        if draw:
+            self.pending_draw = False
+            self.skipped_frames = 0
+            self.frame_count += 1
+        elif ticks:
+            self.skipped_frames += 1
+        return ticks, draw
+    def delay(self):
+        '''
+        Returns how long to wait until the next tick is due
+
+        Returns:
+            delay (float): Seconds until the accumulator holds a whole tick
+        '''
+        return max(self.tick_interval - self.accumulator, 0.0)
+    def rates(self, now):
+        '''
+        Measures the tick rate and frame rate since the last call
+
+        Args:
+            now (float): The current time in seconds, from time.perf_counter()
+
+        Returns:
+            tick_rate (float): Simulation ticks per second
+            frame_rate (float): Drawn frames per second
+        '''
+        if self.rate_time is None or now <= self.rate_time:
+            return 0.0, 0.0
+        elapsed = now - self.rate_time
+        tick_rate, frame_rate = self.tick_count / elapsed, self.frame_count / elapsed
+        self.tick_count = self.frame_count = 0
+        self.rate_time = now
+        return tick_rate, frame_rate
+    def reset(self):
+        '''
+        Empties the accumulator so time spent away (a dialog, a load) isn't caught up on afterwards
+        '''
+        self.accumulator = 0.0
+        self.last_time = None
+
+class SandEngine:
+    '''
+    The falling sand simulation without any tkinter code
+    Holds the particle grid, the particle rules and the stepping so it can run headless or behind the FallingSand window
+    '''
+    def __init__(self, rows, columns, step_mode=VECTORIZED_STEP, track_updates=True, seed=None, workers=None):
+        # Simulation Variables
+        self.rows    = rows
+        self.columns = columns
+        # Creates a grid of size [rows][columns] filled with AIR, stored as a uint8 type array and a uint8 palette index array
+        self.particle_grid = ParticleGrid(rows, columns)
+        self.chunks = ChunkScheduler(rows, columns)
+        self.active = ActiveIndex(self.particle_grid.types)
+        self.reactions = ReactionList(rows, columns)
+        self.emitters  = EmitterList()
+        self.history   = EditHistory(rows, columns)
+        self.replay    = None # the ReplayWriter logging every tick, while a replay is recorded
+        # the file and memory-mapped grid of the world opened with open_world, scenes loaded while it's open are written into it
+        self.world_path = None
+        self.world_grid = None
+        # the cells that changed since the view last drew them, headless runs have nothing to draw so they can turn this off
+        self.track_updates = track_updates
+        self.dirty = DirtyRegions(rows, columns)
+
+        # Step settings
+        self.step_mode = step_mode
+        self.step_count = 0
+        # every random choice of the simulation comes from here, a fixed seed makes a run repeatable
+        self.random = RandomBlocks(seed)
+        # the parallel step's worker processes, started on its first step
+        self.workers = workers or os.cpu_count() or 1
+        self.striped = None
+        # chunks the Margolus step kept awake for this tick only, to try the other block offset
+        self.margolus_kept = None
+        # cells the scalar step swapped this tick, see wake_runs
+        self.swapped = []
+
+        # Stats
+        self.profiler = Profiler()
+        self.last_step_count = 0    # how many steps the last call to step() ran
+        self.last_step_time  = 0.0  # how many seconds the last call to step() took
+
+    # Saving/Loading methods
+    def save(self, path, compression=ZLIB_PLANES):
+        '''
+        Saves the current particle_grid to the specified path
+
+        Args:
+            path (str): The [relative/absolute] path where to save the .sand file to
+            compression (int): ZLIB_PLANES, or RAW_PLANES for a file that can be memory-mapped
+        '''
+        save_scene(path, self.particle_grid, compression, self.scene_sections())
+    def scene_sections(self):
+        '''
+        Returns:
+            sections (dict): The extra tagged sections saved with the scene, None when there are none
+        '''
+        return {EMITTER_TAG: self.emitters.to_bytes()} if len(self.emitters) else None
+    def snapshot(self):
+        '''
+        Copies the scene so it can be saved while the simulation goes on
+
+        Returns:
+            grid (ParticleGrid): A copy of the particle_grid
+            sections (dict): The scene's extra tagged sections
+        '''
+        return self.particle_grid.copy(), self.scene_sections()
+    def load(self, path, memory_map=False, writable=False):
+        '''
+        Loads the file at the specified path and dumps it into the particle_grid
+        
+        Args:
+            path (str): The [absolute/relative] path to the .sand file to be loaded
+            memory_map (bool): Memory-maps the grid of an uncompressed scene instead of reading it into memory
+            writable (bool): Writes the changes to a memory-mapped grid back to the file
+        '''
+        self.install_scene(*load_scene(path, memory_map, writable))
+    def install_scene(self, grid, sections):
+        '''
+        Swaps a loaded scene in for the current one, along with everything kept about the old grid
+        While a world is open the scene is copied into the world's memory-mapped grid instead, so the changes keep reaching its file,
+        a scene of another size is refused with a ValueError and the world carries on as it was
+
+        Args:
+            grid (ParticleGrid): The loaded grid
+            sections (dict): The scene's extra tagged sections
+        '''
+        world = self.world_grid
+        if world is not None and grid is not world:
+            if (grid.rows, grid.columns) != (world.rows, world.columns):
+                raise ValueError(f"a {grid.rows}x{grid.columns} scene doesn't fit the {world.rows}x{world.columns} world open from {self.world_path}")
+            world.types[...], world.colors[...] = grid.types, grid.colors
+            grid = world
+        self.close()
+        # a replay log only covers the scene it was started on
+        self.stop_replay()
+        self.particle_grid = grid
+        self.rows, self.columns = self.particle_grid.rows, self.particle_grid.columns
+        self.emitters.load_bytes(sections.get(EMITTER_TAG, b""), self.rows, self.columns)
+        # every chunk of the new scene starts awake
+        self.chunks = ChunkScheduler(self.rows, self.columns)
+        self.active = ActiveIndex(self.particle_grid.types)
+        self.reactions.rebuild(self.particle_grid.types, self.random.generator)
+        self.history = EditHistory(self.rows, self.columns)
+        self.dirty  = DirtyRegions(self.rows, self.columns)
+        self.dirty.mark_all()
+    def open_world(self, path, rows=None, columns=None):
+        '''
+        Opens a world memory-mapped straight from its scene file, creating an empty one first when there's no file yet
+        Every change is written back to the file, which lets the OS page the world in and out instead of holding all of it in memory
+
+        Args:
+            path (str): The [absolute/relative] path to the uncompressed .sand file of the world
+            rows (int): The number of rows of a new world
+            columns (int): The number of columns of a new world
+        '''
+        if not os.path.exists(path):
+            if rows is None or columns is None:
+                raise ValueError(f"{path} doesn't exist, a new world needs its rows and columns")
+            create_world(path, rows, columns)
+        self.close_world()
+        self.load(path, memory_map=True, writable=True)
+        self.world_path, self.world_grid = path, self.particle_grid
+    def close_world(self):
+        '''
+        Writes the open world's changes back to its file and lets go of it, the next scene installed replaces the grid instead of
+        being copied into the world, like a replay that shouldn't overwrite the world it was recorded on
+        '''
+        if self.world_grid is None:
+            return
+        for plane in (self.world_grid.types, self.world_grid.colors):
+            plane.flush()
+        self.world_path = self.world_grid = None
+    def page_out(self):
+        '''
+        Writes a memory-mapped world's changes back to its file, then lets the OS drop the pages of the bands of rows where
+        every chunk is asleep and out of focus, they're read back from the file the next time they're touched
+
+        Returns:
+            dropped (int): How many rows were paged out
+        '''
+        planes = [plane for plane in (self.particle_grid.types, self.particle_grid.colors) if isinstance(plane, np.memmap) and plane.mode == 'r+']
+        if not planes:
+            return 0
+        chunks = self.chunks
+        busy = chunks.awake | chunks.next_awake
+        if chunks.focus is not None:
+            busy |= chunks.focus
+        idle = ~busy.any(axis=1)
+        # runs of idle chunk rows as grid rows
+        edges = np.flatnonzero(np.diff(np.concatenate(([False], idle, [False])).astype(np.int8)))
+        runs = [(start * chunks.chunk_size, min(end * chunks.chunk_size, self.rows)) for start, end in zip(edges[::2].tolist(), edges[1::2].tolist())]
+        for plane in planes:
+            plane.flush()
+            mapping = getattr(plane, "_mmap", None)
+            if mapping is None or not hasattr(mapping, "madvise"):
+                continue
+            # the mapping starts at the page boundary below the plane's offset in the file
+            start_offset = plane.offset % mmap.ALLOCATIONGRANULARITY
+            for row_start, row_end in runs:
+                start = -(-(start_offset + row_start * self.columns) // mmap.PAGESIZE) * mmap.PAGESIZE
+                end = (start_offset + row_end * self.columns) // mmap.PAGESIZE * mmap.PAGESIZE
+                if start < end:
+                    mapping.madvise(mmap.MADV_DONTNEED, start, end - start)
+        return sum(row_end - row_start for row_start, row_end in runs)
+    def set_focus(self, bounds):
+        '''
+        Sets the part of the world that's simulated every tick, usually the part on screen, the awake chunks outside of it
+        are only simulated every OFFSCREEN_STEP_INTERVAL ticks
+
+        Args:
+            bounds (int, int, int, int): (row_start, row_end, column_start, column_end), or None to simulate everything every tick
+        '''
+        self.chunks.set_focus(bounds)
+    def reset(self):
+        '''
+        Erases every particle and emitter in the grid
+        '''
+        self.log_event("reset")
+        self.history.touch(self.particle_grid, 0, self.rows, 0, self.columns)
+        self.particle_grid.fill(AIR)
+        self.emitters.clear()
+        self.record_emitters()
+        self.refresh()
+    def refresh(self):
+        '''
+        Wakes every chunk, rebuilds the active particle index and reaction list and marks the whole grid to be redrawn
+        Call this after writing to the particle_grid's arrays directly instead of through place_particle
+        '''
+        self.chunks.wake_all()
+        self.active.rebuild(self.particle_grid.types)
+        self.reactions.rebuild(self.particle_grid.types, self.random.generator)
+        self.dirty.mark_all()
+
+    # Replay methods
+    def start_replay(self, path, keyframe_interval=REPLAY_KEYFRAME_INTERVAL):
+        '''
+        Starts streaming a replay log of every tick and input event to a file, replacing the replay being recorded
+
+        Args:
+            path (str): The [relative/absolute] path of the replay log
+            keyframe_interval (int): Ticks between keyframes of the whole grid
+        '''
+        self.stop_replay()
+        self.replay = ReplayWriter(path, self.particle_grid, self.step_count, keyframe_interval)
+        self.replay.record_emitters(self.step_count, self.emitters)
+    def stop_replay(self):
+        '''
+        Stops recording the replay log, if one is being recorded
+        '''
+        if self.replay is None:
+            return
+        self.replay.close()
+        self.replay = None
+    def log_event(self, kind, **arguments):
+        '''
+        Logs an input event to the replay being recorded, if there is one
+
+        Args:
+            kind (str): What happened, the name of the engine method
+            arguments: The JSON serializable arguments of the event
+        '''
+        if self.replay:
+            self.replay.event(self.step_count, kind, **arguments)
+    def record_emitters(self):
+        '''
+        Logs the emitters to the replay being recorded after they changed, if there is one, they're in place from the next tick on
+        '''
+        if self.replay:
+            self.replay.record_emitters(self.step_count + 1, self.emitters)
+
+    # Undo/redo methods
+    def begin_edit(self):
+        '''
+        Starts recording an edit, every particle placed, painted or reset until end_edit is undone together
+        '''
+        self.history.begin()
+    def end_edit(self):
+        '''
+        Stops recording the edit and adds it to the undo history if it changed anything
+
+        Returns:
+            recorded (bool): If the edit was added to the history
+        '''
+        return self.history.end(self.particle_grid)
+    def undo(self):
+        '''
+        Undoes the last edit, only the chunks it changed are written back
+
+        Returns:
+            undone (bool): If there was an edit to undo
+        '''
+        self.end_edit()
+        self.log_event("undo")
+        return self.restore_chunks(self.history.undo(self.particle_grid))
+    def redo(self):
+        '''
+        Redoes the last undone edit
+
+        Returns:
+            redone (bool): If there was an edit to redo
+        '''
+        self.end_edit()
+        self.log_event("redo")
+        return self.restore_chunks(self.history.redo(self.particle_grid))
+    def restore_chunks(self, written):
+        '''
+        Brings the index, reactions and chunks up to date after the history wrote chunks of the grid, and marks just those to be redrawn
+
+        Args:
+            written (list): The (row_start, row_end, column_start, column_end) of every chunk written
+
+        Returns:
+            restored (bool): If any chunk was written
+        '''
+        types = self.particle_grid.types
+        for bounds in written:
+            row_start, row_end, column_start, column_end = bounds
+            self.active.rebuild_region(types[row_start:row_end, column_start:column_end], row_start, column_start)
+            self.reactions.rebuild_region(types, bounds, self.random.generator)
+            self.chunks.wake_rectangle(row_start, row_end, column_start, column_end)
+            if self.track_updates:
+                self.dirty.mark_rectangle(row_start, row_end, column_start, column_end)
+        return bool(written)
+
+    # Helper methods
+    def vary_color(self):
+        '''
+        Picks a random shade from the palette, which gives a slightly varied color for particle types in VARIED_PARTICLES
+        
+        Returns:
+            varied_color (int): A palette index
+        '''
+        varied_color = self.random.shade()
+        return varied_color
+
+    # Particle methods
+    def swap_particles(self, particle_1, particle_2):
+        '''
+        Swap the particles at the input grid location tuples
+
+        Args:
+            particle_1 (int, int): Tuple of integers representing the row and column of a particle to be swapped
+            particle_2 (int, int): Tuple of integers representing the row and column of a particle to be swapped
+        '''
+        p1_row, p1_column = particle_1
+        p2_row, p2_column = particle_2
+
+        self.particle_grid.swap(particle_1, particle_2)
+        self.active.swap(particle_1, particle_2)
+        self.chunks.wake_cell(p1_row, p1_column)
+        self.chunks.wake_cell(p2_row, p2_column)
+        self.swapped.extend((particle_1, particle_2))
+        if self.profiler.enabled:
+            self.profiler.count("swaps")
+
+        # Flag both cells to be redrawn
+        if self.track_updates:
+            self.dirty.mark(p1_row, p1_column)
+            self.dirty.mark(p2_row, p2_column)
+    def update_powder(self, powder_location):
+        '''
+        The update logic for powder particles like sand
+
+        Args:
+            powder_location (int,int): A tuple containing the grid location of the powder particle
+        '''
+        row, column = powder_location
+        types = self.particle_grid.types
+        passable = PASSABLE_LIST[types[row, column]]
+
+        # if the particle is at the bottom of the grid(or somehow past it)
+        if row >= self.rows-1:
+            # do nothing
+            return
+
+        # Identify the particle below our powder location
+        particle_below = types[row+1, column]
+        # Is particle_below lighter and not static, like AIR or WATER under sand?
+        if passable[particle_below]:
+            # A liquid is pushed aside to the surface next to the powder sinking into it, instead of rising up through the powder
+            open_cell = self.find_open_cell(powder_location) if MOBILITY_LIST[particle_below] == LIQUID else None
+            # Swap the powder particle to that location
+            self.swap_particles(powder_location, (row+1, column))
+            if open_cell is not None:
+                # the liquid now in our old location moves on to the open cell, leaving AIR behind
+                self.swap_particles(powder_location, open_cell)
+            return
+        # If the particle below can't be sunk through
+
+        # pick a random direction
+        direction = self.random.direction()
+        # if that direction isn't in bounds or if direction is 0
+        if not (0 <= column + direction < self.columns) or direction == 0:
+            # do nothing
+            return
+        # else that direction is in bounds
+        
+        # Can the particle diagonally down in that direction be sunk through?
+        particle_diagonal = types[row+1, column+direction]
+        particle_adjacent = types[row, column+direction] # adding this stops the particle from slipping down diagonal gaps in walls
+        if passable[particle_diagonal] and passable[particle_adjacent]:
+            # Swap the powder particle to that location
+            self.swap_particles(powder_location, (row+1, column+direction))
+            #return
+        # if you've reached here, then do nothing
+    def find_open_cell(self, powder_location):
+        '''
+        Finds where the liquid under a sinking powder particle is pushed aside to, the same search as displace_liquid
+        Each row of the column of powder, from this particle up, looks both ways through the liquid for the nearest AIR cell
+
+        Args:
+            powder_location (int,int): A tuple containing the grid location of the powder particle, with a liquid below it
+
+        Returns:
+            open_cell (int,int): The grid location of the AIR cell the liquid goes to, None if there isn't one within the liquid's dispersion
+        '''
+        row, column = powder_location
+        types = self.particle_grid.types
+        powder, liquid = types[row, column], types[row+1, column]
+        reach = DISPERSION_LIST[liquid]
+        # the side looked at first alternates from column to column so neither side is favoured
+        first_side = column % 2 * 2 - 1
+        # walk up the column of powder, lowest row first
+        while row >= 0 and types[row, column] == powder:
+            sides = [first_side, -first_side]
+            for step in range(1, reach+1):
+                for side in list(sides):
+                    target = column + side*step
+                    # is that cell out of bounds?
+                    if not (0 <= target < self.columns):
+                        sides.remove(side)
+                        continue
+                    if types[row, target] == AIR:
+                        return (row, target)
+                    # the search only carries on through the liquid itself
+                    if types[row, target] != liquid:
+                        sides.remove(side)
+                if not sides:
+                    break
+            row -= 1
+        return None
+    def update_liquid(self, liquid_location):
+        '''
+        The update logic for liquid particles like water
+        A resting liquid looks along its row in a random direction, then the other one, through the cells it can flow into and the particles
+        of its own liquid up to the first gap past them, for the nearest cell with somewhere lower under it and flows towards it by up to its dispersion.
+        With nowhere lower it stays still, so a level pool can fall asleep
+
+        Args:
+            liquid_location (int,int): A tuple containing the grid location of the liquid particle
+        '''
+        row, column = liquid_location
+        types = self.particle_grid.types
+        particle_type = types[row, column]
+        passable = PASSABLE_LIST[particle_type]
+
+        # if the particle is at the bottom of the grid(or somehow past it)
+        if row >= self.rows-1:
+            # there's nowhere lower to go, do nothing
+            return
+
+        # else that particle is not at the bottom of the grid
+
+        # Identify the particle below our location
+        # Can particle_below be sunk through?
+        if passable[types[row+1, column]]:
+            # Swap the liquid particle to that location
+            self.swap_particles(liquid_location, (row+1, column))
+            return
+        # else the particle_below can't be sunk through
+
+        # pick a random direction, and look the other way if there's nowhere lower that way
+        direction = self.random.side()
+        for direction in (direction, -direction):
+            # is there no room to flow that way at all?
+            if not (0 <= column+direction < self.columns) or not passable[types[row, column+direction]]:
+                continue
+            # scan along the cells in that direction that can be flowed into, like AIR for water, and the particles of the same liquid
+            reach = column # the last cell it can flow into before running into another particle
+            target = column + direction
+            while 0 <= target < self.columns:
+                if passable[types[row, target]]:
+                    if reach == target - direction:
+                        reach = target
+                    # Can the particle below that cell be sunk through?
+                    if passable[types[row+1, target]]:
+                        break
+                    if reach != target:
+                        # a gap past the liquid ahead, the particle next to it flows into it first
+                        target = None
+                        break
+                elif types[row, target] != particle_type:
+                    # something's in the way
+                    target = None
+                    break
+                target += direction
+            else:
+                target = None
+            # is there somewhere lower that way?
+            if target is not None:
+                # Swap the liquid particle towards that location, as far as its dispersion goes, it falls once it gets there
+                distance = min(abs(reach - column), DISPERSION_LIST[particle_type])
+                self.swap_particles(liquid_location, (row, column + direction*distance))
+                return
+        # if you've reached here, then do nothing
+    def replace_cells(self, rows, columns, types):
+        '''
+        Replaces many particles at once, every new particle gets a random shade
+
+        Args:
+            rows (np.ndarray): The rows of the particles to replace, no cell may be listed twice
+            columns (np.ndarray): The columns of the particles to replace
+            types (int or np.ndarray): The particle types to replace them with
+        '''
+        if rows.size == 0:
+            return
+        types = np.broadcast_to(np.asarray(types, dtype=np.uint8), rows.shape)
+        self.particle_grid.types[rows, columns] = types
+        self.particle_grid.colors[rows, columns] = self.random.generator.integers(0, PALETTE_SIZE, rows.size, dtype=np.uint8)
+        self.active.set_cells(rows, columns, types)
+        self.chunks.wake_cells(rows, columns)
+        if self.track_updates:
+            self.dirty.mark_cells(rows, columns)
+    def fade_particles(self):
+        '''
+        Fades away the particles that have a fade chance, like smoke, into AIR
+        They're all movable so only the boxes the step just worked on are searched, and the chunks holding the ones
+        that are left are kept awake so smoke that came to rest under a ceiling still fades away
+        '''
+        size = self.chunks.chunk_size
+        for row_start, row_end, column_start, column_end in self.awake_regions().values():
+            chances = FADE_TABLE[self.particle_grid.types[row_start:row_end, column_start:column_end]]
+            rows, columns = np.nonzero(chances)
+            fading = self.random.generator.random(rows.size, dtype=np.float32) < chances[rows, columns]
+            self.replace_cells(rows[fading] + row_start, columns[fading] + column_start, AIR)
+            self.chunks.next_awake[(rows[~fading] + row_start) // size, (columns[~fading] + column_start) // size] = True
+    def update_reactions(self):
+        '''
+        Burns every particle in the reaction list for a tick
+        A burning particle next to a particle that douses it is put out, otherwise it can set its flammable neighbors on fire
+        and light flames or give off smoke into its AIR neighbors, until its lifetime runs out and it burns away into AIR
+        Only the listed particles and their 8 neighbors are looked at
+        '''
+        reactions = self.reactions
+        if len(reactions) == 0:
+            return
+        types = self.particle_grid.types
+        generator = self.random.generator
+        rows, columns = reactions.cell_rows, reactions.cell_columns
+        burning_types = types[rows, columns]
+        # particles that were erased or painted over since the last tick aren't burning anymore
+        burning = BURNING_TABLE[burning_types]
+        reactions.lifetimes -= 1
+
+        # the type of every burning particle's neighbors, the cells past the edge of the grid read as STONE so they never burn
+        # only the neighbors are looked up, with flat indexes so the new particles can be written back every cell once
+        neighbor_rows = rows[:, None] + NEIGHBOR_OFFSETS[:, 0]
+        neighbor_columns = columns[:, None] + NEIGHBOR_OFFSETS[:, 1]
+        inside = (neighbor_rows >= 0) & (neighbor_rows < self.rows) & (neighbor_columns >= 0) & (neighbor_columns < self.columns)
+        neighbors = np.clip(neighbor_rows, 0, self.rows-1) * self.columns + np.clip(neighbor_columns, 0, self.columns-1)
+        neighbor_types = np.where(inside, types.ravel()[neighbors], STONE).astype(types.dtype)
+
+        doused = burning & DOUSES_TABLE[neighbor_types].any(axis=1)
+        burnt_out = burning & ~doused & (reactions.lifetimes <= 0)
+        spreading = burning & ~doused & ~burnt_out
+        # one roll per neighbor decides if a flammable neighbor catches fire, or if an AIR neighbor gets a flame or smoke
+        rolls = generator.random(neighbor_types.shape, dtype=np.float32)
+        ignites = spreading[:, None] & (rolls < FLAMMABILITY_TABLE[neighbor_types])
+        air = spreading[:, None] & (neighbor_types == AIR)
+        flame_chances = FLAME_TABLE[burning_types][:, None]
+        flames = air & (rolls < flame_chances)
+        smokes = air & ~flames & (rolls < flame_chances + SMOKE_TABLE[burning_types][:, None])
+
+        # the put out and burnt out particles leave the list
+        reactions.keep(spreading)
+        self.replace_cells(rows[burnt_out], columns[burnt_out], AIR)
+        # put out particles turn into their doused type, the ones that stay the same just stop burning
+        changed = doused & (DOUSED_INTO_TABLE[burning_types] != burning_types)
+        self.replace_cells(rows[changed], columns[changed], DOUSED_INTO_TABLE[burning_types[changed]])
+
+        # flammable neighbors start burning, then flames and smoke fill the AIR neighbors that are still empty
+        new_rows, new_columns = flat_cells(neighbors[ignites], self.columns)
+        new_types = BURNS_INTO_TABLE[types[new_rows, new_columns]]
+        self.replace_cells(new_rows, new_columns, new_types)
+        reactions.add(new_rows, new_columns, new_types, generator)
+        for cells, particle_type in ((flames, FIRE), (smokes, SMOKE)):
+            new_rows, new_columns = flat_cells(neighbors[cells], self.columns)
+            empty = types[new_rows, new_columns] == AIR
+            new_rows, new_columns = new_rows[empty], new_columns[empty]
+            self.replace_cells(new_rows, new_columns, particle_type)
+            if BURNING_TABLE[particle_type]:
+                reactions.add(new_rows, new_columns, np.full(new_rows.size, particle_type, dtype=np.uint8), generator)
+    def emit_particles(self):
+        '''
+        Writes the particles of every emitter that's due this tick, all in one go
+        '''
+        if len(self.emitters) == 0:
+            return
+        rows, columns, materials = self.emitters.ready(self.particle_grid.types, self.random.generator)
+        self.replace_cells(rows, columns, materials)
+        burning = BURNING_TABLE[materials]
+        if burning.any():
+            self.reactions.add(rows[burning], columns[burning], materials[burning], self.random.generator)
+    def update_gas(self, gas_location):
+        '''
+        The update logic for gas particles like smoke, the liquid logic upside down
+
+        Args:
+            gas_location (int,int): A tuple containing the grid location of the gas particle
+        '''
+        row, column = gas_location
+        types = self.particle_grid.types
+        particle_type = types[row, column]
+        buoyant = BUOYANT_LIST[particle_type]
+
+        # Can the gas rise through the particle above it?
+        if row > 0 and buoyant[types[row-1, column]]:
+            # Swap the gas particle to that location
+            self.swap_particles(gas_location, (row-1, column))
+            return
+        # at the top of the grid there's nowhere higher to go, do nothing
+        if row == 0:
+            return
+        # else drift in a random direction, then the other one, along the cells it can drift into
+        # towards the nearest one it can rise from, by up to its dispersion
+        direction = self.random.side()
+        for direction in (direction, -direction):
+            # the same scan as update_liquid, upside down
+            if not (0 <= column+direction < self.columns) or not buoyant[types[row, column+direction]]:
+                continue
+            reach = column
+            target = column + direction
+            while 0 <= target < self.columns:
+                if buoyant[types[row, target]]:
+                    if reach == target - direction:
+                        reach = target
+                    # Can the gas rise through the particle above that cell?
+                    if buoyant[types[row-1, target]]:
+                        break
+                    if reach != target:
+                        target = None
+                        break
+                elif types[row, target] != particle_type:
+                    target = None
+                    break
+                target += direction
+            else:
+                target = None
+            if target is not None:
+                # Swap the gas particle towards that location
+                distance = min(abs(reach - column), DISPERSION_LIST[particle_type])
+                self.swap_particles(gas_location, (row, column + direction*distance))
+                return
+    def update_particles(self):
+        '''
+        The update logic for all particle types
+        Only the movable particles in awake chunks are visited, still column by column from the bottom up
+        '''
+        types = self.particle_grid.types
+        size = self.chunks.chunk_size
+        rows, columns = self.active.locations()
+        awake = self.chunks.awake[rows // size, columns // size]
+        rows, columns = rows[awake], columns[awake]
+        # sort by column, then from the bottom row up
+        order = np.lexsort((-rows, columns))
+        # every particle uses at most one random direction per tick
+        self.random.reserve(len(order))
+        for row, column in zip(rows[order].tolist(), columns[order].tolist()):
+            # the particle may have been swapped out of this cell earlier in the step
+            mobility = MOBILITY_LIST[types[row, column]]
+            if mobility == POWDER:
+                self.update_powder((row, column))
+            elif mobility == LIQUID:
+                self.update_liquid((row, column))
+            elif mobility == GAS:
+                self.update_gas((row, column))
+        if self.swapped:
+            swapped = np.array(self.swapped)
+            self.wake_runs(swapped[:, 0], swapped[:, 1])
+            self.swapped.clear()
+    def awake_region(self, awake=None):
+        '''
+        Returns the box the vectorized steps work on, the awake chunks clamped to the rows that hold movable particles
+
+        Args:
+            awake (np.ndarray): Optional 2D boolean array of chunks to use instead of all the awake ones
+
+        Returns:
+            bounds (int, int, int, int): (row_start, row_end, column_start, column_end), or None if nothing can move
+        '''
+        bounds = self.chunks.awake_bounds(awake)
+        active_rows = self.active.row_bounds()
+        if bounds is None or active_rows is None:
+            return None
+        row_start, row_end, column_start, column_end = bounds
+        # only the rows holding movable particles can change
+        row_start, row_end = max(row_start, active_rows[0]), min(row_end, active_rows[1])
+        if row_start >= row_end:
+            return None
+        # pad the box by a cell on each side so particles can still move into the sleeping chunks around it
+        row_start, column_start = max(row_start-1, 0), max(column_start-1, 0)
+        row_end, column_end = min(row_end+1, self.rows), min(column_end+1, self.columns)
+        return row_start, row_end, column_start, column_end
+    def awake_regions(self):
+        '''
+        Returns the boxes the vectorized step works on
+        A box around every awake chunk that's bigger than a sector is cut into SECTOR_SIZE sectors that each get the box
+        around their own awake chunks, so a few busy spots far apart in a big world don't make the step look at everything between them
+        When the sector boxes would cover most of the big box anyway the big box is kept, one pass over it costs less than many small ones
+
+        Returns:
+            regions (dict): (sector_row, sector_column) mapped to (row_start, row_end, column_start, column_end), padded by a cell like awake_region
+        '''
+        bounds = self.awake_region()
+        if bounds is None:
+            return {}
+        row_start, row_end, column_start, column_end = bounds
+        if row_end - row_start <= SECTOR_SIZE and column_end - column_start <= SECTOR_SIZE:
+            return {(0, 0): bounds}
+        regions = {}
+        row_counts = self.active.row_counts
+        for sector, (row_start, row_end, column_start, column_end) in self.chunks.sector_bounds().items():
+            # only the rows holding movable particles can change
+            active_rows = np.flatnonzero(row_counts[row_start:row_end])
+            if active_rows.size == 0:
+                continue
+            row_start, row_end = row_start + active_rows[0], row_start + active_rows[-1] + 1
+            regions[sector] = (max(row_start-1, 0), min(row_end+1, self.rows), max(column_start-1, 0), min(column_end+1, self.columns))
+        area = sum((row_end - row_start) * (column_end - column_start) for row_start, row_end, column_start, column_end in regions.values())
+        if area > SECTOR_SPLIT_SHARE * (bounds[1] - bounds[0]) * (bounds[3] - bounds[2]):
+            return {(0, 0): bounds}
+        return regions
+    def update_particles_vectorized(self):
+        '''
+        The update logic for all particle types, computed at once with NumPy masks over the boxes around the awake chunks
+        Neighboring boxes share the cell of padding along their edges, a particle that moved there in one box can't move again in the next
+        The boxes are stepped from the bottom sectors up, so a run of particles falling across a sector edge isn't held up by the part of it below
+        '''
+        stepped = {}
+        for (sector_row, sector_column), bounds in sorted(self.awake_regions().items(), reverse=True):
+            row_start, row_end, column_start, column_end = bounds
+            region = self.particle_grid[row_start:row_end, column_start:column_end]
+            active = self.chunks.awake_cells(row_start, row_end, column_start, column_end)
+            moved = np.zeros(region.types.shape, dtype=bool)
+            for row_offset in (-1, 0, 1):
+                for column_offset in (-1, 0, 1):
+                    neighbor = stepped.get((sector_row + row_offset, sector_column + column_offset))
+                    if neighbor is None:
+                        continue
+                    (other_row_start, other_row_end, other_column_start, other_column_end), other_moved = neighbor
+                    top, bottom = max(row_start, other_row_start), min(row_end, other_row_end)
+                    left, right = max(column_start, other_column_start), min(column_end, other_column_end)
+                    if top < bottom and left < right:
+                        moved[top-row_start:bottom-row_start, left-column_start:right-column_start] |= \
+                            other_moved[top-other_row_start:bottom-other_row_start, left-other_column_start:right-other_column_start]
+
+            step_vectorized(region.types, region.colors, self.random.generator, flip=self.step_count % 2 == 1, active=active, moved=moved)
+            self.record_moves(moved, row_start, column_start)
+            self.flow_past_edges(moved, *bounds)
+            stepped[(sector_row, sector_column)] = (bounds, moved)
+    def update_particles_parallel(self):
+        '''
+        The vectorized update split into bands of columns that a pool of worker processes steps at the same time
+        The first parallel step moves the grid into shared memory and starts the workers
+        '''
+        bounds = self.awake_region()
+        if bounds is None:
+            return
+        if self.striped is None:
+            self.striped = StripedStepper(self.particle_grid, self.workers)
+            self.particle_grid = self.striped.grid
+        row_start, row_end, column_start, column_end = bounds
+        odd = self.step_count % 2 == 1
+        moved = self.striped.step(row_start, row_end, column_start, column_end, self.chunks.awake, self.chunks.chunk_size,
+                                  odd, self.random.generator, shift=odd)
+        self.record_moves(moved, row_start, column_start)
+        # every band only sees its own columns, so the edges between them are checked too
+        for band_start, band_end in self.striped.bands(column_start, column_end, shift=odd):
+            self.flow_past_edges(moved[:, band_start-column_start:band_end-column_start], row_start, row_end, band_start, band_end)
+    def update_particles_margolus(self):
+        '''
+        The Margolus block rules, every 2x2 block of the boxes around the awake chunks is stepped at once through MARGOLUS_TABLE
+        The blocks of the chunks in focus start on even cells one tick and odd cells the next, the chunks outside the focus
+        are only updated every offscreen_interval ticks so they switch offsets on each of those updates instead
+        '''
+        chunks = self.chunks
+        offsets = np.full(chunks.awake.shape, self.step_count % 2, dtype=np.uint8)
+        if chunks.focus is not None:
+            # the number of offscreen updates so far, a parity taken from the tick itself would be the same on every one of them
+            offsets[~chunks.focus] = self.step_count // chunks.offscreen_interval % 2
+        for offset in (0, 1):
+            awake = chunks.awake & (offsets == offset)
+            if awake.any():
+                self.step_margolus_region(awake, offset)
+
+        # a block that can't move at one offset may be able to at the other, so a chunk only falls asleep after two ticks in a row
+        # where nothing around it changed, every chunk updated this tick that isn't already on its second tick gets one more
+        kept = chunks.awake & ~chunks.next_awake
+        if self.margolus_kept is not None and self.margolus_kept.shape == kept.shape:
+            kept &= ~self.margolus_kept
+            # chunks outside the focus that sat this tick out hold on to their mark until they're updated again
+            kept |= self.margolus_kept & ~chunks.awake
+        chunks.next_awake |= kept & chunks.awake
+        self.margolus_kept = kept
+    def step_margolus_region(self, awake, offset):
+        '''
+        Steps the blocks of the box around some of the awake chunks through MARGOLUS_TABLE, the box is widened to whole blocks
+
+        Args:
+            awake (np.ndarray): 2D boolean array of the awake chunks to step
+            offset (int): 0 or 1, the row and column the blocks start on
+        '''
+        bounds = self.awake_region(awake)
+        if bounds is None:
+            return
+        row_start, row_end, column_start, column_end = bounds
+        # widen the box to whole blocks starting on the offset's cells
+        row_start    -= (row_start - offset) % 2
+        column_start -= (column_start - offset) % 2
+        row_end      += (row_end - row_start) % 2
+        column_end   += (column_end - column_start) % 2
+        # blocks hanging over the edge of the grid are padded with STONE, so the edges act as walls on both offsets
+        pads = ((max(-row_start, 0), max(row_end - self.rows, 0)), (max(-column_start, 0), max(column_end - self.columns, 0)))
+        row_start, row_end = max(row_start, 0), min(row_end, self.rows)
+        column_start, column_end = max(column_start, 0), min(column_end, self.columns)
+        region = self.particle_grid[row_start:row_end, column_start:column_end]
+        active = self.chunks.awake_cells(row_start, row_end, column_start, column_end, awake)
+        if any(pads[0] + pads[1]):
+            types, colors = np.pad(region.types, pads, constant_values=STONE), np.pad(region.colors, pads)
+            changed = step_margolus(types, colors, 0, self.random.generator, np.pad(active, pads))
+            inside = (slice(pads[0][0], pads[0][0] + region.rows), slice(pads[1][0], pads[1][0] + region.columns))
+            region.types[...], region.colors[...], changed = types[inside], colors[inside], changed[inside]
+        else:
+            changed = step_margolus(region.types, region.colors, 0, self.random.generator, active)
+        self.record_moves(changed, row_start, column_start)
+    def record_moves(self, moved, row_start, column_start):
+        '''
+        Wakes the chunks around, re-indexes and marks to be redrawn every cell a vectorized step moved
+
+        Args:
+            moved (np.ndarray): 2D boolean array of the cells that changed in the stepped box
+            row_start (int): The grid row of the box's first row
+            column_start (int): The grid column of the box's first column
+        '''
+        rows, columns = moved.shape
+        self.chunks.wake_mask(moved, row_start, column_start)
+        moved_rows, moved_columns = np.nonzero(moved)
+        self.wake_runs(moved_rows + row_start, moved_columns + column_start)
+        self.active.rebuild_region(self.particle_grid.types[row_start:row_start+rows, column_start:column_start+columns], row_start, column_start)
+        if self.profiler.enabled:
+            # every swap moves two cells, runs that fall together are counted the same way
+            self.profiler.count("swaps", np.count_nonzero(moved) // 2)
+        # mark every moved cell to be redrawn
+        if self.track_updates:
+            self.dirty.mark_mask(moved, row_start, column_start)
+    def wake_runs(self, rows, columns):
+        '''
+        Wakes the liquid and gas particles at both ends of the runs of AIR through the cells that just turned into AIR
+        A resting liquid flows towards the nearest lower cell along its whole row, which can be much further away than the chunks
+        next to a change, so an AIR cell opening up on the surface of a pool, or under a run of AIR above it, wakes the particles
+        that may now have somewhere to flow to, however far away they are
+
+        Args:
+            rows (np.ndarray): The rows of the changed cells
+            columns (np.ndarray): The columns of the changed cells
+        '''
+        types = self.particle_grid.types
+        opened = types[rows, columns] == AIR
+        rows, columns = rows[opened], columns[opened]
+        if rows.size == 0:
+            return
+        # the run through the cell itself, the one above it that may have a lower cell now and the one below it for gases
+        rows, columns = np.concatenate((rows-1, rows, rows+1)), np.tile(columns, 3)
+        inside = (rows >= 0) & (rows < self.rows)
+        rows, columns = rows[inside], columns[inside]
+        opened = types[rows, columns] == AIR
+        run_rows, row_index = np.unique(rows[opened], return_inverse=True)
+        columns = columns[opened]
+
+        # the nearest cell on either side of every cell in those rows that isn't AIR, -1 or columns if there isn't one
+        column_index = np.arange(self.columns)
+        filled = types[run_rows] != AIR
+        left = np.maximum.accumulate(np.where(filled, column_index, -1), axis=1)[row_index, columns]
+        right = np.minimum.accumulate(np.where(filled, column_index, self.columns)[:, ::-1], axis=1)[:, ::-1][row_index, columns]
+        ends = np.concatenate((left, right))
+        end_rows = np.tile(run_rows[row_index], 2)
+        inside = (ends >= 0) & (ends < self.columns)
+        end_rows, ends = end_rows[inside], ends[inside]
+        flowing = np.isin(MOBILITY_TABLE[types[end_rows, ends]], (LIQUID, GAS))
+        self.chunks.wake_cells(end_rows[flowing], ends[flowing])
+    def flow_past_edges(self, moved, row_start, row_end, column_start, column_end):
+        '''
+        Flows the liquids and gases in a stepped box towards somewhere lower past the box's left or right edge
+        The vectorized step only sees the cells inside its box, so a particle whose run of AIR carries on out of the box to a lower cell
+        would fall asleep without ever seeing it. The nearest particle to the edge in each row moves along the run like spread_liquid would
+
+        Args:
+            moved (np.ndarray): 2D boolean array of the cells in the box that already moved this tick, updated in place
+            row_start, row_end (int, int): The rows of the box, end exclusive
+            column_start, column_end (int, int): The columns of the box, end exclusive
+        '''
+        types, colors = self.particle_grid.types, self.particle_grid.colors
+        box = types[row_start:row_end, column_start:column_end]
+        for side in (-1, 1):
+            if (column_start == 0) if side < 0 else (column_end == self.columns):
+                continue
+            # the box's rows from the edge inwards
+            inwards = box if side < 0 else box[:, ::-1]
+            # the nearest particle to the edge in every row, if it's a liquid or a gas that hasn't moved yet
+            filled = inwards != AIR
+            nearest = filled.argmax(axis=1)
+            row = np.flatnonzero(filled.any(axis=1))
+            nearest = nearest[row]
+            particle_types = inwards[row, nearest]
+            mobility = MOBILITY_TABLE[particle_types]
+            flowing = ((mobility == LIQUID) | (mobility == GAS)) & ~(moved if side < 0 else moved[:, ::-1])[row, nearest]
+            # the row a liquid falls into, or a gas rises into, the particle has to be resting on it to flow sideways
+            lower_row = row + row_start + np.where(mobility == LIQUID, 1, -1)
+            flowing &= (lower_row >= 0) & (lower_row < self.rows)
+            row, nearest, particle_types, lower_row = row[flowing] + row_start, nearest[flowing], particle_types[flowing], lower_row[flowing]
+            particle_columns = column_start + nearest if side < 0 else column_end - 1 - nearest
+            resting = types[lower_row, particle_columns] != AIR
+            row, particle_columns, particle_types, lower_row = row[resting], particle_columns[resting], particle_types[resting], lower_row[resting]
+            if row.size == 0:
+                continue
+
+            # the rest of the grid's rows from the edge outwards
+            outwards = types[:, :column_start][:, ::-1] if side < 0 else types[:, column_end:]
+            # the first cell past the edge that isn't AIR, and the first AIR cell with AIR under it(over it for a gas)
+            width = outwards.shape[1]
+            run = outwards[row] == AIR
+            blocked = np.where(run.all(axis=1), width, (~run).argmax(axis=1))
+            lower = run & (outwards[lower_row] == AIR)
+            drop = np.where(lower.any(axis=1), lower.argmax(axis=1), width)
+            found = drop < blocked
+            row, particle_columns, particle_types = row[found], particle_columns[found], particle_types[found]
+            drop_columns = column_start - 1 - drop[found] if side < 0 else column_end + drop[found]
+            if row.size == 0:
+                continue
+
+            # every cell between the particle and the lower cell is AIR, so it can move straight along them
+            distance = np.minimum(np.abs(drop_columns - particle_columns), DISPERSION_TABLE[particle_types])
+            target_columns = particle_columns + side * distance
+            colors[row, target_columns], colors[row, particle_columns] = colors[row, particle_columns], colors[row, target_columns]
+            types[row, target_columns], types[row, particle_columns] = particle_types, AIR
+            cell_rows, cell_columns = np.concatenate((row, row)), np.concatenate((particle_columns, target_columns))
+            self.active.set_cells(cell_rows, cell_columns, types[cell_rows, cell_columns])
+            self.chunks.wake_cells(cell_rows, cell_columns)
+            self.wake_runs(row, particle_columns)
+            if self.track_updates:
+                self.dirty.mark_cells(cell_rows, cell_columns)
+            inside = (cell_columns >= column_start) & (cell_columns < column_end)
+            moved[cell_rows[inside] - row_start, cell_columns[inside] - column_start] = True
+    def step(self, steps=1):
+        '''
+        Advances the simulation by the given number of steps using the current step mode
+
+        Args:
+            steps (int): How many steps to run
+        '''
+        start_time = time.perf_counter()
+        for _ in range(steps):
+            tick_start = time.perf_counter()
+            self.chunks.begin_tick(self.step_count)
+            if self.step_mode == VECTORIZED_STEP:
+                self.update_particles_vectorized()
+            elif self.step_mode == PARALLEL_STEP:
+                self.update_particles_parallel()
+            elif self.step_mode == MARGOLUS_STEP:
+                self.update_particles_margolus()
+            else:
+                self.update_particles()
+            self.fade_particles()
+            self.update_reactions()
+            self.emit_particles()
+            self.emitters.throttle_to(time.perf_counter() - tick_start)
+            self.step_count += 1
+            if self.replay:
+                self.replay.capture(self.particle_grid, self.step_count, self.chunks.awake | self.chunks.next_awake, self.chunks.chunk_size)
+            if self.step_count % PAGE_OUT_INTERVAL == 0:
+                self.page_out()
+        self.last_step_count = steps
+        self.last_step_time  = time.perf_counter() - start_time
+    def close(self):
+        '''
+        Stops the parallel step's worker processes and frees its shared memory, the grid is kept
+        '''
+        if self.striped is None:
+            return
+        self.striped.close()
+        self.striped = None
+    def place_particle(self, location, particle_type):
+        '''
+        Places a particle at the given grid location
+
+        Args:
+            location (int, int): Tuple of integers representing the row and column of the particle
+            particle_type (int): The particle type to place
+        '''
+        row, column = location
+        # is the location within the bounds of the grid?
+        if not (0 <= row < self.rows and 0 <= column < self.columns):
+            return
+
+        # TODO: decide if I want to let particles replace existing particles
+        #    # is there a particle already in that grid location?
+        #    if self.particle_grid.types[row, column] != AIR:
+        #        # do nothing
+        #        return
+
+        # If somehow the particle_type does not correspond to a placeable material
+        if particle_type not in PLACEABLE_PARTICLES:
+            print(f"Error: place_particle() - Invalid particle type: {particle_type}")
+            return
+
+        # Update particle grid and mark the particle as updated so the view draws it
+        self.log_event("place_particle", location=location, particle_type=particle_type)
+        self.history.touch(self.particle_grid, row, row+1, column, column+1)
+        self.particle_grid.set((row, column), particle_type, self.vary_color())
+        self.active.set((row, column), particle_type)
+        if BURNING_TABLE[particle_type]:
+            self.reactions.add(row, column, particle_type, self.random.generator)
+        self.chunks.wake_cell(row, column)
+        if self.track_updates:
+            self.dirty.mark(row, column)
+
+    def paint(self, start, end, particle_type, radius=BRUSH_RADIUS, shape=CIRCLE_BRUSH, density=SPRAY_DENSITY):
+        '''
+        Paints one segment of a brush stroke with a particle type, replacing the particles under it
+        The whole segment is written with one masked assignment and one batch of random shades, and its bounding rectangle is marked to be redrawn
+
+        Args:
+            start (int, int): The row and column the segment starts at
+            end (int, int): The row and column the segment ends at, the same as start to paint a single stamp
+            particle_type (int): The particle type to paint
+            radius (int): The brush radius in cells
+            shape (str): One of BRUSH_SHAPES
+            density (float): Share of the brush's cells the spray brush paints
+        '''
+        if particle_type not in PLACEABLE_PARTICLES:
+            print(f"Error: paint() - Invalid particle type: {particle_type}")
+            return
+        self.log_event("paint", start=start, end=end, particle_type=particle_type, radius=radius, shape=shape, density=density)
+        stroke = brush_mask(start, end, radius, shape, self.rows, self.columns)
+        if stroke is None:
+            return
+        row_start, column_start, mask = stroke
+        generator = self.random.generator
+        if shape == SPRAY_BRUSH:
+            mask &= generator.random(mask.shape, dtype=np.float32) < density
+        rows, columns = np.nonzero(mask)
+        if rows.size == 0:
+            return
+
+        row_end, column_end = row_start + mask.shape[0], column_start + mask.shape[1]
+        self.history.touch(self.particle_grid, row_start, row_end, column_start, column_end)
+        self.particle_grid.types[row_start:row_end, column_start:column_end][mask] = particle_type
+        self.particle_grid.colors[row_start:row_end, column_start:column_end][mask] = generator.integers(0, PALETTE_SIZE, rows.size, dtype=np.uint8)
+        rows += row_start
+        columns += column_start
+        types = np.full(rows.size, particle_type, dtype=np.uint8)
+        self.active.set_cells(rows, columns, types)
+        if BURNING_TABLE[particle_type]:
+            self.reactions.add(rows, columns, types, generator)
+        self.chunks.wake_mask(mask, row_start, column_start)
+        if self.track_updates:
+            self.dirty.mark_rectangle(row_start, row_end, column_start, column_end)
+    def add_emitter(self, location, material, rate=EMITTER_RATE):
+        '''
+        Adds an emitter at the given grid location, replacing the emitter already there
+
+        Args:
+            location (int, int): Tuple of integers representing the row and column of the emitter
+            material (int): The particle type it emits
+            rate (float): Particles per tick, at most 1
+        '''
+        row, column = location
+        if not (0 <= row < self.rows and 0 <= column < self.columns):
+            return
+        if material == AIR or material not in PLACEABLE_PARTICLES:
+            print(f"Error: add_emitter() - Invalid particle type: {material}")
+            return
+        self.log_event("add_emitter", location=location, material=material, rate=rate)
+        self.emitters.add(row, column, material, rate)
+        self.record_emitters()
+    def remove_emitter(self, location):
+        '''
+        Removes the emitter at the given grid location, if there is one
+
+        Args:
+            location (int, int): Tuple of integers representing the row and column of the emitter
+        '''
+        self.log_event("remove_emitter", location=location)
+        self.emitters.remove(*location)
+        self.record_emitters()
+
+    # Stats methods
+    def particle_counts(self):
+        '''
+        Counts the particles of every type in the grid
+
+        Returns:
+            counts (dict): Particle name mapped to how many of that particle are in the grid
+        '''
+        counts = np.bincount(self.particle_grid.types.ravel(), minlength=len(PARTICLE_NAMES))
+        return {name: int(counts[particle_type]) for particle_type, name in PARTICLE_NAMES.items()}
+    def steps_per_second(self):
+        '''
+        Returns the step rate of the last call to step()
+        '''
+        if self.last_step_time <= 0:
+            return 0.0
+        return self.last_step_count / self.last_step_time
+    def stats(self):
+        '''
+        Collects the simulation stats
+
+        Returns:
+            stats (dict): The grid size, step count, step rate, awake chunks and particle counts
+        '''
+        return {
+            "rows": self.rows,
+            "columns": self.columns,
+            "step_mode": self.step_mode,
+            "step_count": self.step_count,
+            "seed": self.random.seed,
+            "steps_per_second": self.steps_per_second(),
+            "awake_chunks": int(np.count_nonzero(self.chunks.awake)),
+            "movable_particles": self.active.count(),
+            "burning_particles": len(self.reactions),
+            "emitters": len(self.emitters),
+            "emit_throttle": self.emitters.throttle,
+            "particles": self.particle_counts(),
+        }
+
+# Recording
+PNG_SIGNATURE     = b"\x89PNG\r\n\x1a\n"
+PNG_COMPRESSION   = 1    # zlib level of the PNG frames, the fastest level keeps batch exports quick
+GIF_SHADES        = PALETTE_SIZE // len(MATERIALS) # shades of each particle type in the 256 color GIF palette
+GIF_MIN_DELAY     = 20   # milliseconds, browsers slow GIF frames shorter than this down to 100ms
+RECORD_FRAME_NAME = "frame_{:05d}.png" # names of the frames of a PNG sequence
+
+def png_chunk(tag, data):
+    '''
+    Packs one PNG chunk, its length, tag, data and CRC
+
+    Args:
+        tag (bytes): The 4 byte chunk type
+        data (bytes): The chunk's data
+
+    Returns:
+        chunk (bytes): The packed chunk
+    '''
+    return struct.pack(">I", len(data)) + tag + data + struct.pack(">I", zlib.crc32(tag + data))
+def write_png(path, rgb):
+    '''
+    Writes an RGB image buffer as a PNG file with only zlib and struct, no imaging library needed
+
+    Args:
+        path (str): The [relative/absolute] path of the .png file
+        rgb (np.ndarray): uint8 array of shape (height, width, 3)
+    '''
+    height, width = rgb.shape[:2]
+    # every scanline starts with its filter type, 0 leaves the row as is
+    scanlines = np.zeros((height, width * 3 + 1), dtype=np.uint8)
+    scanlines[:, 1:] = rgb.reshape(height, width * 3)
+    with open(path, 'wb') as file:
+        file.write(PNG_SIGNATURE)
+        file.write(png_chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0)))
+        file.write(png_chunk(b"IDAT", zlib.compress(scanlines.tobytes(), PNG_COMPRESSION)))
+        file.write(png_chunk(b"IEND", b""))
+def build_gif_palette():
+    '''
+    Builds the 256 color palette of GIF recordings, the first GIF_SHADES shades of every particle type
+
+    Returns:
+        palette (np.ndarray): uint8 array of shape (256, 3)
+    '''
+    palette = np.zeros((PALETTE_SIZE, 3), dtype=np.uint8)
+    for particle_type in range(len(MATERIALS)):
+        palette[particle_type * GIF_SHADES:(particle_type+1) * GIF_SHADES] = PALETTE[particle_type, :GIF_SHADES]
+    return palette
+GIF_PALETTE = build_gif_palette()
+def render_indexed(grid, cell_size=1):
+    '''
+    Turns a particle grid into GIF_PALETTE indices, every shade is folded onto one of its type's first GIF_SHADES shades
+
+    Args:
+        grid (ParticleGrid): The grid, or a slice of the grid, to render
+        cell_size (int): The width and height of a cell in pixels
+
+    Returns:
+        indexed (np.ndarray): uint8 array of shape (rows*cell_size, columns*cell_size)
+    '''
+    indexed = grid.types * np.uint8(GIF_SHADES) + grid.colors % np.uint8(GIF_SHADES)
+    if cell_size > 1:
+        indexed = np.repeat(np.repeat(indexed, cell_size, axis=0), cell_size, axis=1)
+    return indexed
+
+class Recorder:
+    '''
+    Records a simulation as a sequence of PNG frames or an animated GIF, rendered straight from the grid's arrays without tkinter
+    PNG frames are written as they're recorded. GIF frames are kept zlib compressed until close, where Pillow encodes the animation
+    '''
+    def __init__(self, path, stride=1, scale=1, tick_rate=TICK_RATE):
+        '''
+        Args:
+            path (str): A .gif file to record an animated GIF to, anything else is a directory the PNG frames are written into
+            stride (int): Steps between recorded frames
+            scale (int): The width and height of a cell in pixels
+            tick_rate (int): Steps per second of the simulation, sets the GIF's frame delay
+        '''
+        self.path   = path
+        self.stride = max(stride, 1)
+        self.scale  = max(scale, 1)
+        self.gif    = path.lower().endswith(".gif")
+        self.frame_count = 0
+        self.frames = [] # compressed GIF frames
+        self.step_time = 0.0 # seconds spent stepping in record, without the rendering and writing
+        self.shape  = None
+        self.delay  = max(round(1000 * self.stride / tick_rate), GIF_MIN_DELAY)
+        if self.gif and Image is None:
+            raise RuntimeError("Recording a GIF needs Pillow (pip install pillow), record a PNG sequence instead")
+        if not self.gif:
+            os.makedirs(path, exist_ok=True)
+
+    def add_frame(self, grid):
+        '''
+        Records the grid as the next frame
+
+        Args:
+            grid (ParticleGrid): The grid, or a slice of the grid, to record
+        '''
+        if self.gif:
+            indexed = render_indexed(grid, self.scale)
+            self.shape = indexed.shape
+            self.frames.append(zlib.compress(indexed.tobytes(), PNG_COMPRESSION))
+        else:
+            write_png(os.path.join(self.path, RECORD_FRAME_NAME.format(self.frame_count)), render_rgb(grid, self.scale))
+        self.frame_count += 1
+    def record(self, engine, steps):
+        '''
+        Steps an engine and records a frame every stride steps, the grid as it is now is the first frame
+
+        Args:
+            engine (SandEngine): The engine to run
+            steps (int): The number of steps to run
+        '''
+        self.add_frame(engine.particle_grid)
+        for done in range(0, steps, self.stride):
+            engine.step(min(self.stride, steps - done))
+            self.step_time += engine.last_step_time
+            self.add_frame(engine.particle_grid)
+    def gif_frames(self):
+        '''
+        Decompresses the GIF frames one at a time as Pillow encodes them
+
+        Returns:
+            frames (generator): The Pillow images of every frame after the first
+        '''
+        for frame in self.frames[1:]:
+            yield self.gif_image(frame)
+    def gif_image(self, frame):
+        '''
+        Args:
+            frame (bytes): A compressed GIF frame
+
+        Returns:
+            image (PIL.Image.Image): The frame as a paletted Pillow image
+        '''
+        image = Image.frombytes("P", (self.shape[1], self.shape[0]), zlib.decompress(frame))
+        image.putpalette(GIF_PALETTE.tobytes())
+        return image
+    def close(self):
+        '''
+        Finishes the recording, the GIF is only written here
+        '''
+        if not self.gif or not self.frames:
+            return
+        self.gif_image(self.frames[0]).save(self.path, save_all=True, append_images=self.gif_frames(), duration=self.delay, loop=0, optimize=False)
+        self.frames = []
+
+def main(arguments=None):
+    '''
+    Command line entry point that runs a scene headless as fast as possible
+
+    Args:
+        arguments (list): The command line arguments, defaults to sys.argv
+    '''
+    parser = argparse.ArgumentParser(description="Runs a PyFallingSand scene without a window")
+    parser.add_argument("scene", help="path to the .sand scene to load")
+    parser.add_argument("-n", "--steps", type=int, default=1000, help="number of steps to run (default: 1000)")
+    parser.add_argument("-o", "--output", help="path to save the final scene to (default: <scene>_final.sand)")
+    parser.add_argument("-m", "--mode", choices=STEP_MODES, default=VECTORIZED_STEP, help="step mode (default: vectorized)")
+    parser.add_argument("-w", "--workers", type=int, help="worker processes of the parallel step mode (default: one per CPU)")
+    parser.add_argument("--raw", action="store_true", help="save the final scene uncompressed so it can be memory-mapped")
+    parser.add_argument("--memory-map", action="store_true", help="memory-map the scene instead of reading it, only for uncompressed scenes")
+    parser.add_argument("-s", "--seed", type=int, help="seed for the simulation's random numbers, the same scene and seed always give the same final scene")
+    parser.add_argument("-r", "--record", help="records the run to a .gif file (needs Pillow), or to a directory of PNG frames")
+    parser.add_argument("--stride", type=int, default=1, help="steps between recorded frames (default: 1)")
+    parser.add_argument("--scale", type=int, default=1, help="width and height of a cell in the recorded frames, in pixels (default: 1)")
+    parser.add_argument("--replay", help="streams a replay log of every step to this path")
+    arguments = parser.parse_args(arguments)
+
+    engine = SandEngine(1, 1, step_mode=arguments.mode, track_updates=False, seed=arguments.seed, workers=arguments.workers)
+    engine.load(arguments.scene, arguments.memory_map)
+    recorder = Recorder(arguments.record, arguments.stride, arguments.scale) if arguments.record else None
+    if arguments.replay:
+        engine.start_replay(arguments.replay)
+    start_time = time.perf_counter()
+    try:
+        if recorder:
+            recorder.record(engine, arguments.steps)
+            recorder.close()
+        else:
+            engine.step(arguments.steps)
+    finally:
+        engine.close()
+        engine.stop_replay()
+
+    output = arguments.output
+    if output is None:
+        output = (arguments.scene[:-len(".sand")] if arguments.scene.endswith(".sand") else arguments.scene) + "_final.sand"
+    engine.save(output, RAW_PLANES if arguments.raw else ZLIB_PLANES)
+    step_time = recorder.step_time if recorder else engine.last_step_time
+    print(f"Ran {arguments.steps} steps on a {engine.rows}x{engine.columns} grid in {step_time:.3f}s ({arguments.steps / max(step_time, 1e-9):.1f} steps/sec)")
+    print(f"Saved the final scene to {output}")
+    if recorder:
+        print(f"Recorded {recorder.frame_count} frames to {arguments.record} in {time.perf_counter() - start_time:.3f}s")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,326 @@
+'''
+Tests for the headless SandEngine, run with `python -m pytest`
+'''
+import pickle
+
+import numpy as np
+import pytest
+
+import sand_engine as engine
+
+STEP_MODES = [engine.SCALAR_STEP, engine.VECTORIZED_STEP, engine.PARALLEL_STEP, engine.MARGOLUS_STEP]
+
+def settle(sand_engine, limit=2000):
+    '''
+    Steps an engine until every chunk has fallen asleep, chunks outside the focus waiting for their tick count as awake
+
+    Args:
+        sand_engine (SandEngine): The engine to step
+        limit (int): The most ticks to step before giving up
+
+    Returns:
+        ticks (int): How many ticks it took
+    '''
+    for tick in range(limit):
+        sand_engine.step()
+        sand_engine.dirty.clear()
+        if not (sand_engine.chunks.awake.any() or sand_engine.chunks.next_awake.any()):
+            return tick
+    raise AssertionError(f"the grid was still awake after {limit} ticks")
+
+def floor_engine(step_mode, rows=96, columns=96, floor_row=64):
+    '''
+    Builds an engine holding a pile of sand resting on a stone floor whose top row is the first row of a chunk, stepped until asleep
+
+    Args:
+        step_mode (str): The step mode to run the engine with
+        rows, columns (int, int): The size of the grid
+        floor_row (int): The row of the stone floor
+
+    Returns:
+        sand_engine (SandEngine): The settled engine
+    '''
+    sand_engine = engine.SandEngine(rows, columns, step_mode=step_mode, seed=1, workers=2)
+    types = sand_engine.particle_grid.types
+    types[floor_row, :] = engine.STONE
+    types[floor_row-16:floor_row, 20:60] = engine.SAND
+    sand_engine.refresh()
+    settle(sand_engine)
+    return sand_engine
+
+@pytest.mark.parametrize("step_mode", STEP_MODES)
+def test_erasing_a_floor_on_a_chunk_edge_wakes_the_particles_above(step_mode):
+    sand_engine = floor_engine(step_mode)
+    sand = np.count_nonzero(sand_engine.particle_grid.types[:64] == engine.SAND)
+    # a one cell thick line across the floor, so the stroke's own rectangle ends at the chunk edge
+    sand_engine.paint((64, 0), (64, 95), engine.AIR, radius=0)
+    for tick in range(100):
+        sand_engine.step()
+    fallen = np.count_nonzero(sand_engine.particle_grid.types[64:] == engine.SAND)
+    sand_engine.close()
+    assert fallen == sand
+
+@pytest.mark.parametrize("step_mode", STEP_MODES)
+def test_redoing_an_erased_floor_on_a_chunk_edge_wakes_the_particles_above(step_mode):
+    sand_engine = floor_engine(step_mode)
+    sand = np.count_nonzero(sand_engine.particle_grid.types[:64] == engine.SAND)
+    sand_engine.begin_edit()
+    sand_engine.paint((64, 0), (64, 95), engine.AIR, radius=0)
+    sand_engine.end_edit()
+    # the floor is put back before anything falls and the grid falls asleep again
+    assert sand_engine.undo()
+    settle(sand_engine)
+    # redoing only writes the history chunks below the sand
+    assert sand_engine.redo()
+    for tick in range(100):
+        sand_engine.step()
+    fallen = np.count_nonzero(sand_engine.particle_grid.types[64:] == engine.SAND)
+    sand_engine.close()
+    assert fallen == sand
+
+@pytest.mark.parametrize("step_mode", STEP_MODES)
+def test_smoke_under_a_ceiling_fades_away(step_mode):
+    sand_engine = engine.SandEngine(64, 64, step_mode=step_mode, seed=2, workers=2)
+    types = sand_engine.particle_grid.types
+    types[10, :] = engine.STONE
+    types[11:20, 10:50] = engine.SMOKE
+    sand_engine.refresh()
+    for tick in range(3000):
+        sand_engine.step()
+    smoke = np.count_nonzero(sand_engine.particle_grid.types == engine.SMOKE)
+    sand_engine.close()
+    assert smoke == 0
+
+def test_burning_wood_keeps_burning_after_a_load(tmp_path):
+    sand_engine = engine.SandEngine(48, 48, seed=3)
+    types = sand_engine.particle_grid.types
+    types[30:48, 10:38] = engine.WOOD
+    types[29, 24] = engine.FIRE
+    sand_engine.refresh()
+    for tick in range(60):
+        sand_engine.step()
+    assert np.count_nonzero(sand_engine.particle_grid.types == engine.BURNT_WOOD)
+    sand_engine.save(tmp_path / "fire.sand")
+
+    loaded = engine.SandEngine(1, 1, seed=3)
+    loaded.load(tmp_path / "fire.sand")
+    assert len(loaded.reactions) == np.count_nonzero(engine.BURNING_TABLE[loaded.particle_grid.types])
+    for tick in range(3000):
+        loaded.step()
+    assert np.count_nonzero(engine.BURNING_TABLE[loaded.particle_grid.types]) == 0
+
+@pytest.mark.parametrize("step_mode", STEP_MODES)
+def test_replay_seeks_to_the_recorded_grids(step_mode, tmp_path):
+    sand_engine = engine.SandEngine(64, 80, step_mode=step_mode, seed=4, workers=2)
+    sand_engine.start_replay(tmp_path / "run.slog", keyframe_interval=50)
+    recorded = {sand_engine.step_count: sand_engine.particle_grid.copy()}
+    for tick in range(160):
+        if tick == 5:
+            sand_engine.begin_edit()
+            sand_engine.paint((10, 10), (10, 60), engine.SAND, radius=3)
+            sand_engine.end_edit()
+        if tick == 20:
+            sand_engine.add_emitter((2, 40), engine.WATER, rate=1.0)
+            sand_engine.paint((50, 0), (50, 79), engine.WOOD, radius=1)
+            sand_engine.place_particle((48, 30), engine.FIRE)
+        if tick == 90:
+            sand_engine.undo()
+        sand_engine.step()
+        recorded[sand_engine.step_count] = sand_engine.particle_grid.copy()
+    sand_engine.stop_replay()
+    sand_engine.close()
+
+    reader = engine.ReplayReader(tmp_path / "run.slog")
+    assert (reader.first_tick, reader.last_tick) == (0, 160)
+    # forwards, then backwards across the keyframes
+    for tick in list(range(161)) + list(range(160, -1, -7)):
+        grid = reader.seek(tick)
+        assert np.array_equal(grid.types, recorded[tick].types), tick
+        assert np.array_equal(grid.colors, recorded[tick].colors), tick
+    reader.close()
+
+def test_replay_seeks_to_the_recorded_emitters(tmp_path):
+    sand_engine = engine.SandEngine(32, 32, seed=5)
+    sand_engine.add_emitter((1, 5), engine.SAND)
+    sand_engine.start_replay(tmp_path / "run.slog")
+    recorded = {sand_engine.step_count: sand_engine.emitters.to_bytes()}
+    for tick in range(40):
+        if tick == 10:
+            sand_engine.add_emitter((1, 20), engine.WATER, rate=1.0)
+        if tick == 25:
+            sand_engine.remove_emitter((1, 5))
+        sand_engine.step()
+        recorded[sand_engine.step_count] = sand_engine.emitters.to_bytes()
+    sand_engine.stop_replay()
+
+    reader = engine.ReplayReader(tmp_path / "run.slog")
+    for tick, emitters in recorded.items():
+        assert reader.sections(tick)[engine.EMITTER_TAG] == emitters, tick
+    reader.close()
+
+def mixed_scene(path):
+    '''
+    Saves a scene with a bit of every kind of particle and an emitter, for the runs that have to repeat exactly
+
+    Args:
+        path (str): Where to save the scene
+    '''
+    sand_engine = engine.SandEngine(60, 80, seed=0)
+    types = sand_engine.particle_grid.types
+    types[59, :] = engine.STONE
+    types[10:30, 5:30] = engine.SAND
+    types[5:25, 40:75] = engine.WATER
+    types[45:59, 30:60] = engine.WOOD
+    types[44, 45] = engine.FIRE
+    sand_engine.refresh()
+    sand_engine.add_emitter((1, 60), engine.SAND, rate=0.5)
+    sand_engine.save(path)
+
+@pytest.mark.parametrize("step_mode", STEP_MODES)
+def test_the_same_seed_gives_the_same_scene_byte_for_byte(step_mode, tmp_path):
+    scene = str(tmp_path / "scene.sand")
+    mixed_scene(scene)
+    outputs = [str(tmp_path / f"{run}.sand") for run in ("first", "second", "other_seed")]
+    for output, seed in zip(outputs, (7, 7, 8)):
+        engine.main([scene, "--steps", "150", "--mode", step_mode, "--workers", "2", "--seed", str(seed), "--output", output])
+    first, second, other_seed = (open(output, "rb").read() for output in outputs)
+    assert first == second
+    assert first != other_seed
+
+@pytest.mark.parametrize("compression", [engine.ZLIB_PLANES, engine.RAW_PLANES])
+def test_scenes_load_the_way_they_were_saved(compression, tmp_path):
+    sand_engine = engine.SandEngine(40, 50, seed=1)
+    sand_engine.paint((10, 5), (30, 45), engine.SAND, radius=4)
+    sand_engine.paint((5, 5), (5, 45), engine.STONE, radius=1)
+    sand_engine.add_emitter((2, 20), engine.WATER, rate=0.25)
+    sand_engine.save(tmp_path / "scene.sand", compression)
+
+    for memory_map in ([False, True] if compression == engine.RAW_PLANES else [False]):
+        loaded = engine.SandEngine(1, 1)
+        loaded.load(tmp_path / "scene.sand", memory_map=memory_map)
+        grid, types = loaded.particle_grid, sand_engine.particle_grid.types
+        assert (grid.rows, grid.columns) == (40, 50)
+        assert np.array_equal(grid.types, types)
+        # only the shades of jittered particles are saved
+        varied = engine.VARIED_TABLE[types]
+        assert np.array_equal(grid.colors[varied], sand_engine.particle_grid.colors[varied])
+        assert loaded.emitters.to_bytes() == sand_engine.emitters.to_bytes()
+
+def test_legacy_pickled_scenes_still_load(tmp_path):
+    types = np.zeros((4, 6), dtype=np.int64)
+    types[2:, 1:4] = engine.SAND
+    types[3, 5] = engine.STONE
+    with open(tmp_path / "dictionary.sand", "wb") as file:
+        pickle.dump({"types": types, "colors": np.full(types.shape, 3)}, file)
+    records = np.zeros(types.shape, dtype=[("particle_type", int), ("particle_color", "U7")])
+    records["particle_type"] = types
+    records["particle_color"] = engine.MATERIALS[engine.AIR].color
+    records["particle_color"][types == engine.SAND] = engine.MATERIALS[engine.SAND].color
+    records["particle_color"][types == engine.STONE] = engine.MATERIALS[engine.STONE].color
+    with open(tmp_path / "records.sand", "wb") as file:
+        pickle.dump(records, file)
+
+    for name in ("dictionary.sand", "records.sand"):
+        grid, sections = engine.load_scene(tmp_path / name)
+        assert sections == {}
+        assert np.array_equal(grid.types, types)
+
+def test_legacy_scenes_cant_run_code(tmp_path):
+    with open(tmp_path / "evil.sand", "wb") as file:
+        pickle.dump(print, file)
+    with pytest.raises(pickle.UnpicklingError):
+        engine.load_scene(tmp_path / "evil.sand")
+
+def test_undo_and_redo_put_back_whole_edits():
+    sand_engine = engine.SandEngine(100, 100, seed=2)
+    states = [sand_engine.particle_grid.copy()]
+    for particle_type, row in ((engine.STONE, 80), (engine.SAND, 20), (engine.AIR, 80)):
+        sand_engine.begin_edit()
+        sand_engine.paint((row, 10), (row, 90), particle_type, radius=3)
+        sand_engine.paint((row-10, 50), (row+10, 50), particle_type, radius=2)
+        assert sand_engine.end_edit()
+        states.append(sand_engine.particle_grid.copy())
+
+    def assert_state(index):
+        assert np.array_equal(sand_engine.particle_grid.types, states[index].types)
+        assert np.array_equal(sand_engine.particle_grid.colors, states[index].colors)
+        # the index of movable particles is brought up to date with the written chunks
+        rows, columns = sand_engine.active.locations()
+        assert np.array_equal(np.sort(rows * 100 + columns), np.flatnonzero(engine.MOVABLE_TABLE[states[index].types]))
+
+    for index in (2, 1, 0):
+        assert sand_engine.undo()
+        assert_state(index)
+    assert not sand_engine.undo()
+    for index in (1, 2):
+        assert sand_engine.redo()
+        assert_state(index)
+    # a new edit drops the edits that could still be redone
+    sand_engine.begin_edit()
+    sand_engine.paint((50, 50), (50, 50), engine.WATER, radius=5)
+    sand_engine.end_edit()
+    assert not sand_engine.redo()
+    assert sand_engine.undo()
+    assert_state(2)
+
+def test_scenes_with_unknown_particle_types_dont_load(tmp_path):
+    engine.SandEngine(8, 8).save(tmp_path / "corrupt.sand", engine.RAW_PLANES)
+    # the type plane of an uncompressed scene starts after the header, the palette and the plane's length
+    with open(tmp_path / "corrupt.sand", "r+b") as file:
+        file.seek(engine.SCENE_HEADER.size + engine.PALETTE.size + engine.SCENE_LENGTH.size + 4*8 + 4)
+        file.write(bytes([len(engine.MATERIALS)]))
+    types = np.zeros((4, 4), dtype=np.int64)
+    types[1, 1] = 300 # would wrap around to a known type as a uint8
+    with open(tmp_path / "legacy.sand", "wb") as file:
+        pickle.dump({"types": types, "colors": np.zeros(types.shape)}, file)
+
+    for name, memory_map in (("corrupt.sand", False), ("corrupt.sand", True), ("legacy.sand", False)):
+        with pytest.raises(ValueError, match="particle type"):
+            engine.load_scene(tmp_path / name, memory_map=memory_map)
+
+@pytest.mark.parametrize("focus", [None, (0, 16, 64, 80)])
+def test_a_margolus_dam_break_levels_out_and_falls_asleep(focus):
+    sand_engine = engine.SandEngine(60, 80, step_mode=engine.MARGOLUS_STEP, seed=1)
+    # 1200 cells of water fill the 80 columns exactly 15 deep, with the dam on the left outside the focus
+    sand_engine.particle_grid.types[20:60, 0:30] = engine.WATER
+    sand_engine.refresh()
+    sand_engine.set_focus(focus)
+    settle(sand_engine, limit=12000)
+    depths = np.count_nonzero(sand_engine.particle_grid.types == engine.WATER, axis=0)
+    sand_engine.close()
+    assert depths.min() == depths.max() == 15
+
+def test_emitters_stop_once_the_grid_is_full_enough():
+    sand_engine = engine.SandEngine(32, 32, seed=2)
+    sand_engine.emitters.max_fill = 0.5
+    for column in range(32):
+        sand_engine.add_emitter((0, column), engine.SAND, rate=1.0)
+    # more ticks than the emitters need, so they run on past several counts of the grid
+    for tick in range(200):
+        sand_engine.step()
+    filled = np.count_nonzero(sand_engine.particle_grid.types)
+    sand_engine.close()
+    assert filled == 32 * 32 // 2
+
+def test_scenes_loaded_into_a_world_reach_its_file(tmp_path):
+    scene = engine.SandEngine(32, 48, seed=6)
+    scene.particle_grid.types[20:, 10:30] = engine.SAND
+    scene.save(tmp_path / "scene.sand")
+    engine.SandEngine(16, 16).save(tmp_path / "small.sand")
+
+    sand_engine = engine.SandEngine(32, 48, seed=6)
+    sand_engine.open_world(tmp_path / "world.sand", 32, 48)
+    sand_engine.load(tmp_path / "scene.sand")
+    # edits after the load still go to the world's file
+    sand_engine.paint((0, 0), (0, 47), engine.STONE, radius=0)
+    # a scene of another size is refused and the world is left as it was
+    with pytest.raises(ValueError):
+        sand_engine.load(tmp_path / "small.sand")
+    expected = sand_engine.particle_grid.types.copy()
+    sand_engine.close_world()
+    sand_engine.close()
+
+    grid, sections = engine.load_scene(tmp_path / "world.sand")
+    assert (grid.types == expected).all()
+    assert np.count_nonzero(grid.types == engine.SAND) == 12 * 20
+    assert (grid.types[0] == engine.STONE).all()